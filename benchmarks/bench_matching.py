@@ -0,0 +1,29 @@
+'''Service name lookups: normalization and closest match of an unknown name.
+
+python benchmarks/bench_matching.py
+'''
+import timeit
+
+from webhook_api.matching import TrigramIndex, normalize_service_name
+
+NETWORKS = ('ВК', 'Telegram', 'Instagram', 'TikTok', 'YouTube')
+KINDS = ('Лайки', 'Подписчики', 'Просмотры записи', 'Репосты', 'Комментарии позитивные')
+TIERS = ('Эконом', 'Стандарт', 'Премиум', 'Живые', 'Боты')
+SERIES = 16  # 2000 services
+
+
+def main():
+    names = [f'{network}: {kind} {tier} {n}'
+             for network in NETWORKS for kind in KINDS for tier in TIERS for n in range(SERIES)]
+    index = TrigramIndex(normalize_service_name(name) for name in names)
+    query = normalize_service_name('вк  Лaйки эконом 7 ')
+    number = 2000
+    normalize = timeit.timeit(lambda: normalize_service_name('ВК: Лайки  Эконом 7 '), number=number)
+    match = timeit.timeit(lambda: index.match(query), number=number)
+    print(f'services:   {len(index):>8}')
+    print(f'normalize:  {normalize / number * 1e6:>8.1f} us')
+    print(f'match:      {match / number * 1e6:>8.1f} us  -> {index.match(query)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''Peak memory of concatenated orders parsing: legacy list based vs `iter_raw_orders`.
+
+python benchmarks/bench_order_parser.py
+'''
+import re
+import tracemalloc
+
+from webhook_api.order_parser import iter_raw_orders, parse_order
+
+ENTRY = 'Услуга ВК: Просмотры записи: 0.17 руб. / 1 шт   Ссылка: https://vk.com/wall-217057222_{n}  Количество: 150 - 1x26 = 26'
+
+
+def _legacy_parse_raw_orders(orders_raw: str) -> list:
+    orders = []
+    raw_orders = [f'Услуга:{line}'.strip() for line in re.split(r'(?:^Услуга|; Услуга)', orders_raw) if len(line)]
+    for p in raw_orders:
+        _order = parse_order(p)
+        if _order is not None:
+            orders.append(_order)
+    return orders
+
+
+def _peak(func, *args) -> int:
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _consume(orders_raw: str) -> int:
+    count = 0
+    for _ in iter_raw_orders(orders_raw):
+        count += 1
+    return count
+
+
+def main():
+    for entries in (33, 500, 5000):
+        sample = '; '.join(ENTRY.format(n=n) for n in range(entries))
+        legacy = _peak(_legacy_parse_raw_orders, sample)
+        streaming = _peak(_consume, sample)
+        print(f'{entries:>5} entries ({len(sample.encode()) / 1024:>7.0f} KiB): '
+              f'legacy peak {legacy / 1024:>8.0f} KiB, '
+              f'iter_raw_orders peak {streaming / 1024:>5.0f} KiB')
+
+
+if __name__ == '__main__':
+    main()
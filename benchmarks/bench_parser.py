@@ -0,0 +1,122 @@
+'''Product name parser throughput: legacy implementation vs `parser.parse_orders`.
+
+python benchmarks/bench_parser.py
+'''
+import dataclasses
+import functools
+import math
+import re
+import timeit
+from urllib.parse import unquote
+
+from webhook_api import parser
+
+PRODUCTS = [
+    {
+        'name': 'Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/photo-217356953_457239069?access_keyх25abee02487126647c  Количество: 75',
+        'quantity': 1, 'amount': 24.8, 'price': '24.8',
+    },
+    {
+        'name': 'Услуга Telegram: 300 шт позитивных  : 84 руб. 0.28/шт вместо 0.35/шт   Ссылка: https://t.me/atmanshopp  Количество: 1 пакет',
+        'quantity': 1, 'amount': 84, 'price': '84',
+    },
+    {
+        'name': 'Услуга ВК: Лайки Стандарт: 0.5 руб. / 1 шт   Ссылка: https://vk.com/wall-217057222_3  Количество: 95',
+        'quantity': 1, 'amount': 48, 'price': '48',
+    },
+    {
+        'name': 'Услуга Telegram: Премиум 2000 подп: 1280 руб. 0.64/шт вместо 0.8/шт   Ссылка: https://t.me/medicinskoedelo  Количество: 1 пакет',
+        'quantity': 1, 'amount': 1280, 'price': '1280',
+    },
+]
+
+
+# Legacy implementation (dataclass + cached_property, chained str.replace)
+def _legacy_unescape_url(raw_url: str) -> str:
+    buff = raw_url.strip()
+    for esc, unsec in parser.ESCAPE_MAPPING:
+        buff = buff.replace(esc, unsec)
+    return unquote(buff)
+
+
+_LEGACY_TYPES = {
+    'service_name': lambda service: service.strip(':').strip(' '),
+    'price_per_unit': float,
+    'per_unit': float,
+    'url': _legacy_unescape_url,
+    'amount': float,
+    'is_package': bool,
+    'quantity': float,
+    'price': float,
+    'units_amount': float,
+}
+
+
+@dataclasses.dataclass()
+class _LegacyDetails:
+    service_name: str
+    name: str
+    url: str
+    price_per_unit: float
+    per_unit: float
+    units_amount: float
+    quantity: float
+    amount: float
+    price: float
+    is_package: bool
+
+    @functools.cached_property
+    def calculated_price(self) -> float:
+        if self.is_package:
+            price = self.price_per_unit * self.quantity
+        else:
+            price = self.price_per_unit * self.units_amount * self.quantity
+        return round(price, 2)
+
+    @functools.cached_property
+    def is_payed(self) -> bool:
+        return (self.amount >= self.calculated_price) \
+            or math.floor(self.amount) == math.floor(self.calculated_price) \
+            or (abs(self.amount - self.calculated_price) <= 1)
+
+
+def _legacy_parse_order(_product):
+    m = parser.PRODUCT_RE.search(_product.get('name'))
+    if m is None:
+        return None
+    data = m.groupdict()
+    is_package = data.get('price_per_unit1') is not None
+    price_per_unit = data.get('price_per_unit1') or data.get('price_per_unit')
+    per_unit = data.get('per_unit1') or data.get('per_unit')
+    data.update({
+        'price_per_unit': price_per_unit,
+        'per_unit': per_unit,
+        'is_package': is_package,
+    })
+    data.update(_product)
+    del data['price_per_unit1']
+    del data['per_unit1']
+    if data['is_package']:
+        data['units_amount'] = re.search(r'(\d.)+', data.get('service_name', ''))[0]
+    for prop, value in data.items():
+        data[prop] = _LEGACY_TYPES.get(prop, str)(value)
+    details = _LegacyDetails(**data)
+    details.is_payed
+    return details
+
+
+def main():
+    cart = PRODUCTS * 8  # 32 products; names repeat as in real traffic
+    number = 2000
+    legacy = timeit.timeit(lambda: [_legacy_parse_order(p) for p in cart], number=number)
+    current = timeit.timeit(lambda: parser.parse_orders(cart), number=number)
+    parser._parse_name.cache_clear()
+    cold = timeit.timeit(lambda: (parser._parse_name.cache_clear(), parser.parse_orders(cart)), number=number)
+    total = len(cart) * number
+    print(f'legacy:          {total / legacy:>12,.0f} products/s')
+    print(f'parse_orders:    {total / current:>12,.0f} products/s ({legacy / current:.1f}x)')
+    print(f'parse_orders *:  {total / cold:>12,.0f} products/s ({legacy / cold:.1f}x)  * cache cleared per cart')
+
+
+if __name__ == '__main__':
+    main()
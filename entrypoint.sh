@@ -2,4 +2,8 @@
 set -eu
 set -x
 
-gunicorn 'webhook_api:create_app()'
+if [ "$#" -gt 0 ]; then
+  exec "$@"
+fi
+
+exec gunicorn 'webhook_api:create_app()'
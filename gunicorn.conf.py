@@ -0,0 +1,17 @@
+## gunicorn.conf.py
+## https://docs.gunicorn.org/en/stable/settings.html
+import os
+
+# `/api/v1/status/wait` and `/api/v1/status/stream` requests are mostly idle:
+# a gevent worker holds thousands of them, a thread per request would not
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+# gthread worker
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+
+
+def post_worker_init(worker):
+    '''psycopg2 waits for the database without blocking other greenlets'''
+    if worker.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -1,24 +1,35 @@
+import atexit
 import json
 import logging
-import typing
+import time
 import uuid
-from dataclasses import asdict
-from functools import wraps
 from http import HTTPStatus
 
 import flask
-from flask import Flask, current_app, g, jsonify, request
-from flask_cors import CORS, cross_origin
+from flask import Flask, current_app, g, jsonify, request, stream_with_context
+from flask_cors import CORS
 
 from .config import Config
-from .decorators import auth_required
+from .decorators import auth_required, is_authorized
+from .events import get_events
 from .ext import db
-from .models import (Order, OrderEntry, OrderEntryState, Providers,
-                     RequestLogEntry, ServiceDescription)
-from .order_parser import parse_raw_orders
-from .parser import OrderProductDetails, parse_order
-from .providers import get_provider, is_valid_row, resolve_provider
-from .providers.dummy import DummyProvider
+from .fulfillment import fulfill_order
+from .jobs import FulfillmentQueue
+from .live import get_live_status
+from .journal import RequestJournal, database_sink
+from .metrics import REGISTRY, REQUEST_SECONDS
+from .models import (FulfillmentJob, Notification, Order, ProviderBreaker,
+                     Providers, RequestTrace, ServiceDescription)
+from .panels import PANELS
+from .parser import parse_orders
+from .persistence import insert_order
+from .providers.balance import get_balances
+from .providers.catalog import get_catalog
+from .providers.registry import get_registry
+from .routing import get_routing_cache, update_services
+from .status import (is_settled, load_statuses, requested_order_ids,
+                     status_etag, status_result)
+from .tracing import current_trace, traced
 
 
 def create_app() -> Flask:
@@ -37,6 +48,39 @@ def create_app() -> Flask:
 
     with app.app_context() as ctx:
         db.create_all()
+    get_routing_cache(config).invalidate()
+
+    # Raw requests journal; written by background thread
+    journal = None
+    if config.is_requests_colleced:
+        journal = RequestJournal(
+            directory=config.request_journal_dir,
+            sink=database_sink(app) if config.is_request_journal_db else None,
+            compression=config.request_journal_compression,
+            max_segment_bytes=config.request_journal_segment_size,
+            max_segment_age=config.request_journal_segment_age,
+        )
+        app.extensions['request_journal'] = journal
+        atexit.register(journal.stop)
+
+    # Metrics of all processes are merged via `METRICS_DIR`
+    REGISTRY.configure(config.metrics_dir, config.metrics_flush_interval)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            REGISTRY.touch()
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                endpoint=request.url_rule.rule if request.url_rule is not None else 'unmatched',
+                status=response.status_code,
+            )
+        return response
 
     # Configure CORS headers
     # Restrict access
@@ -51,18 +95,14 @@ def create_app() -> Flask:
         return jsonify({'status': 'ok'}), HTTPStatus.OK
 
     @app.post('/api/v1/webhook')
+    @traced('webhook')
     def api_v1_webhook():
         # Handle platform test request
         # TODO: fix state problem: 1624284557
         #
         # Log each request
-        if config.is_requests_colleced:
-            current_app.logger.info('Storing raw request data')
-            db.session.add(RequestLogEntry(
-                raw_data=request.get_data(as_text=True),
-                content_type=request.headers.get('content-type')
-            ))
-            db.session.commit()
+        if journal is not None:
+            journal.append(request.get_data(as_text=True), request.headers.get('content-type'))
 
         # Handle test webhook invokation
         if 'test' in request.json:
@@ -82,35 +122,42 @@ def create_app() -> Flask:
             with open(sink_dir / f'{order_id}.json', 'wb') as fp:
                 fp.write(request.data)
 
-        # Skip if order already commited;
-        order = db.session.execute(
-            db.select(Order).filter_by(order_id=order_id)
-        ).first()
-        if order is not None:
-            return jsonify({
-                'status': 'error',
-                'message': 'Already exists',
-                'orderId': order_id,
-            }), HTTPStatus.CONFLICT
-
-        # Store Order record
+        # Store Order record, Order Entries (Products. 1 or more)
+        # and fulfillment job in a single transaction.
+        # Already commited orders are skipped atomically
         try:
             # freekassa's transaction id == '0'
             # TODO: this is quick fix
             _systranid = payment.get('systranid')
             _systranid = '_' + str(uuid.uuid4()) if _systranid == '0' else _systranid
-            order = Order(
-                order_id=payment.get('orderid'),
-                email=request.json.get('email'),
-                payment_system=payment.get('sys'),
-                systran_id=_systranid,
-                orders_amount=len(payment.get('products', [])),
-                raw_data=request.get_data(as_text=True),
-            )
-            db.session.add(order)
+            _order = {
+                'order_id': payment.get('orderid'),
+                'email': request.json.get('email'),
+                'payment_system': payment.get('sys'),
+                'systran_id': _systranid,
+                'orders_amount': len(payment.get('products', [])),
+                'raw_data': request.get_data(as_text=True),
+            }
+            _entries = []
+            for n, _product in enumerate(parse_orders(payment.get('products'))):
+                _entries.append({
+                    'entry_id': f'{_order["order_id"]}-{n}',
+                    'state': _product.state,
+                    'is_payed': _product.is_payed,
+                    **_product.as_dict()
+                })
+            _related = []
+            if config.is_fulfillment_queued:
+                _related.append((FulfillmentJob, [FulfillmentQueue.job_values()]))
+            order_pk = insert_order(_order, _entries, _related)
+            if order_pk is not None and config.is_fulfillment_queued:
+                db.session.add(current_trace().record(order_pk))
             db.session.commit()
+
         except Exception as exc:
             current_app.logger.error('Unable to commit order: %s', exc, exc_info=exc)
+            db.session.rollback()
+
             return flask.jsonify({
                 'status': 'error',
                 'message': 'Unable to commit order',
@@ -118,74 +165,20 @@ def create_app() -> Flask:
                 'orderId': order_id,
             }), HTTPStatus.BAD_REQUEST
 
-        # And Order Entries (Products. 1 or more)
-        order_products = []
-        try:
-            for n, _raw_product in enumerate(payment.get('products')):
-                _product = parse_order(_raw_product)
-                _order_entry = OrderEntry(
-                    order=order,
-                    entry_id=f'{order.order_id}-{n}',
-                    state=_product.state,
-                    is_payed=_product.is_payed,
-                    **asdict(_product)
-                )
-                order_products.append(_order_entry)
-                db.session.add(_order_entry)
-            db.session.commit()
-
-        except Exception as exc:
-            current_app.logger.error('Unable to commit order entries: %s', exc, exc_info=exc)
-            db.session.rollback()
-
-            return flask.jsonify({
+        if order_pk is None:
+            return jsonify({
                 'status': 'error',
-                'message': 'Unable to commit order entries',
-                'details': str(exc),
+                'message': 'Already exists',
                 'orderId': order_id,
-            }), HTTPStatus.BAD_REQUEST
+            }), HTTPStatus.CONFLICT
 
-        # Process order entries
-        # Invoke service provider
-        providers_index = ServiceDescription.get_index()
-        _product: OrderEntry
-        for _product in order_products:
-            # Normally not payed requests should be skipped asap
-            # if _product.state != OrderEntryState.created:
-            #    current_app.logger.info('Skipping product: %s', _product.entry_id)
-            #    continue
-            commited_id = None
-            state = _product.state
-            try:
-                provider_details = resolve_provider(str(_product.service_name).lower(), providers_index)
-                _product.service_id = provider_details.service_id
-                _product.provider_id = provider_details.provider_id
-                current_app.logger.info('Order=%s provider=%s', _product.entry_id, provider_details)
-                Provider = get_provider(provider_details.provider_id)
-                provider = Provider(config.get_provider_config(provider_details.provider_id))
-                notifier = DummyProvider(config.get_provider_config(Providers.dummy))
-                notifier.describe(_product)
-
-                # Process if product payed
-                if _product.is_payed:
-                    commited_id = provider.make_order(_product)
-                # Mark as fulfiled if payed and executed (commited_id received)
-                if _product.is_payed and commited_id is not None:
-                    state = OrderEntryState.fulfilled
-                current_app.logger.info('Commited ID: %s', commited_id)
-            except Exception as exc:
-                if 'Invalid API key' in str(exc):
-                    current_app.logger.error('API KEY REQUIRED')
-                else:
-                    current_app.logger.error('Unable to commit order: %s', exc, exc_info=exc)
-                current_app.logger.error('Details: %s', _product)
-                state = OrderEntryState.failed
-                _product.error_hint = str(exc)
-            _product.state = state
-            _product.provider_order_id = commited_id
-
-            db.session.add(_product)
-        db.session.commit()
+        # Process order entries: invoke service providers
+        # Queued orders are processed by `webhook-worker`
+        if not config.is_fulfillment_queued:
+            fulfill_order(db.session.get(Order, order_pk), config)
+            db.session.add(current_trace().record(order_pk))
+            db.session.commit()
+        current_trace().report(order_id, config.slow_request_threshold_ms)
 
         return jsonify({
             'status': 'ok',
@@ -194,67 +187,225 @@ def create_app() -> Flask:
             },
         }), HTTPStatus.OK
 
-    @app.post('/api/v1/status')
+    @app.route('/api/v1/status', methods=['GET', 'POST'])
     def api_v1_status():
-        '''Check order status'''
-        data = request.json
-        order_id = data.get('orderId')
-        if order_id is None:
+        '''Check order status.
+
+        POST {"orderId": ...} or {"orderIds": [...]};
+        GET ?orderId=... or ?orderIds=1,2,3.
+        `live`: entries include panel statuses (cached for LIVE_STATUS_TTL seconds); authorized only.
+        Responses carry ETag; `If-None-Match` of unchanged orders gets 304.
+        '''
+        data = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+        try:
+            requested, is_batch = requested_order_ids(data)
+        except ValueError as exc:
             return jsonify({
                 'status': 'error',
-                'message': 'Bad request. orderId missing',
+                'message': f'Bad request. {exc}',
             }), HTTPStatus.BAD_REQUEST
 
-        order = db.session.execute(
-            db.select(Order)
-            .filter_by(order_id=str(order_id))
-            .options(db.lazyload(Order.orders))
-        ).first()
-        if order is None:
+        statuses = load_statuses(requested)
+        with_timings = bool(data.get('timings')) and is_authorized(config.tokens)
+        # Panel calls spend the rate limits and breakers of the fulfillment
+        with_live = bool(data.get('live')) and is_authorized(config.tokens)
+        etag = None
+        if not with_timings and not with_live:
+            # Timings and panel statuses are not covered by the state changes
+            etag = status_etag(statuses, requested)
+            if request.if_none_match.contains(etag):
+                return '', HTTPStatus.NOT_MODIFIED, {'ETag': f'"{etag}"'}
+
+        live = None
+        if with_live:
+            # Lookups of concurrent requests share `multi_status` calls
+            live = get_live_status(config).lookup(
+                (entry.provider_id, entry.provider_order_id)
+                for status in statuses.values() for entry in status.entries
+            )
+        result = status_result(statuses, requested, is_batch, live)
+        if not is_batch and requested[0] not in statuses:
+            return jsonify(result), HTTPStatus.NOT_FOUND
+        # Stage timings of the webhook request and worker runs
+        if with_timings and not is_batch:
+            result['result']['timings'] = [
+                trace.as_dict()
+                for trace in db.session.execute(
+                    db.select(RequestTrace)
+                    .filter_by(order_id=statuses[requested[0]].pk)
+                    .order_by(RequestTrace.id)
+                ).scalars()
+            ]
+        response = jsonify(result)
+        if etag is not None:
+            response.set_etag(etag)
+        return response, HTTPStatus.OK
+
+    @app.get('/api/v1/status/wait')
+    def api_v1_status_wait():
+        '''Long-poll `/api/v1/status`: answered once the orders differ from `If-None-Match`.
+
+        GET ?orderId=... or ?orderIds=1,2,3; ?timeout= seconds (up to STATUS_WAIT_TIMEOUT).
+        Nothing changed within timeout - 304.
+        '''
+        try:
+            requested, is_batch = requested_order_ids(request.args)
+            timeout = min(float(request.args.get('timeout', config.status_wait_timeout)),
+                          config.status_wait_timeout)
+        except ValueError as exc:
             return jsonify({
-                'status': 'ok',
-                'result': 'Not found'
-            }), HTTPStatus.NOT_FOUND
+                'status': 'error',
+                'message': f'Bad request. {exc}',
+            }), HTTPStatus.BAD_REQUEST
+
+        deadline = time.monotonic() + timeout
+        # Subscribed before the first read: changes committed meanwhile are not missed
+        with get_events(db.engine).subscribe(requested) as subscription:
+            statuses = load_statuses(requested)
+            etag = status_etag(statuses, requested)
+            while request.if_none_match.contains(etag):
+                # Database connection is not held by waiting requests
+                db.session.close()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not subscription.wait(remaining):
+                    return '', HTTPStatus.NOT_MODIFIED, {'ETag': f'"{etag}"'}
+                statuses = load_statuses(requested)
+                etag = status_etag(statuses, requested)
+
+        response = jsonify(status_result(statuses, requested, is_batch))
+        response.set_etag(etag)
+        return response, HTTPStatus.OK
+
+    @app.get('/api/v1/status/stream')
+    def api_v1_status_stream():
+        '''Server-Sent Events: `/api/v1/status` result as a `status` event on every change.
+
+        GET ?orderId=... or ?orderIds=1,2,3. Event id is the ETag; reconnects with
+        `Last-Event-ID` skip the unchanged state. The stream ends once all entries
+        are settled (then reconnects get 204) or after STATUS_STREAM_TIMEOUT.
+        '''
+        try:
+            requested, is_batch = requested_order_ids(request.args)
+        except ValueError as exc:
+            return jsonify({
+                'status': 'error',
+                'message': f'Bad request. {exc}',
+            }), HTTPStatus.BAD_REQUEST
+
+        subscription = get_events(db.engine).subscribe(requested)
+        statuses = load_statuses(requested)
+        last_event_id = request.headers.get('Last-Event-ID')
+        if is_settled(statuses, requested) and status_etag(statuses, requested) == last_event_id:
+            # Nothing is going to change: 204 stops EventSource reconnects
+            subscription.close()
+            return '', HTTPStatus.NO_CONTENT
+
+        def _events():
+            nonlocal statuses
+            deadline = time.monotonic() + config.status_stream_timeout
+            sent_etag = last_event_id
+            while True:
+                etag = status_etag(statuses, requested)
+                if etag != sent_etag:
+                    data = json.dumps(status_result(statuses, requested, is_batch), ensure_ascii=False)
+                    yield f'event: status\nid: {etag}\ndata: {data}\n\n'
+                    sent_etag = etag
+                if is_settled(statuses, requested):
+                    return
+                # Database connection is not held between events
+                db.session.close()
+                while not subscription.wait(min(config.status_keepalive_interval,
+                                                max(deadline - time.monotonic(), 0))):
+                    if time.monotonic() >= deadline:
+                        return
+                    yield ': keep-alive\n\n'
+                statuses = load_statuses(requested)
 
-        order = order[0]
+        response = app.response_class(stream_with_context(_events()), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            # Not buffered by nginx
+            'X-Accel-Buffering': 'no',
+        })
+        # Also when the client is gone before the first event
+        response.call_on_close(subscription.close)
+        return response
 
+    @app.get('/metrics')
+    def metrics_page():
+        '''Prometheus text exposition'''
+        return REGISTRY.render(), HTTPStatus.OK, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    @app.get('/api/v1/catalog')
+    @auth_required(config.tokens)
+    def api_v1_catalog():
+        '''Panel service catalogs freshness and routing table entries unknown to panels'''
+        catalog = get_catalog(config)
+        if request.args.get('refresh'):
+            registry = get_registry(config)
+            for name in PANELS:
+                try:
+                    registry.get(Providers[name]).refresh_catalog()
+                except Exception as exc:
+                    current_app.logger.error('Unable to refresh %s catalog: %s', name, exc, exc_info=exc)
+        rows = db.session.execute(
+            db.select(ServiceDescription.service_name,
+                      ServiceDescription.service_id,
+                      ServiceDescription.provider_id)
+            .where(ServiceDescription.provider_id.in_([Providers[name] for name in PANELS]))
+            .order_by(ServiceDescription.service_name, ServiceDescription.priority)
+        ).all()
         return jsonify({
             'status': 'ok',
             'result': {
-                'orderId': order.order_id,
-                'entries': [
-                    {
-                        'entryId': _product.entry_id,
-                        'state': str(_product.state.name),
-                        'message': str(_product.error_hint or ''),
-                    }
-                    for _product in order.orders
-                ],
-                'createdAt': order.created_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
-                'total': order.orders_amount
-            }
+                'catalogs': {name: catalog.stats(name) for name in PANELS},
+                'mismatches': catalog.mismatches(
+                    (service_name, service_id, provider_id.name) for service_name, service_id, provider_id in rows
+                ),
+            },
         }), HTTPStatus.OK
 
+    @app.get('/api/v1/health')
     @auth_required(config.tokens)
+    def api_v1_health():
+        '''Provider clients state of this process'''
+        return jsonify({
+            'status': 'ok',
+            'result': {
+                'pools': get_registry(config).stats(),
+                'breakers': get_registry(config).breakers(),
+                'rate_limits': get_registry(config).limits(),
+                'balances': get_balances(config).stats(),
+                'shared_breakers': {
+                    breaker.provider: {
+                        'state': breaker.state.name,
+                        'opened_until': breaker.opened_until.strftime('%Y-%m-%dT%H:%M:%SZ')
+                        if breaker.opened_until else None,
+                        'trips': breaker.trips,
+                    }
+                    for breaker in db.session.execute(db.select(ProviderBreaker)).scalars()
+                },
+                'routing': get_routing_cache(config).stats(),
+                'status_events': get_events().stats(),
+                'live_status': get_live_status(config).stats(),
+                'outbox': {
+                    state.name: count
+                    for state, count in db.session.execute(
+                        db.select(Notification.state, db.func.count(Notification.id)).group_by(Notification.state))
+                },
+            },
+        }), HTTPStatus.OK
+
     @app.post('/api/v1/updateServices')
+    @auth_required(config.tokens)
     def api_v1_update_services():
-        '''Handle service configurations from Google Sheets'''
+        '''Handle service configurations from Google Sheets.
+
+        Only the difference with the current routing table is written;
+        pushes identical to the last applied one are skipped.
+        '''
         data = request.json
-        _index = {}
-        updates = []
-        for row in data:
-            if is_valid_row(row):
-                _service_name = str(row[0]).lower()
-                if _service_name not in updates:
-                    updates.append(row)
-                    _index[_service_name] = 1
         try:
-            ServiceDescription.query.delete()
-            for service_name, service_id, provider_id in updates:
-                db.session.add(ServiceDescription(
-                    service_name=str(service_name).lower().strip(),
-                    service_id=service_id,
-                    provider_id=Providers[provider_id]))
+            diff = update_services(data)
             db.session.commit()
         except Exception as exc:
             db.session.rollback()
@@ -263,8 +414,11 @@ def create_app() -> Flask:
                 'status': 'error',
                 'message': f'Unable to commit changes: {exc}'
             }), HTTPStatus.BAD_REQUEST
-        return jsonify({
-            'status': 'ok'
-        }), HTTPStatus.OK
+        response = jsonify({
+            'status': 'ok',
+            'result': diff.as_dict(),
+        })
+        response.set_etag(diff.checksum)
+        return response, HTTPStatus.OK
 
     return app
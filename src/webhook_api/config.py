@@ -1,10 +1,18 @@
 import os
 from functools import cached_property
+from typing import Optional
+
+from .panels import PANELS
 
 __all__ = (
     'Config',
 )
 
+# Calls per second; Telegram allows a bot about 30 messages per second
+DEFAULT_RATE_LIMITS = {
+    'dummy': 25.0,
+}
+
 
 class Config:
     @cached_property
@@ -35,26 +43,238 @@ class Config:
         _val = os.environ.get('COLLECT_REQUESTS', '').strip()
         return bool(_val)
 
+    @cached_property
+    def request_journal_dir(self) -> str:
+        '''Raw requests segments directory; not set - segments are not written'''
+        return os.environ.get('REQUEST_JOURNAL_DIR', '').strip() or None
+
+    @cached_property
+    def request_journal_compression(self) -> str:
+        '''gzip or zstd'''
+        return os.environ.get('REQUEST_JOURNAL_COMPRESSION', 'gzip').strip().lower()
+
+    @cached_property
+    def request_journal_segment_size(self) -> int:
+        return int(os.environ.get('REQUEST_JOURNAL_SEGMENT_SIZE', str(64 * 2 ** 20)))
+
+    @cached_property
+    def request_journal_segment_age(self) -> int:
+        return int(os.environ.get('REQUEST_JOURNAL_SEGMENT_AGE', '3600'))
+
+    @cached_property
+    def is_request_journal_db(self) -> bool:
+        '''Raw requests are stored as `RequestLogEntry` rows (in batches)'''
+        _val = os.environ.get('REQUEST_JOURNAL_DB', '').strip()
+        if not _val:
+            return self.request_journal_dir is None
+        return _val.lower() not in ('0', 'false', 'no')
+
+    @cached_property
+    def is_fulfillment_queued(self) -> bool:
+        '''Provider calls are made by `webhook-worker` instead of the request handler'''
+        _val = os.environ.get('FULFILLMENT_MODE', 'queue').strip().lower()
+        return _val != 'inline'
+
+    @cached_property
+    def worker_poll_interval(self) -> float:
+        return float(os.environ.get('WORKER_POLL_INTERVAL', '1.0'))
+
+    @cached_property
+    def worker_batch_size(self) -> int:
+        return int(os.environ.get('WORKER_BATCH_SIZE', '10'))
+
+    @cached_property
+    def worker_lock_timeout(self) -> int:
+        '''Seconds before a claimed job is considered abandoned'''
+        return int(os.environ.get('WORKER_LOCK_TIMEOUT', '300'))
+
+    @cached_property
+    def worker_max_attempts(self) -> int:
+        return int(os.environ.get('WORKER_MAX_ATTEMPTS', '5'))
+
+    @cached_property
+    def status_sync_interval(self) -> int:
+        '''Seconds between provider status synchronizations; 0 - disabled'''
+        return int(os.environ.get('STATUS_SYNC_INTERVAL', '300'))
+
+    @cached_property
+    def routing_check_interval(self) -> float:
+        '''Seconds between services routing table revision checks'''
+        return float(os.environ.get('ROUTING_CHECK_INTERVAL', '1.0'))
+
+    @cached_property
+    def service_match_threshold(self) -> float:
+        '''Unknown service names are routed to a configured service at least that similar (0..1); 0 - never'''
+        return float(os.environ.get('SERVICE_MATCH_THRESHOLD', '0.9'))
+
+    @cached_property
+    def dispatch_max_workers(self) -> int:
+        '''Threads invoking providers for the order entries in parallel'''
+        return int(os.environ.get('DISPATCH_MAX_WORKERS', '8'))
+
+    @cached_property
+    def provider_concurrency(self) -> int:
+        '''Default limit of parallel calls per provider'''
+        return int(os.environ.get('PROVIDER_CONCURRENCY', '4'))
+
+    @cached_property
+    def http_pool_maxsize(self) -> int:
+        '''Keep-alive connections per provider host'''
+        return int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+
+    @cached_property
+    def retry_budget(self) -> float:
+        '''Seconds provider calls of an order may spend on retries'''
+        return float(os.environ.get('RETRY_BUDGET', '30'))
+
+    @cached_property
+    def breaker_window(self) -> float:
+        '''Seconds of provider call outcomes considered by circuit breakers'''
+        return float(os.environ.get('BREAKER_WINDOW', '30'))
+
+    @cached_property
+    def breaker_min_calls(self) -> int:
+        return int(os.environ.get('BREAKER_MIN_CALLS', '10'))
+
+    @cached_property
+    def breaker_failure_rate(self) -> float:
+        '''Share of failed (or slow) calls which opens the breaker'''
+        return float(os.environ.get('BREAKER_FAILURE_RATE', '0.5'))
+
+    @cached_property
+    def breaker_slow_call(self) -> float:
+        '''Seconds; slower calls count as slow'''
+        return float(os.environ.get('BREAKER_SLOW_CALL', '3.0'))
+
+    @cached_property
+    def breaker_open_seconds(self) -> float:
+        return float(os.environ.get('BREAKER_OPEN_SECONDS', '30'))
+
+    @cached_property
+    def breaker_sync_interval(self) -> float:
+        '''Seconds between shared breaker state checks'''
+        return float(os.environ.get('BREAKER_SYNC_INTERVAL', '1.0'))
+
+    @cached_property
+    def provider_rate_limit(self) -> float:
+        '''Default calls per second per provider API key; 0 - unlimited'''
+        return float(os.environ.get('PROVIDER_RATE_LIMIT', '10'))
+
+    @cached_property
+    def rate_limit_max_wait(self) -> float:
+        '''Seconds a provider call may be queued by rate limits before it is deferred'''
+        return float(os.environ.get('RATE_LIMIT_MAX_WAIT', '5.0'))
+
+    @cached_property
+    def catalog_dir(self) -> str:
+        '''Panel service catalogs shared by processes; not set - kept in worker memory only'''
+        return os.environ.get('CATALOG_DIR', '').strip() or None
+
+    @cached_property
+    def catalog_refresh_interval(self) -> int:
+        '''Seconds between panel service catalog refreshes; 0 - disabled'''
+        return int(os.environ.get('CATALOG_REFRESH_INTERVAL', '3600'))
+
+    @cached_property
+    def balance_poll_interval(self) -> int:
+        '''Seconds between provider balance polls; 0 - disabled'''
+        return int(os.environ.get('BALANCE_POLL_INTERVAL', '300'))
+
+    @cached_property
+    def notify_batch_size(self) -> int:
+        '''Notifications claimed by the outbox dispatcher at once'''
+        return int(os.environ.get('NOTIFY_BATCH_SIZE', '50'))
+
+    @cached_property
+    def notify_concurrency(self) -> int:
+        '''Notifications sent in parallel'''
+        return int(os.environ.get('NOTIFY_CONCURRENCY', '4'))
+
+    @cached_property
+    def notify_digest_window(self) -> float:
+        '''Seconds order notifications are collected into a digest; 0 - a message per entry'''
+        return float(os.environ.get('NOTIFY_DIGEST_WINDOW', '5'))
+
+    @cached_property
+    def notify_max_attempts(self) -> int:
+        return int(os.environ.get('NOTIFY_MAX_ATTEMPTS', '10'))
+
+    @cached_property
+    def status_wait_timeout(self) -> float:
+        '''Longest `/api/v1/status/wait` request, seconds'''
+        return float(os.environ.get('STATUS_WAIT_TIMEOUT', '30'))
+
+    @cached_property
+    def status_stream_timeout(self) -> float:
+        '''`/api/v1/status/stream` is closed after that many seconds; clients reconnect'''
+        return float(os.environ.get('STATUS_STREAM_TIMEOUT', '300'))
+
+    @cached_property
+    def status_keepalive_interval(self) -> float:
+        '''Seconds between `/api/v1/status/stream` keep-alive comments'''
+        return float(os.environ.get('STATUS_KEEPALIVE_INTERVAL', '15'))
+
+    @cached_property
+    def live_status_window(self) -> float:
+        '''Seconds concurrent live status lookups of a provider are collected into one `multi_status` call'''
+        return float(os.environ.get('LIVE_STATUS_WINDOW', '0.05'))
+
+    @cached_property
+    def live_status_ttl(self) -> float:
+        '''Seconds live provider statuses are cached'''
+        return float(os.environ.get('LIVE_STATUS_TTL', '10'))
+
+    @cached_property
+    def live_status_timeout(self) -> float:
+        return float(os.environ.get('LIVE_STATUS_TIMEOUT', '10'))
+
+    @cached_property
+    def slow_request_threshold_ms(self) -> float:
+        '''Requests (and worker runs) slower than that are logged with their spans; 0 - disabled'''
+        return float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', '5000'))
+
+    @cached_property
+    def metrics_dir(self) -> str:
+        '''Shared metrics directory of all processes; not set - per process metrics'''
+        return os.environ.get('METRICS_DIR', '').strip() or None
+
+    @cached_property
+    def metrics_flush_interval(self) -> float:
+        return float(os.environ.get('METRICS_FLUSH_INTERVAL', '5.0'))
+
     @cached_property
     def providers(self) -> dict:
         return {
             'dummy': {
                 'token': os.environ.get('TELEGRAM_TOKEN'),
                 'chat_id': os.environ.get('TELEGRAM_CHAT_ID'),
+                'digest_window': self.notify_digest_window,
             },
-            'socproof': {
-                'token': os.environ.get('SOCPROOF_TOKEN'),
+            **{
+                panel.name: {
+                    'token': os.environ.get(panel.token_key),
+                }
+                for panel in PANELS.values()
             },
-            'justanotherpanel': {
-                'token': os.environ.get('JUSTANOTHERPANEL_TOKEN'),
-            },
-            'prosmmstore': {
-                'token': os.environ.get('PROSMMSTORE_TOKEN'),
-            },
-            'fxsmmsoc': {
-                'token': os.environ.get('FXSMMSOC_TOKEN'),
-            }
         }
 
     def get_provider_config(self, provider_id) -> dict:
         return self.providers.get(provider_id.name, {})
+
+    def get_provider_concurrency(self, provider_id) -> int:
+        '''Per provider limit, e.g. SOCPROOF_CONCURRENCY=2'''
+        _val = os.environ.get(f'{provider_id.name.upper()}_CONCURRENCY', '').strip()
+        return int(_val) if _val else self.provider_concurrency
+
+    def get_provider_rate_limit(self, provider_id) -> tuple[float, float]:
+        '''(calls per second, burst) per provider, e.g. SOCPROOF_RATE_LIMIT=5, SOCPROOF_RATE_BURST=10'''
+        _name = provider_id.name.upper()
+        _rate = os.environ.get(f'{_name}_RATE_LIMIT', '').strip()
+        rate = float(_rate) if _rate else DEFAULT_RATE_LIMITS.get(provider_id.name, self.provider_rate_limit)
+        _burst = os.environ.get(f'{_name}_RATE_BURST', '').strip()
+        return rate, float(_burst) if _burst else rate
+
+    def get_provider_max_in_flight(self, provider_id) -> Optional[int]:
+        '''Calls in progress per process, e.g. SOCPROOF_MAX_IN_FLIGHT=8'''
+        _val = os.environ.get(f'{provider_id.name.upper()}_MAX_IN_FLIGHT', '').strip()
+        return int(_val) if _val else None
@@ -6,21 +6,26 @@ from flask import current_app, jsonify, request
 
 __all__ = (
     'auth_required',
+    'is_authorized',
 )
 
 
+def is_authorized(_tokens) -> bool:
+    '''Current request has a valid bearer token'''
+    _raw = request.headers.get('Authorization', '')
+    try:
+        scheme, token = [part.strip().lower() for part in f'{_raw} '.split(' ', 1)]
+    except ValueError:
+        return False
+    return scheme == 'bearer' and bool(token) and token in _tokens
+
+
 def auth_required(_tokens) -> Callable:
     def _wrapper(f: Callable):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             current_app.logger.info(request.headers)
-            _raw = request.headers.get('Authorization', '')
-            try:
-                scheme, token = [part.strip().lower() for part in f'{_raw} '.split(' ', 1)]
-                if scheme != 'bearer' \
-                        or not token or token not in _tokens:
-                    raise Exception('Auth REQUIRED')
-            except Exception:
+            if not is_authorized(_tokens):
                 return jsonify({
                     'status': 'error',
                     'message': 'auth REQUIRED',
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+from .config import Config
+from .models import Providers
+
+__all__ = (
+    'DispatchResult',
+    'OrderDispatcher',
+    'get_dispatcher',
+)
+
+
+class DispatchResult(NamedTuple):
+    item: Any
+    result: Any
+    error: Optional[Exception]
+
+
+class OrderDispatcher:
+    '''Bounded thread pool for provider invocations.
+
+    Calls are executed in parallel, but no more than
+    `config.get_provider_concurrency(provider)` calls per provider at once.
+    '''
+
+    def __init__(self, config: Config) -> None:
+        self._config = config
+        self._executor = ThreadPoolExecutor(
+            max_workers=config.dispatch_max_workers,
+            thread_name_prefix='dispatch',
+        )
+        self._limits: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, provider_id: Providers) -> threading.BoundedSemaphore:
+        with self._lock:
+            semaphore = self._limits.get(provider_id.name)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self._config.get_provider_concurrency(provider_id))
+                self._limits[provider_id.name] = semaphore
+            return semaphore
+
+    @contextmanager
+    def slot(self, provider_id: Providers):
+        '''Hold one of provider's concurrency slots'''
+        with self._limit(provider_id):
+            yield
+
+    def map(self, func: Callable, items: Iterable) -> list[DispatchResult]:
+        '''Run `func(item)` for each item. Results are returned in items order'''
+        items = list(items)
+        futures = [self._executor.submit(func, item) for item in items]
+        results = []
+        for item, future in zip(items, futures):
+            try:
+                results.append(DispatchResult(item, future.result(), None))
+            except Exception as exc:
+                results.append(DispatchResult(item, None, exc))
+        return results
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+_dispatcher: Optional[OrderDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher(config: Config) -> OrderDispatcher:
+    '''Process-wide dispatcher. Created lazily, so pool threads start after fork'''
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = OrderDispatcher(config)
+        return _dispatcher
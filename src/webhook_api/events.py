@@ -0,0 +1,239 @@
+'''Order state change events for waiting `/api/v1/status` clients.
+
+Fulfillment and status synchronization publish Tilda order ids of the
+changed entries within their transaction. On PostgreSQL an event is a
+`NOTIFY order_state` sent by the commit; every web process holds a single
+LISTEN connection and wakes up its waiting requests. Other databases
+(SQLite) fall back to the in-process broker: events are delivered on
+commit to the requests of the same process.
+'''
+import os
+import select
+import threading
+from typing import Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, scoped_session
+
+from .ext import db
+from .log import logger
+from .metrics import REGISTRY
+
+__all__ = (
+    'CHANNEL',
+    'OrderEvents',
+    'Subscription',
+    'get_events',
+    'publish',
+)
+
+# NOTIFY channel
+CHANNEL = 'order_state'
+# NOTIFY payload is limited to 8000 bytes
+PAYLOAD_SIZE = 7900
+# `Session.info` key of the events delivered on commit (in-process broker)
+_PENDING = 'order_events'
+
+ORDER_EVENTS = REGISTRY.counter(
+    'order_events_total', 'Order state change events received by the process')
+SUBSCRIBERS = REGISTRY.gauge(
+    'order_event_subscribers', 'Requests waiting for order state changes')
+
+
+def _payloads(order_ids: Iterable[str]) -> list[str]:
+    '''Comma separated order ids within NOTIFY payload limit'''
+    payloads, current = [], ''
+    for order_id in sorted(order_ids):
+        candidate = f'{current},{order_id}' if current else order_id
+        if len(candidate.encode()) > PAYLOAD_SIZE and current:
+            payloads.append(current)
+            candidate = order_id
+        current = candidate
+    if current:
+        payloads.append(current)
+    return payloads
+
+
+def publish(session, order_ids: Iterable) -> None:
+    '''Announce changes of the orders when the session is committed. Nothing is sent on rollback'''
+    order_ids = {str(order_id) for order_id in order_ids if order_id is not None}
+    if not order_ids:
+        return
+    if isinstance(session, scoped_session):
+        session = session()
+    if session.get_bind().dialect.name == 'postgresql':
+        for payload in _payloads(order_ids):
+            session.execute(db.select(db.func.pg_notify(CHANNEL, payload)))
+    else:
+        if not session.in_transaction():
+            # Discarded by the rollback of this transaction
+            session.begin()
+        session.info.setdefault(_PENDING, set()).update(order_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _deliver(session: Session) -> None:
+    order_ids = session.info.pop(_PENDING, None)
+    if order_ids:
+        get_events().dispatch(order_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard(session: Session, previous_transaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+class Subscription:
+    '''Changes of the orders published since the subscription. Use as context manager'''
+
+    def __init__(self, events: 'OrderEvents', order_ids: Iterable[str]) -> None:
+        self._events = events
+        self.order_ids = frozenset(str(order_id) for order_id in order_ids)
+        self._changed: set[str] = set()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def notify(self, order_ids: Iterable[str]) -> None:
+        with self._condition:
+            self._changed.update(order_ids)
+            self._condition.notify_all()
+
+    def wait(self, timeout: float) -> set[str]:
+        '''Changed order ids; empty if nothing changed within timeout'''
+        with self._condition:
+            self._condition.wait_for(lambda: self._changed, timeout)
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def close(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+        self._events.unsubscribe(self)
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class OrderEvents:
+    '''Waiting requests of this process by order id'''
+
+    def __init__(self) -> None:
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._listener: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.waiting = 0
+        self.received = 0
+
+    def subscribe(self, order_ids: Iterable[str]) -> Subscription:
+        subscription = Subscription(self, order_ids)
+        with self._lock:
+            for order_id in subscription.order_ids:
+                self._subscriptions.setdefault(order_id, set()).add(subscription)
+            self.waiting += 1
+            SUBSCRIBERS.set(self.waiting)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for order_id in subscription.order_ids:
+                subscriptions = self._subscriptions.get(order_id)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[order_id]
+            self.waiting -= 1
+            SUBSCRIBERS.set(self.waiting)
+
+    def dispatch(self, order_ids: Iterable[str]) -> None:
+        '''Wake up subscriptions of the changed orders'''
+        changed: dict[Subscription, set[str]] = {}
+        with self._lock:
+            for order_id in order_ids:
+                self.received += 1
+                ORDER_EVENTS.inc()
+                for subscription in self._subscriptions.get(order_id, ()):
+                    changed.setdefault(subscription, set()).add(order_id)
+        for subscription, subscription_changes in changed.items():
+            subscription.notify(subscription_changes)
+
+    def dispatch_all(self) -> None:
+        '''Events may have been lost (e.g. LISTEN connection reconnected): every subscription rechecks'''
+        with self._lock:
+            subscriptions = {subscription for group in self._subscriptions.values() for subscription in group}
+        for subscription in subscriptions:
+            subscription.notify(subscription.order_ids)
+
+    def listen(self, engine, reconnect_delay: float = 1.0) -> None:
+        '''Receive NOTIFY events of all processes with a dedicated connection (PostgreSQL only)'''
+        with self._lock:
+            if self._listener is not None or engine.dialect.name != 'postgresql':
+                return
+            self._listener = threading.Thread(target=self._listen, args=(engine, reconnect_delay),
+                                              name='order-events', daemon=True)
+            self._listener.start()
+
+    def _listen(self, engine, reconnect_delay: float) -> None:
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                driver_connection = connection.driver_connection
+                driver_connection.autocommit = True
+                with driver_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CHANNEL}')
+                logger.info('Listening to %s', CHANNEL)
+                self.dispatch_all()
+                while not self._stopped.is_set():
+                    if select.select([driver_connection], [], [], 5.0) == ([], [], []):
+                        continue
+                    driver_connection.poll()
+                    while driver_connection.notifies:
+                        notify = driver_connection.notifies.pop(0)
+                        self.dispatch(filter(None, notify.payload.split(',')))
+            except Exception as exc:
+                logger.error('%s listener failed: %s', CHANNEL, exc, exc_info=exc)
+                self._stopped.wait(reconnect_delay)
+            finally:
+                if connection is not None:
+                    # Connection in LISTEN state is never returned to the pool
+                    connection.invalidate()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'waiting': self.waiting,
+                'orders': len(self._subscriptions),
+                'received': self.received,
+                'listening': self._listener is not None and self._listener.is_alive(),
+            }
+
+
+_events: Optional[OrderEvents] = None
+_events_lock = threading.Lock()
+
+
+def get_events(engine=None) -> OrderEvents:
+    '''Broker of the process. LISTEN connection is opened once `engine` is given
+
+    Built again after fork (e.g. gunicorn `preload_app`): the listener
+    thread is not inherited. The parent's LISTEN connection is left alone,
+    closing it would end the parent's session too.
+    '''
+    global _events
+    with _events_lock:
+        if _events is None or _events.pid != os.getpid():
+            _events = OrderEvents()
+    if engine is not None:
+        _events.listen(engine)
+    return _events
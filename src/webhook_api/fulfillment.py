@@ -0,0 +1,249 @@
+import dataclasses
+import time
+from typing import NamedTuple, Optional
+
+from .config import Config
+from .dispatcher import OrderDispatcher, get_dispatcher
+from .events import publish
+from .ext import db
+from .jobs import utcnow
+from .log import logger
+from .metrics import ORDER_ENTRY_TRANSITIONS, REGISTRY, stage, timed
+from .models import Order, OrderEntry, OrderEntryState, Providers
+from .providers.dummy import DummyProvider
+from .providers.registry import ProviderRegistry, get_registry
+from .providers.utils import RETRYABLE, ProviderError, RetryLater, classify_error, retry_scope
+from .routing import get_routing_cache
+from .tracing import Trace, current_trace
+
+__all__ = (
+    'abandon_entries',
+    'fulfill_order',
+    'pending_entries',
+)
+
+FAILOVERS = REGISTRY.counter(
+    'provider_failovers_total', 'Orders passed to an alternate provider', ('provider', 'alternate'))
+
+
+def pending_entries(order: Order, is_retry: bool = False) -> list[OrderEntry]:
+    '''Order entries which still have to be passed to the providers.
+
+    First run handles every entry (not payed ones are only described).
+    Retries handle payed entries without provider's order id only.
+    Parent order is loaded eagerly: entries are read from dispatcher threads.
+    '''
+    query = db.select(OrderEntry) \
+        .filter_by(order_id=order.id) \
+        .options(db.joinedload(OrderEntry.order)) \
+        .order_by(OrderEntry.id)
+    if is_retry:
+        query = query.filter_by(state=OrderEntryState.created, is_payed=True)
+    return list(db.session.execute(query).scalars())
+
+
+class _Candidate(NamedTuple):
+    service_id: str
+    provider_id: Providers
+    provider: object
+
+
+class _RoutedEntry:
+    '''Order entry as seen by an alternate provider. Read-only'''
+
+    def __init__(self, entry: OrderEntry, candidate: _Candidate) -> None:
+        self._entry = entry
+        self.service_id = candidate.service_id
+        self.provider_id = candidate.provider_id
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+@dataclasses.dataclass()
+class _Submission:
+    entry: OrderEntry
+    candidates: list[_Candidate]  # Preferred first
+    notifier: DummyProvider
+    trace: Trace = None
+    deadline: Optional[float] = None  # time.monotonic()
+    defer: bool = False
+    describe: bool = True  # First run only: retries are described already
+
+
+def _is_not_placed(exc: Exception) -> bool:
+    '''Provider surely did not accept the order: safe to pass it to another one'''
+    if isinstance(exc, RetryLater) and exc.error is not None:
+        exc = exc.error
+    return isinstance(exc, ProviderError) or classify_error(exc) == RETRYABLE
+
+
+def _submit(dispatcher: OrderDispatcher, submission: _Submission):
+    '''Executed in dispatcher thread. Must not touch the DB session.
+
+    Returns (candidate which accepted the order, provider's order id)
+    '''
+    entry = submission.entry
+    with retry_scope(submission.deadline, submission.defer):
+        if submission.describe:
+            with dispatcher.slot(Providers.dummy), \
+                    stage('notify', submission.trace, entry=entry.entry_id):
+                submission.notifier.describe(entry)
+        # Process if product payed
+        if not entry.is_payed:
+            return None, None
+        candidates = submission.candidates
+        for n, candidate in enumerate(candidates):
+            # Entry is routed to the first candidate already
+            details = entry if n == 0 else _RoutedEntry(entry, candidate)
+            try:
+                with dispatcher.slot(candidate.provider_id), \
+                        stage('submit', submission.trace, entry=entry.entry_id, provider=candidate.provider_id.name):
+                    return candidate, candidate.provider.make_order(details)
+            except Exception as exc:
+                if n == len(candidates) - 1 and submission.defer \
+                        and not isinstance(exc, RetryLater) and getattr(exc, 'retry_after', None) is not None:
+                    # E.g. provider funds are exhausted: try again later
+                    raise RetryLater(exc.retry_after, exc) from exc
+                if n == len(candidates) - 1 or not _is_not_placed(exc):
+                    raise
+                logger.warning('Entry %s: %s failed, trying %s: %s', entry.entry_id,
+                               candidate.provider_id.name, candidates[n + 1].provider_id.name, exc)
+                FAILOVERS.inc(provider=candidate.provider_id.name, alternate=candidates[n + 1].provider_id.name)
+
+
+def _fail(entry: OrderEntry, exc: Exception) -> None:
+    if 'Invalid API key' in str(exc):
+        logger.error('API KEY REQUIRED')
+    else:
+        logger.error('Unable to commit order: %s', exc, exc_info=exc)
+    logger.error('Details: %s', entry)
+    entry.state = OrderEntryState.failed
+    ORDER_ENTRY_TRANSITIONS.inc(source='fulfillment', state=entry.state.name)
+    entry.error_hint = str(exc)
+    entry.provider_order_id = None
+
+
+def abandon_entries(order: Order, config: Config, reason: str, error: str = None,
+                    registry: ProviderRegistry = None) -> list[OrderEntry]:
+    '''Mark payed entries not passed to a provider as failed and report them.
+
+    Used once the order's job ran out of attempts: nothing retries the
+    entries anymore. The hint is `reason` and the last error of the entry
+    (or `error`). Changes are added to the session; caller is responsible
+    for commit.
+    '''
+    entries = pending_entries(order, is_retry=True)
+    if not entries:
+        return entries
+    notifier = (registry or get_registry(config)).get(Providers.dummy)
+    for entry in entries:
+        last_error = entry.error_hint or error
+        entry.state = OrderEntryState.failed
+        ORDER_ENTRY_TRANSITIONS.inc(source='fulfillment', state=entry.state.name)
+        entry.error_hint = f'{reason}: {last_error}' if last_error else reason
+        logger.error('Entry %s abandoned: %s', entry.entry_id, entry.error_hint)
+        entry.state_changed_at = utcnow()
+        db.session.add(entry)
+        try:
+            notifier.report_failure(entry)
+        except Exception as exc:
+            logger.error('Unable to report entry %s failure: %s', entry.entry_id, exc, exc_info=exc)
+    publish(db.session, [order.order_id])
+    return entries
+
+
+@timed('fulfill')
+def fulfill_order(order: Order, config: Config, entries: list[OrderEntry] = None,
+                  dispatcher: OrderDispatcher = None, registry: ProviderRegistry = None,
+                  defer_retries: bool = False, is_retry: bool = False) -> None:
+    '''Invoke service providers for the order entries.
+
+    Providers are resolved here, invoked in parallel by the dispatcher,
+    and results are applied back to the entries in one batch.
+    Changes are added to the session; caller is responsible for commit.
+
+    Services with alternate providers are passed to the next candidate
+    when the provider surely did not accept the order (e.g. the order was
+    refused locally for lack of provider funds).
+
+    Provider calls are retried within `config.retry_budget` seconds.
+    defer_retries: do not wait for retries; entries with retryable errors
+                   are left `created` and `RetryLater` is raised after
+                   results of the other entries are applied
+    is_retry: entries were described to Telegram by the first run
+    '''
+    if entries is None:
+        entries = pending_entries(order)
+    dispatcher = dispatcher or get_dispatcher(config)
+    registry = registry or get_registry(config)
+
+    routing = get_routing_cache(config)
+    trace = current_trace()
+    deadline = time.monotonic() + config.retry_budget
+    submissions = []
+    changed = False
+    _product: OrderEntry
+    with stage('route'):
+        for _product in entries:
+            try:
+                candidates = routing.candidates(str(_product.service_name).lower())
+                if len(candidates) > 1:
+                    # Healthy and fast providers first
+                    candidates = registry.rank(candidates)
+                provider_details = candidates[0]
+                _product.service_id = provider_details.service_id
+                _product.provider_id = provider_details.provider_id
+                logger.info('Order=%s provider=%s', _product.entry_id, provider_details)
+                submissions.append(_Submission(
+                    entry=_product,
+                    candidates=[
+                        _Candidate(candidate.service_id, candidate.provider_id,
+                                   registry.get(candidate.provider_id))
+                        for candidate in candidates
+                    ],
+                    notifier=registry.get(Providers.dummy),
+                    trace=trace,
+                    deadline=deadline,
+                    defer=defer_retries,
+                    describe=not is_retry,
+                ))
+            except Exception as exc:
+                _fail(_product, exc)
+                _product.state_changed_at = utcnow()
+                db.session.add(_product)
+                changed = True
+
+    retry_delays = []
+    for submission, result, error in dispatcher.map(
+            lambda submission: _submit(dispatcher, submission), submissions):
+        _product = submission.entry
+        observed = (_product.state, _product.error_hint)
+        candidate, commited_id = result or (None, None)
+        if candidate is not None:
+            # Accepted by an alternate provider
+            _product.service_id = candidate.service_id
+            _product.provider_id = candidate.provider_id
+        if isinstance(error, RetryLater):
+            retry_delays.append(error.delay)
+            _product.error_hint = str(error)
+        elif error is not None:
+            _fail(_product, error)
+        else:
+            # Mark as fulfiled if payed and executed (commited_id received)
+            if _product.is_payed and commited_id is not None:
+                _product.state = OrderEntryState.fulfilled
+                ORDER_ENTRY_TRANSITIONS.inc(source='fulfillment', state=_product.state.name)
+            _product.provider_order_id = commited_id
+            logger.info('Commited ID: %s', commited_id)
+        if (_product.state, _product.error_hint) != observed:
+            _product.state_changed_at = utcnow()
+            changed = True
+        db.session.add(_product)
+
+    if changed:
+        # Waiting status clients are woken up by the commit
+        publish(db.session, [order.order_id])
+
+    if retry_delays:
+        raise RetryLater(max(retry_delays))
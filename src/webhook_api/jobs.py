@@ -0,0 +1,145 @@
+import datetime
+import os
+import socket
+
+from .ext import db
+from .log import logger
+from .models import FulfillmentJob, FulfillmentJobState, Order
+
+__all__ = (
+    'FulfillmentQueue',
+    'utcnow',
+)
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class FulfillmentQueue:
+    '''DB backed queue of fulfillment jobs.
+
+    Postgres: candidates are locked with `SELECT ... FOR UPDATE SKIP LOCKED`,
+    so concurrent workers never block on (or claim) the same row.
+    Other databases (SQLite): candidates are claimed with conditional
+    `UPDATE ... WHERE state = <observed state>`; only one worker wins the row.
+    '''
+
+    def __init__(self, session=None, worker_id: str = None,
+                 lock_timeout: int = 300, max_attempts: int = 5) -> None:
+        self._session = session
+        self.worker_id = worker_id or default_worker_id()
+        self.lock_timeout = lock_timeout
+        self.max_attempts = max_attempts
+
+    @property
+    def session(self):
+        return self._session or db.session
+
+    @property
+    def is_skip_locked_supported(self) -> bool:
+        return self.session.get_bind().dialect.name == 'postgresql'
+
+    def enqueue(self, order: Order) -> FulfillmentJob:
+        '''Add job to the session. Committed together with the order'''
+        job = FulfillmentJob(order=order, state=FulfillmentJobState.pending,
+                             attempts=0, available_at=utcnow())
+        self.session.add(job)
+        return job
+
+    @staticmethod
+    def job_values() -> dict:
+        '''Column values of a new job; `order_id` is set by the caller'''
+        return {
+            'state': FulfillmentJobState.pending,
+            'attempts': 0,
+            'available_at': utcnow(),
+        }
+
+    def _claimable(self, now: datetime.datetime):
+        stale_before = now - datetime.timedelta(seconds=self.lock_timeout)
+        return db.or_(
+            db.and_(FulfillmentJob.state == FulfillmentJobState.pending,
+                    FulfillmentJob.available_at <= now),
+            # Worker died while processing the job
+            db.and_(FulfillmentJob.state == FulfillmentJobState.running,
+                    FulfillmentJob.locked_at <= stale_before),
+        )
+
+    def claim(self, limit: int = 1) -> list[FulfillmentJob]:
+        '''Claim up to `limit` jobs. Claim is committed before return'''
+        now = utcnow()
+        query = db.select(FulfillmentJob) \
+            .where(self._claimable(now)) \
+            .order_by(FulfillmentJob.available_at, FulfillmentJob.id) \
+            .limit(limit)
+        if self.is_skip_locked_supported:
+            jobs = self._claim_skip_locked(query, now)
+        else:
+            jobs = self._claim_conditional(query, now)
+        self.session.commit()
+        if jobs:
+            logger.info('Worker %s claimed jobs: %s', self.worker_id, [job.id for job in jobs])
+        return jobs
+
+    def _claim_skip_locked(self, query, now) -> list[FulfillmentJob]:
+        jobs = list(self.session.execute(
+            query.with_for_update(skip_locked=True)
+        ).scalars())
+        for job in jobs:
+            job.state = FulfillmentJobState.running
+            job.locked_by = self.worker_id
+            job.locked_at = now
+            job.attempts = (job.attempts or 0) + 1
+        return jobs
+
+    def _claim_conditional(self, query, now) -> list[FulfillmentJob]:
+        candidates = [
+            (job.id, job.state, job.locked_at) for job in self.session.execute(query).scalars()
+        ]
+        claimed_ids = []
+        for job_id, state, locked_at in candidates:
+            result = self.session.execute(
+                db.update(FulfillmentJob)
+                .where(FulfillmentJob.id == job_id,
+                       FulfillmentJob.state == state,
+                       FulfillmentJob.locked_at.is_(None) if locked_at is None
+                       else FulfillmentJob.locked_at == locked_at)
+                .values(state=FulfillmentJobState.running,
+                        locked_by=self.worker_id,
+                        locked_at=now,
+                        attempts=FulfillmentJob.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                claimed_ids.append(job_id)
+        if not claimed_ids:
+            return []
+        return list(self.session.execute(
+            db.select(FulfillmentJob)
+            .where(FulfillmentJob.id.in_(claimed_ids))
+            .order_by(FulfillmentJob.id)
+            .execution_options(populate_existing=True)
+        ).scalars())
+
+    def complete(self, job: FulfillmentJob) -> None:
+        job.state = FulfillmentJobState.done
+        job.locked_by = None
+        job.error_hint = None
+        self.session.add(job)
+
+    def release(self, job: FulfillmentJob, delay: float = 0, error: str = None) -> None:
+        '''Return job to the queue; mark failed if attempts limit exceeded'''
+        job.locked_by = None
+        job.error_hint = error
+        if job.attempts >= self.max_attempts:
+            logger.error('Job %s failed after %s attempts: %s', job.id, job.attempts, error)
+            job.state = FulfillmentJobState.failed
+        else:
+            job.state = FulfillmentJobState.pending
+            job.available_at = utcnow() + datetime.timedelta(seconds=delay)
+        self.session.add(job)
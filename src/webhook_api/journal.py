@@ -0,0 +1,237 @@
+'''Append-only journal of raw webhook requests.
+
+Request handler only appends to an in-memory buffer; a background thread
+writes buffered records to compressed segment files and/or to
+`RequestLogEntry` rows in batches.
+
+Segments: <directory>/requests-<started>-<pid>-<seq>.jsonl.<gz|zst>,
+one JSON record per line; segment being written has `.open` suffix.
+'''
+import collections
+import dataclasses
+import datetime
+import gzip
+import io
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .log import logger
+
+__all__ = (
+    'JournalRecord',
+    'RequestJournal',
+    'database_sink',
+    'iter_journal',
+)
+
+
+@dataclasses.dataclass()
+class JournalRecord:
+    created_at: float  # Unix timestamp
+    content_type: str
+    raw_data: str
+
+    def as_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+class _Segment:
+    def __init__(self, path: pathlib.Path, compression: str) -> None:
+        self.path = path
+        self.opened_at = time.monotonic()
+        self._fp = open(path, 'wb')
+        if compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._fp)
+        else:
+            self._stream = gzip.GzipFile(fileobj=self._fp, mode='wb')
+        self._compression = compression
+
+    @property
+    def size(self) -> int:
+        return self._fp.tell()
+
+    def write(self, lines: list[bytes]) -> None:
+        self._stream.write(b''.join(lines))
+        # Flush compressor: segment is readable up to this point
+        if self._compression == 'zstd':
+            self._stream.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self._stream.flush()
+        self._fp.flush()
+
+    def close(self) -> pathlib.Path:
+        self._stream.close()
+        if not self._fp.closed:
+            self._fp.close()
+        closed_path = self.path.with_suffix('')
+        self.path.rename(closed_path)
+        return closed_path
+
+
+class RequestJournal:
+    '''Buffered request journal. `append` costs a deque append.
+
+    Oldest records are dropped if more than `max_buffer` records wait for flush.
+    '''
+
+    def __init__(self, directory: str = None, sink: Callable[[list[JournalRecord]], None] = None,
+                 compression: str = 'gzip', max_segment_bytes: int = 64 * 2 ** 20,
+                 max_segment_age: float = 3600, flush_interval: float = 1.0,
+                 max_buffer: int = 100_000) -> None:
+        if compression == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed; request journal uses gzip')
+            compression = 'gzip'
+        self._directory = pathlib.Path(directory) if directory else None
+        self._sink = sink
+        self._compression = compression
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segment_age = max_segment_age
+        self._flush_interval = flush_interval
+        self._buffer = collections.deque(maxlen=max_buffer)
+        self._segment: Optional[_Segment] = None
+        self._sequence = 0
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+
+    def append(self, raw_data: str, content_type: str = None) -> None:
+        self._buffer.append(JournalRecord(time.time(), content_type, raw_data))
+        if self._pid != os.getpid():
+            self.start()
+
+    def start(self) -> None:
+        '''Start flush thread in current process (again after fork)'''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._segment = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='request-journal', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        self._close_segment()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error('Unable to flush request journal: %s', exc, exc_info=exc)
+
+    def _drain(self) -> list[JournalRecord]:
+        records = []
+        while True:
+            try:
+                records.append(self._buffer.popleft())
+            except IndexError:
+                return records
+
+    def flush(self) -> int:
+        '''Write buffered records. Returns amount of written records'''
+        with self._flush_lock:
+            records = self._drain()
+            if self._segment is not None and self._is_expired(self._segment):
+                self._close_segment()
+            if not records:
+                return 0
+            if self._directory is not None:
+                self._write(records)
+            if self._sink is not None:
+                try:
+                    self._sink(records)
+                except Exception as exc:
+                    logger.error('Request journal sink failed: %s', exc, exc_info=exc)
+            return len(records)
+
+    def _is_expired(self, segment: _Segment) -> bool:
+        return segment.size >= self._max_segment_bytes \
+            or time.monotonic() - segment.opened_at >= self._max_segment_age
+
+    def _write(self, records: list[JournalRecord]) -> None:
+        if self._segment is None:
+            self._segment = self._open_segment()
+        self._segment.write([
+            json.dumps(record.as_dict(), ensure_ascii=False).encode() + b'\n'
+            for record in records
+        ])
+        if self._is_expired(self._segment):
+            self._close_segment()
+
+    def _open_segment(self) -> _Segment:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._sequence += 1
+        started = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S')
+        extension = 'zst' if self._compression == 'zstd' else 'gz'
+        name = f'requests-{started}-{os.getpid()}-{self._sequence:04d}.jsonl.{extension}.open'
+        return _Segment(self._directory / name, self._compression)
+
+    def _close_segment(self) -> None:
+        if self._segment is not None:
+            path = self._segment.close()
+            logger.info('Request journal segment closed: %s', path)
+            self._segment = None
+
+
+def _read_segment(path: pathlib.Path) -> Iterator[bytes]:
+    with open(path, 'rb') as fp:
+        if '.zst' in path.suffixes:
+            if zstandard is None:
+                raise RuntimeError(f'zstandard is required to read {path}')
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp))
+        else:
+            stream = gzip.GzipFile(fileobj=fp, mode='rb')
+        try:
+            yield from stream
+        except EOFError:
+            # Segment is still being written
+            pass
+
+
+def iter_journal(directory: str, include_open: bool = False) -> Iterator[JournalRecord]:
+    '''Iterate journal records in segments order (for replay)'''
+    paths = sorted(pathlib.Path(directory).glob('requests-*.jsonl.*'))
+    for path in paths:
+        if path.suffix == '.open' and not include_open:
+            continue
+        for line in _read_segment(path):
+            if line.strip():
+                yield JournalRecord(**json.loads(line))
+
+
+def database_sink(app) -> Callable[[list[JournalRecord]], None]:
+    '''Store records as `RequestLogEntry` rows; one INSERT per flush'''
+    from .ext import db
+    from .models import RequestLogEntry
+
+    def _sink(records: list[JournalRecord]) -> None:
+        with app.app_context():
+            db.session.execute(db.insert(RequestLogEntry), [
+                {
+                    'raw_data': record.raw_data,
+                    'content_type': record.content_type,
+                    'created_at': datetime.datetime.fromtimestamp(record.created_at, datetime.timezone.utc),
+                }
+                for record in records
+            ])
+            db.session.commit()
+            db.session.remove()
+    return _sink
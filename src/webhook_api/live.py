@@ -0,0 +1,189 @@
+'''Live provider statuses of order entries for `/api/v1/status?live=1`.
+
+Lookups of entries on the same provider are coalesced: the first one
+opens a batch, waits `LIVE_STATUS_WINDOW` seconds for concurrent lookups
+to join it and makes a single `multi_status` call for all of them; an
+order id already being fetched is never requested twice. Results are
+cached for `LIVE_STATUS_TTL` seconds, so refresh bursts are answered from
+memory.
+'''
+import threading
+import time
+from typing import Iterable, NamedTuple, Optional
+
+from .config import Config
+from .dispatcher import OrderDispatcher, get_dispatcher
+from .log import logger
+from .metrics import REGISTRY
+from .models import Providers
+from .panels import PANELS
+from .providers.registry import ProviderRegistry, get_registry
+
+__all__ = (
+    'LiveStatus',
+    'get_live_status',
+)
+
+LIVE_LOOKUPS = REGISTRY.counter(
+    'live_status_lookups_total', 'Live provider status lookups of order entries', ('outcome',))
+LIVE_CALLS = REGISTRY.counter(
+    'live_status_calls_total', 'multi_status calls made for live lookups', ('provider',))
+
+# Panel status fields exposed by `/api/v1/status`; charge, currency etc. are not
+LIVE_FIELDS = ('status', 'remains', 'start_count')
+
+
+class _Key(NamedTuple):
+    provider_id: Providers
+    provider_order_id: str
+
+
+def _public(details) -> dict:
+    '''Panel status of an order reduced to `LIVE_FIELDS`'''
+    if not isinstance(details, dict) or 'status' not in details:
+        # E.g. {"error": "Incorrect order ID"}
+        return {'error': 'Not found'}
+    return {field: details[field] for field in LIVE_FIELDS if field in details}
+
+
+class _Batch:
+    '''Order ids of a provider fetched with one `multi_status` call'''
+
+    def __init__(self, provider_id: Providers, client) -> None:
+        self.provider_id = provider_id
+        self.client = client
+        self.order_ids: list[str] = []
+        self.results: dict[str, dict] = {}
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class LiveStatus:
+    '''Coalescing, caching `multi_status` lookups of this process
+
+    window: seconds a batch waits for other lookups
+    ttl: seconds results are cached
+    timeout: seconds a lookup waits for its batches
+    '''
+
+    def __init__(self, config: Config, registry: ProviderRegistry = None, dispatcher: OrderDispatcher = None,
+                 window: float = 0.05, ttl: float = 10.0, timeout: float = 10.0) -> None:
+        self._config = config
+        self._registry = registry
+        self._dispatcher = dispatcher
+        self._window = window
+        self._ttl = ttl
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._cache: dict[_Key, tuple[float, dict]] = {}
+        self._open: dict[Providers, _Batch] = {}
+        self._in_flight: dict[_Key, _Batch] = {}
+        self.calls = 0
+
+    @property
+    def registry(self) -> ProviderRegistry:
+        return self._registry or get_registry(self._config)
+
+    @property
+    def dispatcher(self) -> OrderDispatcher:
+        return self._dispatcher or get_dispatcher(self._config)
+
+    @staticmethod
+    def is_supported(provider_id: Optional[Providers], provider_order_id) -> bool:
+        '''Accepted by an SMM panel'''
+        return provider_id is not None and provider_id.name in PANELS and provider_order_id is not None
+
+    def _fetch(self, batch: _Batch) -> None:
+        '''Executed in dispatcher thread by the lookup which opened the batch'''
+        try:
+            with self._lock:
+                # Nothing joins the batch from now on
+                if self._open.get(batch.provider_id) is batch:
+                    del self._open[batch.provider_id]
+            with self.dispatcher.slot(batch.provider_id):
+                batch.results = batch.client.multi_status(batch.order_ids) or {}
+            LIVE_CALLS.inc(provider=batch.provider_id.name)
+        except Exception as exc:
+            logger.warning('Live %s status of %s orders failed: %s',
+                           batch.provider_id.name, len(batch.order_ids), exc)
+            batch.error = exc
+        finally:
+            expires_at = time.monotonic() + self._ttl
+            with self._lock:
+                self.calls += 1
+                for order_id in batch.order_ids:
+                    key = _Key(batch.provider_id, order_id)
+                    self._in_flight.pop(key, None)
+                    if batch.error is None:
+                        self._cache[key] = (expires_at, _public(batch.results.get(order_id)))
+            batch.done.set()
+
+    def _purge(self, now: float) -> None:
+        for key in [key for key, (expires_at, _) in self._cache.items() if expires_at <= now]:
+            del self._cache[key]
+
+    def lookup(self, entries: Iterable[tuple[Providers, str]]) -> dict[tuple[Providers, str], dict]:
+        '''Panel status (`LIVE_FIELDS` or {"error": ...}) by (provider id, provider order id)'''
+        keys = {_Key(provider_id, str(order_id)) for provider_id, order_id in entries
+                if self.is_supported(provider_id, order_id)}
+        results, waiting, opened = {}, {}, []
+        now = time.monotonic()
+        clients = {provider_id: self.registry.get(provider_id).client
+                   for provider_id in {key.provider_id for key in keys}}
+        with self._lock:
+            if len(self._cache) > 10000:
+                self._purge(now)
+            for key in keys:
+                cached = self._cache.get(key)
+                if cached is not None and cached[0] > now:
+                    results[key] = cached[1]
+                    LIVE_LOOKUPS.inc(outcome='hit')
+                    continue
+                batch = self._in_flight.get(key)
+                if batch is not None:
+                    LIVE_LOOKUPS.inc(outcome='coalesced')
+                else:
+                    batch = self._open.get(key.provider_id)
+                    if batch is None or len(batch.order_ids) >= PANELS[key.provider_id.name].max_status_batch:
+                        batch = self._open[key.provider_id] = _Batch(key.provider_id, clients[key.provider_id])
+                        opened.append(batch)
+                    batch.order_ids.append(key.provider_order_id)
+                    self._in_flight[key] = batch
+                    LIVE_LOOKUPS.inc(outcome='fetched')
+                waiting[key] = batch
+        if opened:
+            # Concurrent lookups join the opened batches meanwhile
+            time.sleep(self._window)
+            self.dispatcher.map(self._fetch, opened)
+        deadline = time.monotonic() + self._timeout
+        for key, batch in waiting.items():
+            if not batch.done.wait(max(deadline - time.monotonic(), 0)):
+                results[key] = {'error': 'Timed out'}
+            elif batch.error is not None:
+                # Details are logged by `_fetch`
+                results[key] = {'error': 'Unavailable'}
+            else:
+                results[key] = _public(batch.results.get(key.provider_order_id))
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'cached': len(self._cache),
+                'in_flight': len(self._in_flight),
+                'calls': self.calls,
+            }
+
+
+_live_status: Optional[LiveStatus] = None
+_live_status_lock = threading.Lock()
+
+
+def get_live_status(config: Config = None) -> LiveStatus:
+    global _live_status
+    with _live_status_lock:
+        if _live_status is None:
+            config = config or Config()
+            _live_status = LiveStatus(config, window=config.live_status_window,
+                                      ttl=config.live_status_ttl, timeout=config.live_status_timeout)
+        return _live_status
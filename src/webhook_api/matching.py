@@ -0,0 +1,107 @@
+'''Service name matching.
+
+Tilda product names and the services sheet differ in details: case,
+extra or non-breaking spaces, Latin letters typed instead of Cyrillic
+look-alikes, separators, dash and quote variants. `normalize_service_name`
+folds them into the key stored as `ServiceDescription.service_key`. Names
+whose key is still unknown are matched by `TrigramIndex` to the closest
+configured service.
+'''
+import math
+import re
+import unicodedata
+from typing import Iterable, NamedTuple, Optional
+
+__all__ = (
+    'FuzzyMatch',
+    'TrigramIndex',
+    'normalize_service_name',
+)
+
+# Latin look-alikes of Cyrillic letters (after casefolding)
+_HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м',
+    'o': 'о', 'p': 'р', 't': 'т', 'x': 'х', 'y': 'у', 'ё': 'е',
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '−': '-',
+    '«': '"', '»': '"', '“': '"', '”': '"', '„': '"', "'": '"', '’': '"', '`': '"',
+})
+_SPACE_RE = re.compile(r'\s+')
+# Separators Tilda names and the sheet disagree on
+_PUNCTUATION_RE = re.compile(r'[:;,!?]')
+
+
+def normalize_service_name(service_name) -> str:
+    '''Matching key: casefolded, look-alikes folded to Cyrillic, separators dropped, spaces collapsed
+
+    "ВК :  Лaйки\xa0Эконом " (Latin "a") -> "вк лайки эконом"
+    '''
+    key = unicodedata.normalize('NFKC', str(service_name or '')).casefold().translate(_HOMOGLYPHS)
+    key = _PUNCTUATION_RE.sub(' ', key)
+    return _SPACE_RE.sub(' ', key).strip()
+
+
+def _trigrams(key: str) -> set[str]:
+    padded = f'  {key} '
+    return {padded[n:n + 3] for n in range(len(padded) - 2)}
+
+
+class FuzzyMatch(NamedTuple):
+    key: str
+    score: float  # Dice coefficient of trigrams; 1.0 - same trigrams
+
+
+class TrigramIndex:
+    '''Closest key by trigram similarity. Read-only once built
+
+    Trigram sets are kept as bit masks: the overlap of two keys is a
+    single `&` and `bit_count()`.
+    '''
+
+    def __init__(self, keys: Iterable[str]) -> None:
+        self._ids: dict[str, int] = {}
+        self._masks: dict[str, int] = {}
+        self._postings: dict[str, list[str]] = {}
+        for key in keys:
+            if key in self._masks:
+                continue
+            trigrams = _trigrams(key)
+            self._masks[key] = self._mask(trigrams, grow=True)
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, []).append(key)
+
+    def _mask(self, trigrams: set[str], grow: bool = False) -> int:
+        mask = 0
+        for trigram in trigrams:
+            bit = self._ids.get(trigram)
+            if bit is None:
+                if not grow:
+                    continue
+                bit = self._ids[trigram] = len(self._ids)
+            mask |= 1 << bit
+        return mask
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+    def match(self, key: str, min_score: float = 0.5) -> Optional[FuzzyMatch]:
+        '''The most similar key scoring at least `min_score`; ties go to the shorter (then lesser) key
+
+        Only postings of the rarest trigrams are scanned: a key sharing
+        none of them cannot reach `min_score`.
+        '''
+        trigrams = _trigrams(key)
+        size = len(trigrams)
+        shared_min = math.ceil(min_score * size / (2 - min_score))
+        rarest = sorted(trigrams, key=lambda trigram: len(self._postings.get(trigram, ())))
+        candidates = set()
+        for trigram in rarest[:size - shared_min + 1]:
+            candidates.update(self._postings.get(trigram, ()))
+        mask = self._mask(trigrams)
+        best, best_score = None, min_score
+        for candidate in candidates:
+            candidate_mask = self._masks[candidate]
+            score = 2 * (mask & candidate_mask).bit_count() / (size + candidate_mask.bit_count())
+            if score > best_score or (score == best_score and (best is None
+                                                               or (len(candidate), candidate) < (len(best), best))):
+                best, best_score = candidate, score
+        return FuzzyMatch(best, best_score) if best is not None else None
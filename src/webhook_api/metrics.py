@@ -0,0 +1,354 @@
+'''Prometheus-style metrics.
+
+Counters, gauges and histograms are kept in process memory. With
+`METRICS_DIR` set every process (gunicorn workers, webhook-worker) dumps
+its values to `<METRICS_DIR>/metrics-<pid>.json` in background, and
+`/metrics` merges all dumps: counters and histograms are summed, gauges
+are taken from the most recent dump. Dumps of exited processes (gunicorn
+recycles workers) are folded into `<METRICS_DIR>/archive.json`, so
+counters never go back; their gauges are dropped.
+'''
+import atexit
+import bisect
+import fcntl
+import functools
+import json
+import math
+import os
+import pathlib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from .log import logger
+from .tracing import Trace, span
+
+__all__ = (
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'REGISTRY',
+    'MetricsRegistry',
+    'stage',
+    'timed',
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Gauges of dumps not refreshed for that many flush intervals are ignored
+STALE_FLUSHES = 3
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._values.items()}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def merge(dumps: list) -> dict:
+        merged = {}
+        for _, values in dumps:
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, values: dict) -> list[str]:
+        return [
+            f'{self.name}{_format_labels(self.labelnames, tuple(json.loads(key)))} {_format_value(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @staticmethod
+    def merge(dumps: list) -> dict:
+        merged = {}
+        # Oldest first: the most recent dump wins
+        for _, values in sorted(dumps, key=lambda dump: dump[0]):
+            merged.update(values)
+        return merged
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per bucket counts..., +Inf count, sum]
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def merge(dumps: list) -> dict:
+        merged = {}
+        for _, values in dumps:
+            for key, state in values.items():
+                current = merged.get(key)
+                merged[key] = list(state) if current is None else [a + b for a, b in zip(current, state)]
+        return merged
+
+    def render(self, values: dict) -> list[str]:
+        lines = []
+        for key, state in sorted(values.items()):
+            labels = tuple(json.loads(key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{_format_labels(self.labelnames, labels, {"le": _format_value(bound)})} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(state[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+        self._directory: Optional[pathlib.Path] = None
+        self._flush_interval = 5.0
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric already registered: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def configure(self, directory: str = None, flush_interval: float = 5.0) -> None:
+        '''Enable multiprocess mode'''
+        self._directory = pathlib.Path(directory) if directory else None
+        self._flush_interval = flush_interval
+        if self._directory is not None:
+            self._directory.mkdir(parents=True, exist_ok=True)
+
+    def _ensure_flusher(self) -> None:
+        if self._directory is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+            atexit.register(self._exit)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.warning('Unable to dump metrics: %s', exc)
+
+    def dump(self) -> dict:
+        return {name: metric.dump() for name, metric in self._metrics.items()}
+
+    def flush(self) -> None:
+        '''Dump this process values for other processes'''
+        if self._directory is None:
+            return
+        path = self._directory / f'metrics-{os.getpid()}.json'
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.dump()))
+        tmp_path.replace(path)
+
+    def _exit(self) -> None:
+        '''Fold the final values of this process into the archive'''
+        if self._directory is None or self._pid != os.getpid():
+            return
+        try:
+            self.flush()
+            self._archive(self._directory / f'metrics-{os.getpid()}.json')
+        except Exception as exc:
+            logger.warning('Unable to archive metrics: %s', exc)
+
+    def _archive(self, path: pathlib.Path) -> None:
+        '''Add counters and histograms of an exited process dump to the archive and remove the dump'''
+        claimed = path.with_name(f'{path.name}.{os.getpid()}.dead')
+        try:
+            path.rename(claimed)
+        except FileNotFoundError:
+            # Archived by another process
+            return
+        archive_path = self._directory / 'archive.json'
+        with open(self._directory / 'archive.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = json.loads(archive_path.read_text()) if archive_path.exists() else {}
+            dump = json.loads(claimed.read_text())
+            for name, metric in self._metrics.items():
+                if name in dump and not isinstance(metric, Gauge):
+                    archive[name] = metric.merge([(0, archive.get(name, {})), (0, dump[name])])
+            tmp_path = archive_path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(archive))
+            tmp_path.replace(archive_path)
+        claimed.unlink()
+
+    def _collect(self) -> list:
+        '''[(modified at, {metric: values})] of all processes'''
+        if self._directory is None:
+            return [(time.time(), self.dump())]
+        self.flush()
+        for path in self._directory.glob('metrics-*.json'):
+            try:
+                pid = int(path.stem.split('-', 1)[1])
+            except ValueError:
+                continue
+            if not _is_alive(pid):
+                try:
+                    self._archive(path)
+                except (OSError, ValueError) as exc:
+                    logger.warning('Unable to archive metrics dump %s: %s', path, exc)
+        dumps = []
+        for path in [*self._directory.glob('metrics-*.json'), self._directory / 'archive.json']:
+            try:
+                dumps.append((path.stat().st_mtime, json.loads(path.read_text())))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as exc:
+                logger.warning('Unable to read metrics dump %s: %s', path, exc)
+        return dumps
+
+    def render(self) -> str:
+        dumps = self._collect()
+        stale_before = time.time() - STALE_FLUSHES * self._flush_interval
+        lines = []
+        for name, metric in self._metrics.items():
+            metric_dumps = dumps
+            if isinstance(metric, Gauge) and self._directory is not None:
+                # Process hung or exited without being noticed yet
+                metric_dumps = [dump for dump in dumps if dump[0] >= stale_before]
+            values = metric.merge([(mtime, dump.get(name, {})) for mtime, dump in metric_dumps])
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+    def touch(self) -> None:
+        '''Called on hot paths: start dump thread after fork'''
+        if self._pid != os.getpid() and self._directory is not None:
+            self._ensure_flusher()
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'webhook_stage_seconds', 'Order processing stage latency', ('stage',))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'API request latency', ('endpoint', 'status'))
+PROVIDER_REQUEST_SECONDS = REGISTRY.histogram(
+    'provider_request_seconds', 'Provider API call latency', ('provider', 'action'))
+PROVIDER_ERRORS = REGISTRY.counter(
+    'provider_errors_total', 'Failed provider API calls', ('provider', 'action', 'error'))
+PROVIDER_RETRIES = REGISTRY.counter(
+    'provider_retries_total', 'Retried provider operations', ('operation',))
+PROVIDER_ATTEMPTS = REGISTRY.counter(
+    'provider_attempts_total', 'Provider operation attempts by outcome', ('operation', 'outcome'))
+ORDER_ENTRY_TRANSITIONS = REGISTRY.counter(
+    'order_entry_transitions_total', 'Order entry state changes', ('source', 'state'))
+
+
+@contextmanager
+def stage(name: str, trace: Trace = None, **attrs):
+    '''Observe stage latency and add it to the request trace'''
+    REGISTRY.touch()
+    with STAGE_SECONDS.time(stage=name), span(name, trace, **attrs):
+        yield
+
+
+def timed(name: str) -> Callable:
+    '''Observe function latency as `webhook_stage_seconds{stage=...}`'''
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return wrapper
@@ -1,11 +1,23 @@
 import sqlalchemy as sa
 
 from .ext import db
+from .matching import normalize_service_name
+from .panels import PANELS
 
 __all__ = (
     'OrderEntryState',
     'Order',
     'OrderEntry',
+    'FulfillmentJobState',
+    'FulfillmentJob',
+    'Revision',
+    'RequestTrace',
+    'BreakerState',
+    'ProviderBreaker',
+    'RateLimitBucket',
+    'ProviderBalance',
+    'NotificationState',
+    'Notification',
 )
 import dataclasses
 import enum
@@ -26,14 +38,36 @@ class OrderEntryState(enum.Enum):
     not_payed = 4  # total price < calculated price
     failed = 5
     dummy = 6
+    in_progress = 7  # Accepted by provider; pending / processing
+    partial = 8  # Completed by provider partially
+    canceled = 9  # Canceled by provider
+    completed = 10  # Completed by provider
 
 
-class Providers(enum.Enum):
-    dummy = 0
-    socproof = 1
-    justanotherpanel = 2
-    prosmmstore = 3
-    fxsmmsoc = 4
+class FulfillmentJobState(enum.Enum):
+    pending = 1  # Waiting for a worker
+    running = 2  # Claimed by a worker
+    done = 3
+    failed = 4  # Attempts limit exceeded
+
+
+class NotificationState(enum.Enum):
+    pending = 1  # Waiting for delivery
+    sending = 2  # Claimed by the outbox dispatcher
+    sent = 3
+    failed = 4  # Rejected by Telegram or attempts limit exceeded
+
+
+class BreakerState(enum.Enum):
+    closed = 1  # Calls pass
+    open = 2  # Calls fail fast until `opened_until`
+    half_open = 3  # Probe calls decide
+
+
+# dummy (Telegram) + registered SMM panels
+Providers = enum.Enum('Providers', [('dummy', 0)] + [
+    (panel.name, panel.provider_id) for panel in PANELS.values()
+])
 
 
 @dataclasses.dataclass()
@@ -51,25 +85,58 @@ class RequestLogEntry(db.Model):
 
 
 class ServiceDescription(db.Model):
+    '''Provider candidate of a service; lower priority is preferred'''
+    __table_args__ = (
+        db.UniqueConstraint('service_name', 'priority'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    service_name = db.Column(db.String, unique=True, comment='Service name')
+    service_name = db.Column(db.String, index=True, comment='Service name')
+    service_key = db.Column(db.String, index=True, comment='Normalized service name; see normalize_service_name')
     service_id = db.Column(db.String, comment='Provider sevice ID')
     provider_id = db.Column(db.Enum(Providers), comment='Provider entry')
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default='0',
+                         comment='Candidate order; 0 - primary provider')
 
     def __repr__(self) -> str:
-        return f'<Service name={self.service_name} id={self.provider_id.name}:{self.service_id}>'
+        return f'<Service name={self.service_name} id={self.provider_id.name}:{self.service_id} priority={self.priority}>'
 
     @classmethod
     def get_index(cls):
+        '''Primary provider of each service'''
         _index = {}
         results = db.session.execute(
-            db.select(cls)
+            db.select(cls).order_by(cls.priority)
         ).all()
         for [entry] in results:
-            _index[str(entry.service_name).lower()] = entry
+            _index.setdefault(entry.service_key or normalize_service_name(entry.service_name), entry)
         return _index
 
 
+class Revision(db.Model):
+    '''Change counter of a shared data set (e.g. services routing table)'''
+    __tablename__ = 'revisions'
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    checksum = db.Column(db.String, comment='Content hash of the last applied data set')
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now(),
+                           onupdate=sa.func.now())
+
+    @classmethod
+    def get_value(cls, name: str) -> int:
+        return db.session.execute(
+            db.select(cls.value).filter_by(name=name)
+        ).scalar() or 0
+
+    @classmethod
+    def bump(cls, name: str, checksum: str = None) -> None:
+        '''Increment counter within current transaction'''
+        result = db.session.execute(
+            db.update(cls).filter_by(name=name).values(value=cls.value + 1, checksum=checksum)
+        )
+        if result.rowcount == 0:
+            db.session.add(cls(name=name, value=1, checksum=checksum))
+
+
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
@@ -112,7 +179,105 @@ class OrderEntry(db.Model):
     service_id = db.Column(db.String, comment='Resolved service id')
     provider_order_id = db.Column(db.String, comment='OrderID from service provider')
     error_hint = db.Column(db.String, comment='Error message from provider')
+    state_changed_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now(),
+                                 comment='Last change of state or error hint; status ETag')
     # service related
 
     def __repr__(self) -> str:
         return f'<OrderEntry state={self.state} id={self.entry_id} name={self.service_name}>'
+
+
+class FulfillmentJob(db.Model):
+    '''Queued provider invocation for the order entries'''
+    __tablename__ = 'fulfillment_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False,
+                         comment='Order to fulfill')
+    state = db.Column(db.Enum(FulfillmentJobState), nullable=False, index=True,
+                      default=FulfillmentJobState.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    locked_by = db.Column(db.String, comment='Worker which claimed the job')
+    locked_at = db.Column(db.DateTime(timezone=True))
+    available_at = db.Column(db.DateTime(timezone=True), comment='Not claimed before this moment')
+    error_hint = db.Column(db.String, comment='Last processing error')
+    order = db.relationship('Order')
+    created_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now())
+
+    def __repr__(self) -> str:
+        return f'<FulfillmentJob id={self.id} order={self.order_id} state={self.state}>'
+
+
+class RequestTrace(db.Model):
+    '''Stage timings of a webhook request or a worker run for the order'''
+    __tablename__ = 'request_traces'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    source = db.Column(db.String, comment='webhook | worker')
+    total_ms = db.Column(db.Float)
+    spans = db.Column(db.JSON, comment='[{name, start_ms, duration_ms, ...}]')
+    created_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now())
+
+    def as_dict(self) -> dict:
+        return {
+            'source': self.source,
+            'totalMs': self.total_ms,
+            'spans': self.spans,
+            'createdAt': self.created_at.strftime('%Y-%m-%dT%H:%M:%SZ') if self.created_at else None,
+        }
+
+
+class ProviderBreaker(db.Model):
+    '''Circuit breaker state of a provider shared by all processes'''
+    __tablename__ = 'provider_breakers'
+    provider = db.Column(db.String, primary_key=True)
+    state = db.Column(db.Enum(BreakerState), nullable=False, default=BreakerState.closed)
+    opened_until = db.Column(db.DateTime(timezone=True), comment='Calls fail fast before this moment')
+    probe_until = db.Column(db.DateTime(timezone=True), comment='Half-open probe claimed till')
+    trips = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now(),
+                           onupdate=sa.func.now())
+
+
+class RateLimitBucket(db.Model):
+    '''Token bucket of a provider API key shared by all processes'''
+    __tablename__ = 'rate_limit_buckets'
+    key = db.Column(db.String, primary_key=True, comment='Provider name and API key hash')
+    tokens = db.Column(db.Float, nullable=False, comment='Negative - calls are queued')
+    refilled_at = db.Column(db.Float, nullable=False, comment='Unix timestamp of `tokens` value')
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ProviderBalance(db.Model):
+    '''Provider account balance polled by the worker and debited by submitted orders'''
+    __tablename__ = 'provider_balances'
+    provider = db.Column(db.String, primary_key=True)
+    balance = db.Column(db.Float, nullable=False, comment='Reported by the provider')
+    currency = db.Column(db.String)
+    spent = db.Column(db.Float, nullable=False, default=0, comment='Cost of orders submitted since the poll')
+    burn_rate = db.Column(db.Float, comment='Spent per hour between the last polls')
+    polled_at = db.Column(db.Float, nullable=False, comment='Unix timestamp')
+
+    @property
+    def available(self) -> float:
+        return self.balance - self.spent
+
+
+class Notification(db.Model):
+    '''Telegram message waiting in the outbox'''
+    __tablename__ = 'notifications'
+    id = db.Column(db.Integer, primary_key=True)
+    chat_id = db.Column(db.String)
+    text = db.Column(db.Text, nullable=False)
+    digest_key = db.Column(db.String, comment='Sent within a digest, grouped by the key (order id)')
+    state = db.Column(db.Enum(NotificationState), nullable=False, index=True,
+                      default=NotificationState.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime(timezone=True), comment='Not sent before this moment')
+    locked_at = db.Column(db.DateTime(timezone=True))
+    message_id = db.Column(db.String, comment='Telegram message id')
+    error_hint = db.Column(db.String, comment='Last delivery error')
+    created_at = db.Column(db.DateTime(timezone=True), server_default=sa.func.now())
+    sent_at = db.Column(db.DateTime(timezone=True))
+
+    def __repr__(self) -> str:
+        return f'<Notification id={self.id} state={self.state}>'
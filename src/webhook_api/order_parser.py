@@ -1,10 +1,13 @@
 import dataclasses
 import re
+from typing import Iterator
 
 from .log import logger
 
 __all__ = (
     'unescape_url',
+    'iter_raw_orders',
+    'parse_raw_orders',
 )
 
 
@@ -81,7 +84,6 @@ def parse_order(order_raw: str) -> OrderDetails:
     # Услуга: ВК: Подписчики Премиум: 1.68 руб. / 1 шт   Ссылка: https://vk.com/public217057222  Количество: 575 - 1x966 = 966;
     # data = re.search(r'^Услуга: (?P<service_name>.+?) (?P<price_per_unit>[\d.]+) руб\. / (?P<per_unit>[\d.]+) шт[ ]*Ссылка: (?P<url>.+?)[ ]*Количество: (?P<amount>[\d.]+) - (?P<order_amount>\d+)x(?P<order_price>[\d.]+) = (?P<price_total>[\d.]+)$', order_raw)
     m = ORDER_RE.search(order_raw)
-    print(m)
     if m is None:
         return None
     # print(order_raw)
@@ -95,7 +97,6 @@ def parse_order(order_raw: str) -> OrderDetails:
     })
     del data['price_per_unit1']
     del data['per_unit1']
-    print(data)
     try:
         for prop, value in data.items():
             data[prop] = ORDER_TYPES.get(prop, str)(value)
@@ -106,17 +107,27 @@ def parse_order(order_raw: str) -> OrderDetails:
     return order
 
 
-def parse_raw_orders(orders_raw: str) -> list[OrderDetails]:
-    orders = []
-    raw_orders = [f'Услуга:{line}'.strip() for line in re.split(r'(?:^Услуга|; Услуга)', orders_raw) if len(line)]
+# Start of every order entry in concatenated string
+ORDER_SEPARATOR_RE = re.compile(r'(?:^Услуга|; Услуга)')
+
 
-    for p in raw_orders:
-        _order = parse_order(p)
+def iter_raw_orders(orders_raw: str) -> Iterator[OrderDetails]:
+    '''Parse concatenated order entries one by one; unparsed entries are skipped'''
+    start = 0
+    for m in ORDER_SEPARATOR_RE.finditer(orders_raw):
+        if m.start() > start:
+            _order = parse_order(f'Услуга:{orders_raw[start:m.start()]}'.strip())
+            if _order is not None:
+                yield _order
+        start = m.end()
+    if start < len(orders_raw):
+        _order = parse_order(f'Услуга:{orders_raw[start:]}'.strip())
         if _order is not None:
-            orders.append(_order)
-    # print(len(raw_orders))
-    # assert len(raw_orders) == 33
-    return orders
+            yield _order
+
+
+def parse_raw_orders(orders_raw: str) -> list[OrderDetails]:
+    return list(iter_raw_orders(orders_raw))
 
 
 def main():
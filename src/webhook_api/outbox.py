@@ -0,0 +1,290 @@
+'''Delivery of the Telegram notifications outbox.
+
+Notifications are written by the fulfillment (`DummyProvider`) and sent
+by `OutboxDispatcher` in a background thread of `webhook-worker`, so
+order handling never waits for Telegram. Calls go through the pooled,
+rate limited `dummy` transport; failed deliveries are retried with
+backoff. Digest lines (`digest_key` set) wait `NOTIFY_DIGEST_WINDOW`
+seconds and are sent together, grouped by order, in as few messages as
+Telegram's message size allows. Any number of workers may run: notifications are claimed like
+fulfillment jobs.
+'''
+import datetime
+import html
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from flask import Flask
+
+from .config import Config
+from .ext import db
+from .jobs import utcnow
+from .log import logger
+from .metrics import REGISTRY
+from .models import Notification, NotificationState, Providers
+from .providers.dummy import MESSAGE_LIMIT, TelegramClient, TelegramError
+from .providers.registry import get_registry
+from .providers.utils import FATAL, backoff_delay, classify_error
+
+__all__ = (
+    'OutboxDispatcher',
+    'pack_digest',
+    'truncate_html',
+)
+
+OUTBOX_DEPTH = REGISTRY.gauge(
+    'notification_outbox_depth', 'Notifications waiting for delivery')
+NOTIFICATIONS = REGISTRY.counter(
+    'notifications_total', 'Notification delivery attempts', ('outcome',))
+
+
+_TAG_RE = re.compile(r'<(/?)([a-z-]+)[^>]*>', re.IGNORECASE)
+
+
+def _is_balanced(text: str) -> bool:
+    stack = []
+    for match in _TAG_RE.finditer(text):
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def truncate_html(text: str, limit: int) -> str:
+    '''Cut Telegram HTML text to `limit` characters without breaking tags or entities.
+
+    Whole lines are kept while they fit; a first line too long on its own
+    is cut as plain text (markup dropped).
+    '''
+    if len(text) <= limit:
+        return text
+    lines = text.split('\n')
+    for end in range(len(lines) - 1, 0, -1):
+        head = '\n'.join(lines[:end])
+        if len(head) <= limit and _is_balanced(head):
+            return head
+    plain = html.unescape(_TAG_RE.sub('', text))
+    escaped, size = [], 0
+    for char in plain:
+        part = html.escape(char, quote=False)
+        if size + len(part) > limit:
+            break
+        escaped.append(part)
+        size += len(part)
+    return ''.join(escaped)
+
+
+def pack_digest(groups: dict[str, list[Notification]], limit: int = MESSAGE_LIMIT) -> list[tuple[str, list]]:
+    '''Digest lines grouped by key (order) under headers, split into messages within the limit.
+
+    Returns [(text, notifications of the message)]
+    '''
+    messages = []
+    text, included, current_key = '', [], None
+    for key, notifications in groups.items():
+        header = f'<b>Order {html.escape(key)}</b>'
+        for notification in notifications:
+            # Single line never exceeds a message
+            line = truncate_html(notification.text, limit - len(header) - 1)
+            block = line if key == current_key else f'{header}\n{line}'
+            candidate = f'{text}\n\n{block}' if text else block
+            if len(candidate) > limit:
+                messages.append((text, included))
+                candidate, included = f'{header}\n{line}', []
+            text = candidate
+            included.append(notification)
+            current_key = key
+    if included:
+        messages.append((text, included))
+    return messages
+
+
+def _is_retryable(exc: Exception) -> bool:
+    '''Duplicate message is better than a lost one: ambiguous errors are retried too'''
+    if isinstance(exc, TelegramError):
+        return exc.retry_after is not None or (exc.error_code or 0) >= 500
+    return classify_error(exc) != FATAL
+
+
+class OutboxDispatcher:
+    '''Sends pending notifications.
+
+    lock_timeout: seconds before a claimed notification is considered abandoned
+    '''
+
+    def __init__(self, app: Flask, config: Config = None, client: TelegramClient = None,
+                 lock_timeout: int = 60, poll_interval: float = 1.0) -> None:
+        self._app = app
+        self._config = config or Config()
+        self._client = client
+        self._lock_timeout = lock_timeout
+        self._poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._config.notify_concurrency,
+            thread_name_prefix='outbox',
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def client(self) -> TelegramClient:
+        '''Shares the pooled and rate limited `dummy` transport. Created within app context'''
+        if self._client is None:
+            config = self._config.get_provider_config(Providers.dummy)
+            self._client = TelegramClient(config.get('token'), get_registry(self._config).transport(Providers.dummy))
+        return self._client
+
+    def _claimable(self, now: datetime.datetime):
+        stale_before = now - datetime.timedelta(seconds=self._lock_timeout)
+        return db.or_(
+            db.and_(Notification.state == NotificationState.pending,
+                    Notification.available_at <= now),
+            # Worker died while sending
+            db.and_(Notification.state == NotificationState.sending,
+                    Notification.locked_at <= stale_before),
+        )
+
+    def claim(self, limit: int) -> list[Notification]:
+        '''Claim up to `limit` notifications, oldest first. Claim is committed before return.
+
+        Once a digest line is due, the other pending digest lines join it.
+        '''
+        now = utcnow()
+        columns = (Notification.id, Notification.state, Notification.locked_at, Notification.digest_key)
+        is_skip_locked = db.session.get_bind().dialect.name == 'postgresql'
+
+        def _candidates(condition, size):
+            query = db.select(*columns).where(condition).order_by(Notification.id).limit(size)
+            if is_skip_locked:
+                query = query.with_for_update(skip_locked=True)
+            return db.session.execute(query).all()
+
+        candidates = _candidates(self._claimable(now), limit)
+        if len(candidates) < limit and any(digest_key is not None for *_, digest_key in candidates):
+            candidates += _candidates(
+                db.and_(Notification.state == NotificationState.pending,
+                        Notification.digest_key.is_not(None),
+                        Notification.attempts == 0,
+                        Notification.available_at > now),
+                limit - len(candidates),
+            )
+        claimed_ids = []
+        for notification_id, state, locked_at, _ in candidates:
+            result = db.session.execute(
+                db.update(Notification)
+                .where(Notification.id == notification_id,
+                       Notification.state == state,
+                       Notification.locked_at.is_(None) if locked_at is None
+                       else Notification.locked_at == locked_at)
+                .values(state=NotificationState.sending, locked_at=now, attempts=Notification.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                claimed_ids.append(notification_id)
+        db.session.commit()
+        if not claimed_ids:
+            return []
+        return list(db.session.execute(
+            db.select(Notification)
+            .where(Notification.id.in_(claimed_ids))
+            .order_by(Notification.id)
+            .execution_options(populate_existing=True)
+        ).scalars())
+
+    @staticmethod
+    def compose(notifications: list[Notification]) -> list[tuple[str, str, list[Notification]]]:
+        '''Messages to send: (chat id, text, notifications delivered by the message)'''
+        messages = []
+        digests: dict[str, dict[str, list[Notification]]] = {}
+        for notification in notifications:
+            if notification.digest_key is None:
+                messages.append((notification.chat_id, notification.text, [notification]))
+            else:
+                digests.setdefault(notification.chat_id, {}) \
+                    .setdefault(notification.digest_key, []).append(notification)
+        for chat_id, groups in digests.items():
+            messages.extend((chat_id, text, group) for text, group in pack_digest(groups))
+        return messages
+
+    @staticmethod
+    def _send(client: TelegramClient, chat_id: str, text: str):
+        '''Executed in the pool. Returns Telegram message id'''
+        data = client.send_message(chat_id, text)
+        return data.get('result', {}).get('message_id')
+
+    def _apply(self, notification: Notification, message_id, error: Optional[Exception]) -> None:
+        notification.locked_at = None
+        if error is None:
+            notification.state = NotificationState.sent
+            notification.message_id = str(message_id) if message_id is not None else None
+            notification.sent_at = utcnow()
+            notification.error_hint = None
+            NOTIFICATIONS.inc(outcome='sent')
+            return
+        notification.error_hint = str(error)
+        if not _is_retryable(error) or notification.attempts >= self._config.notify_max_attempts:
+            logger.error('Notification %s failed after %s attempts: %s', notification.id, notification.attempts, error)
+            notification.state = NotificationState.failed
+            NOTIFICATIONS.inc(outcome='failed')
+            return
+        delay = max(backoff_delay(notification.attempts, base=1.0, cap=300.0),
+                    getattr(error, 'retry_after', None) or 0)
+        logger.warning('Notification %s retry in %.1fs: %s', notification.id, delay, error)
+        notification.state = NotificationState.pending
+        notification.available_at = utcnow() + datetime.timedelta(seconds=delay)
+        NOTIFICATIONS.inc(outcome='retry')
+
+    def depth(self) -> int:
+        return db.session.execute(
+            db.select(db.func.count(Notification.id))
+            .where(Notification.state.in_((NotificationState.pending, NotificationState.sending)))
+        ).scalar()
+
+    def run_once(self) -> int:
+        '''Claim and send a single batch. Returns amount of claimed notifications'''
+        with self._app.app_context():
+            try:
+                client = self.client
+                notifications = self.claim(self._config.notify_batch_size)
+                messages = self.compose(notifications)
+                futures = [
+                    self._executor.submit(self._send, client, chat_id, text)
+                    for chat_id, text, _ in messages
+                ]
+                for (_, _, group), future in zip(messages, futures):
+                    try:
+                        message_id, error = future.result(), None
+                    except Exception as exc:
+                        message_id, error = None, exc
+                    for notification in group:
+                        self._apply(notification, message_id, error)
+                db.session.commit()
+                OUTBOX_DEPTH.set(self.depth())
+                return len(notifications)
+            finally:
+                db.session.remove()
+
+    def run_forever(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                sent = self.run_once()
+            except Exception as exc:
+                logger.error('Outbox dispatch failed: %s', exc, exc_info=exc)
+                sent = 0
+            if not sent:
+                self._stopped.wait(self._poll_interval)
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run_forever, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,72 @@
+'''SMM panels speaking "API v2" protocol (add, status, services, balance).
+
+New panel is added with a `register_panel` call below; `Providers` enum,
+provider config and `PROVIDERS` map are built from this registry.
+'''
+import dataclasses
+
+__all__ = (
+    'PanelSpec',
+    'PANELS',
+    'register_panel',
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class PanelSpec:
+    name: str  # Providers member name, used in Google Sheets
+    provider_id: int  # Providers member value. Never reuse
+    base_url: str
+    token_key: str  # Environment variable with API key
+    title: str = ''  # Used in logs
+    docs_url: str = ''
+    # Quirks
+    verify: bool = False  # TLS certificate verification
+    timeout: float = 5
+    max_status_batch: int = 100  # Order ids per multi status request
+
+
+PANELS: dict[str, PanelSpec] = {}
+
+
+def register_panel(spec: PanelSpec) -> PanelSpec:
+    if spec.name in PANELS or spec.name == 'dummy':
+        raise ValueError(f'Panel already registered: {spec.name}')
+    if any(panel.provider_id == spec.provider_id for panel in PANELS.values()) or spec.provider_id == 0:
+        raise ValueError(f'Provider id already used: {spec.provider_id}')
+    PANELS[spec.name] = spec
+    return spec
+
+
+register_panel(PanelSpec(
+    name='socproof',
+    provider_id=1,
+    title='SOCProof',
+    base_url='https://partner.soc-proof.su/api/v2',
+    docs_url='https://partner.soc-proof.su/api',
+    token_key='SOCPROOF_TOKEN',
+))
+register_panel(PanelSpec(
+    name='justanotherpanel',
+    provider_id=2,
+    title='JustAnotherPanel',
+    base_url='https://justanotherpanel.com/api/v2',
+    docs_url='https://justanotherpanel.com/api',
+    token_key='JUSTANOTHERPANEL_TOKEN',
+))
+register_panel(PanelSpec(
+    name='prosmmstore',
+    provider_id=3,
+    title='ProSMMStore',
+    base_url='https://prosmm-store.com/api/v2',
+    docs_url='https://prosmm-store.com/api',
+    token_key='PROSMMSTORE_TOKEN',
+))
+register_panel(PanelSpec(
+    name='fxsmmsoc',
+    provider_id=4,
+    title='FxSMMSoc',
+    base_url='https://fxsmm.socpanel.com/api/v2',
+    docs_url='https://fxsmm.socpanel.com/developer',
+    token_key='FXSMMSOC_TOKEN',
+))
@@ -1,19 +1,21 @@
-import dataclasses
 import math
 import re
 from urllib.parse import unquote
 
 __all__ = (
     'parse_order',
+    'parse_orders',
     'OrderProductDetails',
 )
 import functools
 
 try:
     from .log import logger
+    from .metrics import timed
     from .models import OrderEntryState
 except ImportError:
     from webhook_api.log import logger
+    from webhook_api.metrics import timed
     from webhook_api.models import OrderEntryState
 
 ESCAPE_MAPPING = [
@@ -29,27 +31,18 @@ ESCAPE_MAPPING = [
 ]
 
 
+# Single pass replacement table
+UNESCAPE_TABLE = str.maketrans(dict(ESCAPE_MAPPING))
+
+
 def unescape_url(raw_url: str) -> str:
-    buff = raw_url.strip()
-    for esc, unsec in ESCAPE_MAPPING:
-        buff = buff.replace(esc, unsec)
-    return unquote(buff)
-
-
-PRODUCT_TYPES = {
-    'service_name': lambda service: service.strip(':').strip(' '),
-    'price_per_unit': float,
-    'per_unit': float,
-    'url': unescape_url,
-    'amount': float,
-    'order_amount': int,
-    'order_price': float,
-    'price_total': float,
-    'is_package': bool,
-    'quantity': float,
-    'price': float,
-    'units_amount': float,
-}
+    return unquote(raw_url.strip().translate(UNESCAPE_TABLE))
+
+
+def _service_name(service: str) -> str:
+    return service.strip(':').strip(' ')
+
+
 # "Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/photo-217356953_457239069?access_keyх25abee02487126647c  Количество: 75",
 # "Услуга Telegram: 300 шт позитивных  : 84 руб. 0.28/шт вместо 0.35/шт   Ссылка: https://t.me/atmanshopp  Количество: 1 пакет",
 
@@ -65,33 +58,51 @@ PRODUCT_RE = re.compile(
 )
 
 
-@dataclasses.dataclass()
+PACKAGE_UNITS_RE = re.compile(r'(\d.)+')
+
+# Order entry attributes stored in `OrderEntry`
+PRODUCT_FIELDS = (
+    'service_name',
+    'name',
+    'url',
+    'price_per_unit',
+    'per_unit',
+    'units_amount',
+    'quantity',
+    'amount',
+    'price',
+    'is_package',
+)
+
+PARSE_CACHE_SIZE = 4096
+
+
 class OrderProductDetails:
-    service_name: str
-    name: str
-    url: str
-    price_per_unit: float
-    per_unit: float
-    units_amount: float
-    quantity: float
-    amount: float
-    price: float
-    is_package: bool
-
-    @functools.cached_property
-    def calculated_price(self) -> float:
-        if self.is_package:
-            price = self.price_per_unit * self.quantity
+    __slots__ = PRODUCT_FIELDS + ('calculated_price', 'is_payed')
+
+    def __init__(self, service_name: str, name: str, url: str, price_per_unit: float,
+                 per_unit: float, units_amount: float, quantity: float, amount: float,
+                 price: float, is_package: bool) -> None:
+        self.service_name = service_name
+        self.name = name
+        self.url = url
+        self.price_per_unit = price_per_unit
+        self.per_unit = per_unit
+        self.units_amount = units_amount
+        self.quantity = quantity
+        self.amount = amount
+        self.price = price
+        self.is_package = is_package
+
+        if is_package:
+            calculated_price = price_per_unit * quantity
         else:
-            price = self.price_per_unit * self.units_amount * self.quantity
-        return round(price, 2)
-
-    @functools.cached_property
-    def is_payed(self) -> bool:
-        '''Tilda's payment info fix ...'''
-        return (self.amount >= self.calculated_price) \
-            or math.floor(self.amount) == math.floor(self.calculated_price) \
-            or (abs(self.amount - self.calculated_price) <= 1)
+            calculated_price = price_per_unit * units_amount * quantity
+        self.calculated_price = round(calculated_price, 2)
+        # Tilda's payment info fix ...
+        self.is_payed = (amount >= self.calculated_price) \
+            or math.floor(amount) == math.floor(self.calculated_price) \
+            or (abs(amount - self.calculated_price) <= 1)
 
     @property
     def state(self) -> OrderEntryState:
@@ -100,36 +111,70 @@ class OrderProductDetails:
             state = OrderEntryState.not_payed
         return state
 
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in PRODUCT_FIELDS}
 
-def parse_order(_product) -> OrderProductDetails:
-    m = PRODUCT_RE.search(_product.get('name'))
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, OrderProductDetails):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{field}={getattr(self, field)!r}' for field in PRODUCT_FIELDS)
+        return f'OrderProductDetails({fields})'
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_name(name: str):
+    '''Name dependent part of the product: parsed once per distinct name'''
+    m = PRODUCT_RE.search(name)
     if m is None:
         return None
-    data = m.groupdict()
+    service_name, price_per_unit, per_unit, price_per_unit1, per_unit1, url, units_amount = m.group(
+        'service_name', 'price_per_unit', 'per_unit', 'price_per_unit1', 'per_unit1', 'url', 'units_amount')
     # Handle package
-    is_package = data.get('price_per_unit1') is not None
-    price_per_unit = data.get('price_per_unit1') or data.get('price_per_unit')
-    per_unit = data.get('per_unit1') or data.get('per_unit')
-    data.update({
-        'price_per_unit': price_per_unit,
-        'per_unit': per_unit,
-        'is_package': is_package,
-    })
-    data.update(_product)
-    del data['price_per_unit1']
-    del data['per_unit1']
-    if data['is_package']:
-        units_amount = re.search(r'(\d.)+', data.get('service_name', ''))[0]
-        data['units_amount'] = units_amount
+    is_package = price_per_unit1 is not None
+    if is_package:
+        price_per_unit, per_unit = price_per_unit1, per_unit1
+        units_amount = PACKAGE_UNITS_RE.search(service_name)[0]
+    return (
+        _service_name(service_name),
+        unescape_url(url),
+        float(price_per_unit),
+        float(per_unit),
+        float(units_amount),
+        is_package,
+    )
+
+
+def parse_order(_product) -> OrderProductDetails:
     try:
-        for prop, value in data.items():
-            data[prop] = PRODUCT_TYPES.get(prop, str)(value)
+        name = str(_product.get('name'))
+        parsed = _parse_name(name)
+        if parsed is None:
+            return None
+        service_name, url, price_per_unit, per_unit, units_amount, is_package = parsed
+        return OrderProductDetails(
+            service_name=service_name,
+            name=name,
+            url=url,
+            price_per_unit=price_per_unit,
+            per_unit=per_unit,
+            units_amount=units_amount,
+            quantity=float(_product.get('quantity')),
+            amount=float(_product.get('amount')),
+            price=float(_product.get('price')),
+            is_package=is_package,
+        )
     except Exception as exc:
         logger.error('Unable to parse order entry: %s', exc, exc_info=exc)
         return None
-    details = OrderProductDetails(**data)
 
-    return details
+
+@timed('parse')
+def parse_orders(products) -> list[OrderProductDetails]:
+    '''Parse Tilda's `payment.products`; `None` for unparsed products'''
+    return [parse_order(_product) for _product in products]
 
 
 def main():
@@ -0,0 +1,59 @@
+from typing import Optional
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .ext import db
+from .metrics import ORDER_ENTRY_TRANSITIONS, timed
+from .models import Order, OrderEntry
+
+__all__ = (
+    'insert_order',
+)
+
+_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def _insert_order_statement(values: dict):
+    dialect = db.session.get_bind().dialect.name
+    insert = _INSERTS.get(dialect)
+    if insert is None:
+        # No ON CONFLICT support: duplicate raises IntegrityError
+        return db.insert(Order).values(**values).returning(Order.id)
+    return insert(Order).values(**values) \
+        .on_conflict_do_nothing(index_elements=[Order.order_id]) \
+        .returning(Order.id)
+
+
+@timed('persist')
+def insert_order(order: dict, entries: list[dict], related: list[tuple] = ()) -> Optional[int]:
+    '''Store order with its entries in a single transaction.
+
+    order: `Order` column values
+    entries: `OrderEntry` column values; `order_id` is filled in
+    related: (model, [values]) rows referencing the order by `order_id`
+             (e.g. fulfillment job), inserted in the same transaction
+
+    Duplicate order id is detected atomically by `ON CONFLICT DO NOTHING`;
+    `None` is returned and nothing is inserted. Entries are sent with a
+    single multi-row INSERT. Caller commits.
+    '''
+    order_pk = db.session.execute(_insert_order_statement(order)).scalar()
+    if order_pk is None:
+        return None
+    if entries:
+        db.session.execute(
+            db.insert(OrderEntry),
+            [{**entry, 'order_id': order_pk} for entry in entries],
+        )
+        for entry in entries:
+            ORDER_ENTRY_TRANSITIONS.inc(source='webhook', state=entry['state'].name)
+    for model, rows in related:
+        if rows:
+            db.session.execute(
+                db.insert(model),
+                [{**row, 'order_id': order_pk} for row in rows],
+            )
+    return order_pk
@@ -3,19 +3,14 @@ __all__ = (
 )
 import dataclasses
 
+from ..matching import normalize_service_name
 from ..models import Providers, ServiceProvider
+from ..panels import PANELS
 from .dummy import DummyProvider
-from .justanotherpanel import JustAnotherPanelProvider
-from .prosmmstore import ProSMMStoreProvider
-from .fxsmmsocpanel import FxSMMSocProvider
-from .services import JUSTANOTHERPANEL, PROSMMSTORE, SOCPROOF, FXSMMSOC
-from .socproof import SocProofProvider
+from .panel import panel_provider
 
 PROVIDERS = {
-    JUSTANOTHERPANEL: JustAnotherPanelProvider,
-    SOCPROOF: SocProofProvider,
-    PROSMMSTORE: ProSMMStoreProvider,
-    FXSMMSOC: FxSMMSocProvider,
+    **{name: panel_provider(spec) for name, spec in PANELS.items()},
     'dummy': DummyProvider,
 }
 
@@ -29,19 +24,30 @@ def get_provider(_id: Providers):
 
 
 def resolve_provider(service_name: str, index=None):
-    return (index or {}).get(service_name, ServiceProvider(service_name, None, Providers['dummy']))
+    '''index: by normalized service name, see `ServiceDescription.get_index`'''
+    return (index or {}).get(normalize_service_name(service_name),
+                             ServiceProvider(service_name, None, Providers['dummy']))
 
 
-SERVICES = (
-    SOCPROOF,
-    JUSTANOTHERPANEL,
-    PROSMMSTORE,
-    FXSMMSOC
-)
+SERVICES = tuple(PANELS)
+
+
+def row_candidates(row) -> list[tuple[str, str]]:
+    '''(service_id, provider) pairs of a sheet row in priority order.
+
+    Row: [service_name, service_id, provider, alt_service_id, alt_provider, ...];
+    empty alternate pairs are skipped.
+    '''
+    return [
+        (service_id, provider)
+        for service_id, provider in zip(row[1::2], row[2::2])
+        if str(service_id or '').strip() or str(provider or '').strip()
+    ]
 
 
 def is_valid_row(row) -> bool:
-    is_valid = True
-    is_valid &= len(row) == 3
-    is_valid &= row[2] in PROVIDERS
-    return is_valid
+    if len(row) < 3 or len(row) % 2 == 0:
+        return False
+    candidates = row_candidates(row)
+    return bool(candidates) and row[2] in PROVIDERS \
+        and all(provider in PROVIDERS for _, provider in candidates)
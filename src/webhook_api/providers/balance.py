@@ -0,0 +1,216 @@
+'''Provider account balances.
+
+The worker polls `balance` of every panel and stores it in
+`ProviderBalance` rows. Every submitted order debits its catalog cost
+from the row with a conditional UPDATE, so orders which the account
+can not pay for are refused before the network round trip and all
+processes see the same remainder. The next poll replaces the estimate
+with the balance reported by the provider.
+
+Ledger runs in dispatcher threads: the DB is accessed with engine
+connections, never with the scoped session.
+'''
+import threading
+import time
+from typing import Optional
+
+from flask import has_app_context
+
+from ..config import Config
+from ..ext import db
+from ..log import logger
+from ..metrics import REGISTRY
+from ..models import ProviderBalance
+from .utils import ProviderError
+
+__all__ = (
+    'BalanceLedger',
+    'BalanceStore',
+    'InsufficientFunds',
+    'LocalBalances',
+    'get_balances',
+)
+
+BALANCE = REGISTRY.gauge(
+    'provider_balance', 'Provider account balance estimate', ('provider',))
+BURN_RATE = REGISTRY.gauge(
+    'provider_balance_burn_rate', 'Provider account spendings per hour', ('provider',))
+INSUFFICIENT_FUNDS = REGISTRY.counter(
+    'provider_insufficient_funds_total', 'Orders refused for lack of provider funds', ('provider',))
+
+
+class InsufficientFunds(ProviderError):
+    '''Provider account can not pay for the order; nothing was sent'''
+
+    def __init__(self, name: str, available: float, cost: float, retry_after: float) -> None:
+        super().__init__(f'Insufficient funds: {name}; {available:.2f} available, {cost:.2f} required')
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _burn_rate(previous: Optional[ProviderBalance], balance: float, now: float) -> Optional[float]:
+    '''Spent per hour since the previous poll; top-ups keep the previous rate'''
+    if previous is None:
+        return None
+    elapsed = now - previous.polled_at
+    if balance > previous.balance or elapsed <= 0:
+        return previous.burn_rate
+    return (previous.balance - balance) * 3600 / elapsed
+
+
+class LocalBalances:
+    '''Balances of this process only'''
+
+    def __init__(self) -> None:
+        self._balances: dict[str, ProviderBalance] = {}
+        self._lock = threading.Lock()
+
+    def update(self, name: str, balance: float, currency: str, now: float) -> ProviderBalance:
+        with self._lock:
+            previous = self._balances.get(name)
+            row = self._balances[name] = ProviderBalance(
+                provider=name, balance=balance, currency=currency, spent=0.0,
+                burn_rate=_burn_rate(previous, balance, now), polled_at=now)
+            return row
+
+    def debit(self, name: str, amount: float) -> Optional[ProviderBalance]:
+        '''None if debited (or the balance is unknown), the row otherwise'''
+        with self._lock:
+            row = self._balances.get(name)
+            if row is None or row.available >= amount:
+                if row is not None:
+                    row.spent += amount
+                return None
+            return row
+
+    def credit(self, name: str, amount: float) -> None:
+        with self._lock:
+            row = self._balances.get(name)
+            if row is not None:
+                row.spent = max(row.spent - amount, 0)
+
+    def load(self) -> list[ProviderBalance]:
+        with self._lock:
+            return list(self._balances.values())
+
+
+class BalanceStore:
+    '''`ProviderBalance` rows accessed with own connections'''
+
+    table = ProviderBalance.__table__
+
+    def __init__(self, engine) -> None:
+        self._engine = engine
+
+    def _row(self, conn, name: str) -> Optional[ProviderBalance]:
+        row = conn.execute(self.table.select().where(self.table.c.provider == name)).first()
+        return ProviderBalance(**row._mapping) if row is not None else None
+
+    def update(self, name: str, balance: float, currency: str, now: float) -> ProviderBalance:
+        table = self.table
+        with self._engine.begin() as conn:
+            previous = self._row(conn, name)
+            values = {'balance': balance, 'currency': currency, 'spent': 0.0,
+                      'burn_rate': _burn_rate(previous, balance, now), 'polled_at': now}
+            if previous is None:
+                conn.execute(table.insert().values(provider=name, **values))
+            else:
+                conn.execute(table.update().where(table.c.provider == name).values(**values))
+        return ProviderBalance(provider=name, **values)
+
+    def debit(self, name: str, amount: float) -> Optional[ProviderBalance]:
+        '''None if debited (or the balance is unknown), the row otherwise'''
+        table = self.table
+        with self._engine.begin() as conn:
+            result = conn.execute(
+                table.update()
+                .where(table.c.provider == name, table.c.balance - table.c.spent >= amount)
+                .values(spent=table.c.spent + amount)
+            )
+            if result.rowcount == 1:
+                return None
+            return self._row(conn, name)
+
+    def credit(self, name: str, amount: float) -> None:
+        table = self.table
+        with self._engine.begin() as conn:
+            conn.execute(
+                table.update()
+                .where(table.c.provider == name, table.c.spent >= amount)
+                .values(spent=table.c.spent - amount)
+            )
+
+    def load(self) -> list[ProviderBalance]:
+        with self._engine.connect() as conn:
+            return [ProviderBalance(**row._mapping) for row in conn.execute(self.table.select())]
+
+
+class BalanceLedger:
+    '''Balances of all providers.
+
+    retry_after: seconds before an order refused for lack of funds is
+                 worth another try (a top-up is seen with the next poll)
+    '''
+
+    def __init__(self, store=None, retry_after: float = 300) -> None:
+        self._store = store or LocalBalances()
+        self._retry_after = retry_after
+
+    def record(self, name: str, balance: float, currency: str = None) -> ProviderBalance:
+        '''Balance reported by the provider'''
+        row = self._store.update(name, balance, currency, time.time())
+        BALANCE.set(row.balance, provider=name)
+        if row.burn_rate is not None:
+            BURN_RATE.set(row.burn_rate, provider=name)
+        logger.info('Balance %s: %s %s', name, balance, currency or '')
+        return row
+
+    def debit(self, name: str, amount: float) -> None:
+        '''Raise `InsufficientFunds` if the known balance does not cover the amount'''
+        try:
+            row = self._store.debit(name, amount)
+        except Exception as exc:
+            # Panel will refuse the order itself
+            logger.warning('Unable to debit %s balance: %s', name, exc)
+            return
+        if row is not None:
+            INSUFFICIENT_FUNDS.inc(provider=name)
+            raise InsufficientFunds(name, row.available, amount, self._retry_after)
+
+    def credit(self, name: str, amount: float) -> None:
+        '''Return the amount of the order which was not placed'''
+        try:
+            self._store.credit(name, amount)
+        except Exception as exc:
+            logger.warning('Unable to credit %s balance: %s', name, exc)
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            row.provider: {
+                'balance': row.balance,
+                'currency': row.currency,
+                'available': round(row.available, 4),
+                'burn_rate': row.burn_rate,
+                'hours_left': round(row.available / row.burn_rate, 1) if row.burn_rate else None,
+                'age': round(now - row.polled_at, 1),
+            }
+            for row in self._store.load()
+        }
+
+
+_balances: Optional[BalanceLedger] = None
+_balances_lock = threading.Lock()
+
+
+def get_balances(config: Config = None) -> BalanceLedger:
+    '''Process-wide ledger. Shared through the DB when created within app context'''
+    global _balances
+    with _balances_lock:
+        if _balances is None:
+            config = config or Config()
+            _balances = BalanceLedger(
+                BalanceStore(db.engine) if has_app_context() else None,
+                retry_after=config.balance_poll_interval or 300,
+            )
+        return _balances
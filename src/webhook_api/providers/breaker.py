@@ -0,0 +1,259 @@
+'''Per-provider circuit breakers.
+
+Each process keeps a sliding window of call outcomes per provider and
+trips the breaker when too many calls fail or are slow. The state is
+shared through `ProviderBreaker` rows: a process which trips the breaker
+opens it for everybody, other processes pick the state up within
+`sync_interval`. After `open_seconds` a single probe call (claimed with a
+conditional UPDATE) decides whether the breaker closes or opens again.
+
+Breakers run in dispatcher threads: the DB is accessed with engine
+connections, never with the scoped session.
+'''
+import collections
+import datetime
+import threading
+import time
+from typing import Optional
+
+from ..log import logger
+from ..metrics import REGISTRY
+from ..models import BreakerState, ProviderBreaker
+from .utils import ProviderUnavailable
+
+__all__ = (
+    'BreakerStore',
+    'CircuitBreaker',
+    'CircuitOpen',
+)
+
+BREAKER_STATE = REGISTRY.gauge(
+    'provider_breaker_state', 'Circuit breaker state (1 closed, 2 open, 3 half-open)', ('provider',))
+BREAKER_TRIPS = REGISTRY.counter(
+    'provider_breaker_trips_total', 'Circuit breaker openings', ('provider',))
+
+
+class CircuitOpen(ProviderUnavailable):
+    '''Provider calls are suspended; retry after `retry_after` seconds'''
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f'Circuit open: {name}; retry in {retry_after:.1f}s', retry_after)
+        self.name = name
+
+
+def _to_timestamp(value: Optional[datetime.datetime]) -> float:
+    if value is None:
+        return 0.0
+    if value.tzinfo is None:
+        # SQLite returns naive UTC values
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+def _to_datetime(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+class BreakerStore:
+    '''`ProviderBreaker` rows accessed with own connections'''
+
+    table = ProviderBreaker.__table__
+
+    def __init__(self, engine) -> None:
+        self._engine = engine
+
+    def load(self, name: str) -> Optional[tuple[BreakerState, float]]:
+        '''(state, opened until timestamp)'''
+        with self._engine.connect() as conn:
+            row = conn.execute(
+                self.table.select().where(self.table.c.provider == name)
+            ).first()
+        if row is None:
+            return None
+        return row.state, _to_timestamp(row.opened_until)
+
+    def open(self, name: str, until: float) -> None:
+        values = {'state': BreakerState.open, 'opened_until': _to_datetime(until), 'probe_until': None}
+        with self._engine.begin() as conn:
+            result = conn.execute(
+                self.table.update()
+                .where(self.table.c.provider == name)
+                .values(trips=self.table.c.trips + 1, **values)
+            )
+            if result.rowcount == 0:
+                conn.execute(self.table.insert().values(provider=name, trips=1, **values))
+
+    def close(self, name: str) -> None:
+        with self._engine.begin() as conn:
+            conn.execute(
+                self.table.update()
+                .where(self.table.c.provider == name)
+                .values(state=BreakerState.closed, opened_until=None, probe_until=None)
+            )
+
+    def claim_probe(self, name: str, now: float, timeout: float) -> bool:
+        '''Only one process probes an expired open breaker at a time'''
+        now_dt = _to_datetime(now)
+        with self._engine.begin() as conn:
+            result = conn.execute(
+                self.table.update()
+                .where(self.table.c.provider == name,
+                       self.table.c.state != BreakerState.closed,
+                       self.table.c.opened_until <= now_dt,
+                       (self.table.c.probe_until.is_(None)) | (self.table.c.probe_until <= now_dt))
+                .values(state=BreakerState.half_open, probe_until=_to_datetime(now + timeout))
+            )
+        return result.rowcount == 1
+
+
+class CircuitBreaker:
+    '''Breaker of a single provider in this process.
+
+    window: seconds of call outcomes considered
+    min_calls: outcomes in the window required to trip
+    failure_rate / slow_rate: share of failed / slow calls which trips the breaker
+    slow_call: seconds; slower calls count as slow
+    open_seconds: calls fail fast this long after trip
+    probe_timeout: seconds a claimed probe blocks other probes
+    '''
+
+    def __init__(self, name: str, store: BreakerStore = None, window: float = 30.0,
+                 min_calls: int = 10, failure_rate: float = 0.5, slow_call: float = 3.0,
+                 slow_rate: float = 0.5, open_seconds: float = 30.0, probe_timeout: float = 10.0,
+                 sync_interval: float = 1.0) -> None:
+        self.name = name
+        self._store = store
+        self._window = window
+        self._min_calls = min_calls
+        self._failure_rate = failure_rate
+        self._slow_call = slow_call
+        self._slow_rate = slow_rate
+        self._open_seconds = open_seconds
+        self._probe_timeout = probe_timeout
+        self._sync_interval = sync_interval
+        self._calls = collections.deque()  # (timestamp, failed, slow)
+        self._state = BreakerState.closed
+        self._opened_until = 0.0
+        self._probe_until = 0.0
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+        BREAKER_STATE.set(self._state.value, provider=name)
+
+    @property
+    def state(self) -> BreakerState:
+        return self._state
+
+    @property
+    def is_closed(self) -> bool:
+        return self._state == BreakerState.closed
+
+    def _set_state(self, state: BreakerState, opened_until: float = 0.0) -> None:
+        if state != self._state:
+            logger.warning('Circuit breaker %s: %s -> %s', self.name, self._state.name, state.name)
+        self._state = state
+        self._opened_until = opened_until
+        BREAKER_STATE.set(state.value, provider=self.name)
+
+    def _sync(self, now: float) -> None:
+        if self._store is None or now - self._synced_at < self._sync_interval:
+            return
+        self._synced_at = now
+        try:
+            shared = self._store.load(self.name)
+        except Exception as exc:
+            logger.warning('Unable to load circuit breaker %s: %s', self.name, exc)
+            return
+        if shared is None:
+            return
+        state, opened_until = shared
+        if state == BreakerState.closed and self._state != BreakerState.closed:
+            self._calls.clear()
+            self._set_state(BreakerState.closed)
+        elif state != BreakerState.closed:
+            if self._state == BreakerState.closed:
+                self._set_state(BreakerState.open, opened_until)
+            else:
+                # Reopened by a failed probe elsewhere
+                self._opened_until = max(self._opened_until, opened_until)
+
+    def before_call(self) -> bool:
+        '''Raise `CircuitOpen` if the call is not allowed. Returns True for probe call'''
+        now = time.time()
+        with self._lock:
+            self._sync(now)
+            if self._state == BreakerState.closed:
+                return False
+            if now < self._opened_until:
+                raise CircuitOpen(self.name, self._opened_until - now)
+            if self._claim_probe(now):
+                self._set_state(BreakerState.half_open, self._opened_until)
+                return True
+            raise CircuitOpen(self.name, min(self._probe_timeout, self._sync_interval))
+
+    def _claim_probe(self, now: float) -> bool:
+        if now < self._probe_until:
+            return False
+        if self._store is not None:
+            try:
+                if not self._store.claim_probe(self.name, now, self._probe_timeout):
+                    return False
+            except Exception as exc:
+                logger.warning('Unable to claim circuit breaker %s probe: %s', self.name, exc)
+        self._probe_until = now + self._probe_timeout
+        return True
+
+    def record(self, duration: float, failed: bool, probe: bool = False) -> None:
+        '''Outcome of a call allowed by `before_call`'''
+        now = time.time()
+        slow = duration >= self._slow_call
+        with self._lock:
+            if probe:
+                self._probe_until = 0.0
+                if failed or slow:
+                    self._trip(now)
+                else:
+                    self._calls.clear()
+                    self._set_state(BreakerState.closed)
+                    self._persist('close')
+                return
+            self._calls.append((now, failed, slow))
+            while self._calls and self._calls[0][0] < now - self._window:
+                self._calls.popleft()
+            if self._state == BreakerState.closed and self._is_tripped():
+                self._trip(now)
+
+    def _is_tripped(self) -> bool:
+        calls = len(self._calls)
+        if calls < self._min_calls:
+            return False
+        failures = sum(1 for _, failed, _ in self._calls if failed)
+        slow = sum(1 for _, _, is_slow in self._calls if is_slow)
+        return failures / calls >= self._failure_rate or slow / calls >= self._slow_rate
+
+    def _trip(self, now: float) -> None:
+        opened_until = now + self._open_seconds
+        self._calls.clear()
+        self._set_state(BreakerState.open, opened_until)
+        BREAKER_TRIPS.inc(provider=self.name)
+        self._persist('open', opened_until)
+
+    def _persist(self, method: str, *args) -> None:
+        '''Share state change with other processes'''
+        if self._store is None:
+            return
+        try:
+            getattr(self._store, method)(self.name, *args)
+        except Exception as exc:
+            logger.warning('Unable to store circuit breaker %s: %s', self.name, exc)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            calls = list(self._calls)
+            return {
+                'state': self._state.name,
+                'retry_in': round(max(self._opened_until - now, 0), 3) if self._state != BreakerState.closed else 0,
+                'calls': len(calls),
+                'failures': sum(1 for _, failed, _ in calls if failed),
+                'slow': sum(1 for _, _, slow in calls if slow),
+            }
@@ -0,0 +1,200 @@
+'''Panel service catalogs (`services` action).
+
+Catalogs are fetched periodically by the worker and kept in memory and,
+with `CATALOG_DIR` set, in `<CATALOG_DIR>/catalog-<provider>.json` files
+which every process picks up when they change.
+'''
+import dataclasses
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Optional
+
+from ..config import Config
+from ..log import logger
+from .utils import ProviderError
+
+__all__ = (
+    'CatalogService',
+    'OrderValidationError',
+    'ProviderCatalog',
+    'ServiceCatalog',
+    'get_catalog',
+)
+
+
+class OrderValidationError(ProviderError):
+    '''Order would be rejected by the panel; nothing was sent'''
+
+
+@dataclasses.dataclass(frozen=True)
+class CatalogService:
+    service_id: str
+    name: str
+    rate: float  # Price per 1000 units
+    min: int
+    max: int
+    category: str = None
+
+    @classmethod
+    def from_panel(cls, item: dict) -> 'CatalogService':
+        return cls(
+            service_id=str(item['service']),
+            name=item.get('name'),
+            rate=float(item.get('rate') or 0),
+            min=int(item.get('min') or 0),
+            max=int(item.get('max') or 0),
+            category=item.get('category'),
+        )
+
+    def cost(self, quantity: int) -> float:
+        return self.rate * quantity / 1000
+
+
+@dataclasses.dataclass()
+class ProviderCatalog:
+    fetched_at: float  # Unix timestamp
+    services: dict[str, CatalogService]
+
+    def as_dict(self) -> dict:
+        return {
+            'fetched_at': self.fetched_at,
+            'services': [dataclasses.asdict(service) for service in self.services.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ProviderCatalog':
+        services = (CatalogService(**item) for item in data['services'])
+        return cls(data['fetched_at'], {service.service_id: service for service in services})
+
+
+class ServiceCatalog:
+    '''Catalogs of all panels.
+
+    max_age: seconds; older catalogs are reported stale (still used)
+    check_interval: seconds between catalog file checks
+    '''
+
+    def __init__(self, directory: str = None, max_age: float = 7200, check_interval: float = 10) -> None:
+        self._directory = pathlib.Path(directory) if directory else None
+        self._max_age = max_age
+        self._check_interval = check_interval
+        self._catalogs: dict[str, ProviderCatalog] = {}
+        self._mtimes: dict[str, float] = {}
+        self._checked_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> pathlib.Path:
+        return self._directory / f'catalog-{name}.json'
+
+    def get(self, name: str) -> Optional[ProviderCatalog]:
+        if self._directory is None:
+            return self._catalogs.get(name)
+        now = time.monotonic()
+        if now - self._checked_at.get(name, -self._check_interval) < self._check_interval:
+            return self._catalogs.get(name)
+        with self._lock:
+            self._checked_at[name] = now
+            path = self._path(name)
+            try:
+                mtime = path.stat().st_mtime
+                if mtime != self._mtimes.get(name):
+                    self._catalogs[name] = ProviderCatalog.from_dict(json.loads(path.read_text()))
+                    self._mtimes[name] = mtime
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as exc:
+                logger.warning('Unable to read catalog %s: %s', path, exc)
+            return self._catalogs.get(name)
+
+    def store(self, name: str, catalog: ProviderCatalog) -> None:
+        with self._lock:
+            self._catalogs[name] = catalog
+            if self._directory is None:
+                return
+            self._directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(name)
+            tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            tmp_path.write_text(json.dumps(catalog.as_dict(), ensure_ascii=False))
+            tmp_path.replace(path)
+            self._mtimes[name] = path.stat().st_mtime
+            self._checked_at[name] = time.monotonic()
+
+    def refresh(self, name: str, client) -> ProviderCatalog:
+        '''Fetch the catalog with panel client'''
+        items = client.services()
+        services = {}
+        for item in items or ():
+            try:
+                service = CatalogService.from_panel(item)
+            except (KeyError, TypeError, ValueError) as exc:
+                logger.warning('Skipped %s catalog item %s: %s', name, item, exc)
+                continue
+            services[service.service_id] = service
+        catalog = ProviderCatalog(time.time(), services)
+        self.store(name, catalog)
+        logger.info('Catalog %s refreshed: %s services', name, len(services))
+        return catalog
+
+    def service(self, name: str, service_id: str) -> Optional[CatalogService]:
+        catalog = self.get(name)
+        return catalog.services.get(str(service_id)) if catalog is not None else None
+
+    def validate(self, name: str, service_id: str, quantity: int) -> Optional[CatalogService]:
+        '''Raise `OrderValidationError` for unknown service or quantity out of range.
+
+        Orders are not checked until the catalog is fetched.
+        '''
+        catalog = self.get(name)
+        if catalog is None:
+            return None
+        service = catalog.services.get(str(service_id))
+        if service is None:
+            raise OrderValidationError(f'Incorrect service id: {name}:{service_id}')
+        if quantity < service.min or (service.max and quantity > service.max):
+            raise OrderValidationError(
+                f'Quantity {quantity} is out of range {service.min}..{service.max} of {name}:{service_id}')
+        return service
+
+    def mismatches(self, rows) -> list[dict]:
+        '''Routing table rows (service_name, service_id, provider name) unknown to the panels'''
+        problems = []
+        for service_name, service_id, name in rows:
+            catalog = self.get(name)
+            if catalog is None:
+                continue
+            if str(service_id) not in catalog.services:
+                problems.append({
+                    'service_name': service_name,
+                    'provider': name,
+                    'service_id': service_id,
+                    'problem': 'unknown_service',
+                })
+        return problems
+
+    def stats(self, name: str) -> dict:
+        catalog = self.get(name)
+        if catalog is None:
+            return {'fetched_at': None, 'age': None, 'is_stale': True, 'services': 0}
+        age = time.time() - catalog.fetched_at
+        return {
+            'fetched_at': catalog.fetched_at,
+            'age': round(age, 1),
+            'is_stale': age > self._max_age,
+            'services': len(catalog.services),
+        }
+
+
+_catalog: Optional[ServiceCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog(config: Config = None) -> ServiceCatalog:
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            config = config or Config()
+            _catalog = ServiceCatalog(config.catalog_dir, max_age=2 * config.catalog_refresh_interval)
+        return _catalog
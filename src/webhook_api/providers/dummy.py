@@ -1,13 +1,40 @@
-import requests
+import datetime
+import html
 
-from ..models import OrderEntry
+from flask import has_app_context
+
+from ..ext import db
+from ..jobs import utcnow
+from ..models import Notification, NotificationState, OrderEntry
+from .transport import Transport
+from .utils import ProviderError
+
+__all__ = (
+    'DummyProvider',
+    'NotificationOutbox',
+    'TelegramClient',
+    'TelegramError',
+)
+
+# Characters per message allowed by Telegram
+MESSAGE_LIMIT = 4096
+
+
+class TelegramError(ProviderError):
+    '''Bot API error: {"ok": false, "error_code": ..., "description": ...}'''
+
+    def __init__(self, description: str, error_code: int = None, retry_after: float = None) -> None:
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
 
 
 class TelegramClient:
-    BASE_URL = 'https://partner.soc-proof.su/api/v2'
+    BASE_URL = 'https://api.telegram.org'
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, transport: Transport = None):
         self._token = token
+        self._transport = transport or Transport('dummy')
 
     def send_message(self, chat_id, text):
         payload = {
@@ -15,21 +42,62 @@ class TelegramClient:
             'text': text,
             'parse_mode': 'HTML',
         }
-        resp = requests.post(f'https://api.telegram.org/bot{self._token}/sendMessage', json=payload)
-        return resp.json()
+        resp = self._transport.post('sendMessage', f'{self.BASE_URL}/bot{self._token}/sendMessage', json=payload)
+        data = resp.json()
+        if not data.get('ok', True):
+            raise TelegramError(data.get('description'), data.get('error_code'),
+                                (data.get('parameters') or {}).get('retry_after'))
+        return data
+
+
+class NotificationOutbox:
+    '''Writes messages to the `notifications` outbox; delivered by `OutboxDispatcher`.
+
+    Used from dispatcher threads: rows are inserted with own connections,
+    never with the scoped session.
+    '''
+
+    table = Notification.__table__
+
+    def __init__(self, engine) -> None:
+        self._engine = engine
+
+    def put(self, chat_id, text: str, digest_key: str = None, delay: float = 0) -> int:
+        '''Queue the message. Returns notification id
+
+        digest_key: the message is a digest line; lines of the same key are grouped
+        delay: seconds the message waits for other digest lines
+        '''
+        with self._engine.begin() as conn:
+            result = conn.execute(self.table.insert().values(
+                chat_id=str(chat_id) if chat_id is not None else None,
+                text=text,
+                digest_key=digest_key,
+                state=NotificationState.pending,
+                attempts=0,
+                available_at=utcnow() + datetime.timedelta(seconds=delay),
+            ))
+        return result.inserted_primary_key[0]
 
 
 class DummyProvider:
-    '''Dummy provider. Used as fallback with echo to Telegram'''
+    '''Dummy provider. Used as fallback with echo to Telegram.
+
+    Messages go to the outbox when created within app context;
+    sent right away otherwise. With `digest_window` set, order entries
+    are queued as short digest lines sent in a few messages per order.
+    '''
 
-    def __init__(self, config) -> None:
+    def __init__(self, config, transport: Transport = None, outbox: NotificationOutbox = None) -> None:
         self._config = config
+        self._transport = transport
+        self._outbox = outbox or (NotificationOutbox(db.engine) if has_app_context() else None)
         self._client = None
 
     @property
     def client(self):
         if self._client is None:
-            self._client = TelegramClient(self.token)
+            self._client = TelegramClient(self.token, self._transport)
         return self._client
 
     @property
@@ -40,7 +108,30 @@ class DummyProvider:
     def chat_id(self):
         return self._config.get('chat_id')
 
+    @property
+    def digest_window(self) -> float:
+        return float(self._config.get('digest_window') or 0) if self._outbox is not None else 0
+
+    @staticmethod
+    def digest_line(details: OrderEntry, *tags: str) -> str:
+        '''Order entry within a digest: summary and hashtags'''
+        hashtags = [
+            f'#{details.provider_id.name}',
+            f'#{(details.order.payment_system or "").replace(".", "_")}',
+            '#payed' if details.is_payed else '#not_payed',
+            f'#service_id{details.service_id}',
+            *(['#package'] if details.is_package else []),
+            *tags,
+        ]
+        quantity = round(details.quantity * details.units_amount)
+        return (f'<b>{details.entry_id}</b> <code>{html.escape(str(details.service_name))}</code> '
+                f'{details.provider_id.name}:{details.service_id} × {quantity} {html.escape(details.url or "")}\n'
+                + ' '.join(hashtags))
+
     def describe(self, details: OrderEntry):
+        if self.digest_window:
+            self.notify(self.digest_line(details), details.order.order_id)
+            return
         text = f'''
 <b>Order entry:</b> {details.entry_id}
 <b>Service name:</b> <code>{details.service_name}</code> ({details.provider_id.name}:{details.service_id})
@@ -56,9 +147,33 @@ link={details.url}
 <pre>{details.name}</pre>
 #{details.provider_id.name} #{details.order.payment_system.replace('.', '_')} {'#payed' if details.is_payed else '#not_payed'} #service_id{details.service_id} {'#package' if details.is_package else ''}
 '''
+        self.notify(text)
+
+    def report_failure(self, details: OrderEntry):
+        '''Entry given up on: it will not be passed to a provider'''
+        if self.digest_window:
+            return self.notify(self.digest_line(details, '#failed') + f'\n{html.escape(details.error_hint or "")}',
+                               details.order.order_id)
+        text = f'''
+<b>Order entry failed:</b> {details.entry_id}
+<b>Service name:</b> <code>{html.escape(str(details.service_name))}</code> ({details.provider_id.name}:{details.service_id})
+<b>Error:</b> {html.escape(details.error_hint or '')}
+#{details.provider_id.name} #failed
+'''
+        return self.notify(text)
+
+    def notify(self, text: str, digest_key: str = None):
+        '''Outbox notification id or Telegram message id'''
+        if self._outbox is not None:
+            if digest_key is not None:
+                return self._outbox.put(self.chat_id, text, digest_key, delay=self.digest_window)
+            return self._outbox.put(self.chat_id, text)
         data = self.client.send_message(self.chat_id, text)
+        return data.get('result', {}).get('message_id')
 
     def make_order(self, details: OrderEntry):
+        if self.digest_window:
+            return self.notify(self.digest_line(details, '#unrouted'), details.order.order_id)
         text = f'''
 <b>Service name:</b> <code>{details.service_name}</code>
 
@@ -74,5 +189,4 @@ link={details.url}
 <pre>{details.name}</pre>
             '''
 
-        data = self.client.send_message(self.chat_id, text)
-        return data.get('result', {}).get('message_id')
+        return self.notify(text)
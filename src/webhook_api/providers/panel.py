@@ -0,0 +1,165 @@
+from typing import List
+
+from ..log import logger
+from ..models import OrderEntry
+from ..panels import PanelSpec
+from .balance import BalanceLedger, get_balances
+from .catalog import ServiceCatalog, get_catalog
+from .transport import Transport
+from .utils import RETRYABLE, ProviderError, classify_error, retry_on_failure
+
+__all__ = (
+    'PanelAPI',
+    'PanelAPIError',
+    'PanelProvider',
+    'panel_provider',
+)
+
+
+class PanelAPIError(ProviderError):
+    '''Error reported by the panel: {"error": "..."}'''
+
+
+class PanelAPI:
+    '''
+    Generic SMM panel "API v2" client
+    '''
+
+    def __init__(self, spec: PanelSpec, token: str, transport: Transport = None):
+        self.spec = spec
+        self._token = token
+        self._transport = transport or Transport(spec.name)
+
+    def _invoke(self, payload):
+        _payload = {
+            'key': self._token
+        }
+        _payload.update(payload)
+        try:
+            resp = self._transport.post(
+                payload.get('action'),
+                self.spec.base_url,
+                data=_payload,
+                verify=self.spec.verify,
+                timeout=self.spec.timeout,
+            )
+            resp.raise_for_status()
+            try:
+                data = resp.json()
+            except ValueError as exc:
+                self._transport.record_error(payload.get('action'), exc)
+                raise
+            if isinstance(data, dict) and 'error' in data:
+                exc = PanelAPIError(data.get('error'))
+                self._transport.record_error(payload.get('action'), exc)
+                raise exc
+            return data
+        except Exception as exc:
+            logger.error('%s API error: %s', self.spec.title or self.spec.name, exc, exc_info=exc)
+            raise exc
+
+    @retry_on_failure()
+    def status(self, order_id: str):
+        return self._invoke({
+            'action': 'status',
+            'order': str(order_id),
+        })
+
+    @retry_on_failure()
+    def multi_status(self, order_ids: List[str]):
+        return self._invoke({
+            'action': 'status',
+            'orders': ','.join(str(order_id) for order_id in order_ids),
+        })
+
+    @retry_on_failure()
+    def services(self):
+        return self._invoke({
+            'action': 'services',
+        })
+
+    @retry_on_failure()
+    def balance(self):
+        return self._invoke({
+            'action': 'balance',
+        })
+
+    # Not repeated if the order may have been placed (e.g. read timeout)
+    @retry_on_failure(idempotent=False)
+    def order(self, link: str, service_id: str, quantity: int):
+        return self._invoke({
+            'action': 'add',
+            'service': service_id,
+            'quantity': quantity,
+            'link': link,
+        })
+
+
+class PanelProvider:
+    '''Provider backed by `PanelAPI`. Concrete classes are built by `panel_provider`'''
+    spec: PanelSpec = None
+
+    def __init__(self, config: dict, transport: Transport = None, catalog: ServiceCatalog = None,
+                 balances: BalanceLedger = None) -> None:
+        self._config = config
+        self._transport = transport
+        self._catalog = catalog
+        self._balances = balances
+        self._client = None
+
+    @property
+    def token(self) -> str:
+        return self._config.get('token')
+
+    @property
+    def client(self) -> PanelAPI:
+        if self._client is None:
+            self._client = PanelAPI(self.spec, self.token, self._transport)
+        return self._client
+
+    @property
+    def catalog(self) -> ServiceCatalog:
+        return self._catalog or get_catalog()
+
+    @property
+    def balances(self) -> BalanceLedger:
+        return self._balances or get_balances()
+
+    def refresh_catalog(self):
+        return self.catalog.refresh(self.spec.name, self.client)
+
+    def poll_balance(self):
+        resp = self.client.balance()
+        return self.balances.record(self.spec.name, float(resp['balance']), resp.get('currency'))
+
+    def make_order(self, details: OrderEntry):
+        logger.info(details)
+        quantity = round(details.units_amount * details.quantity)
+        # Rejected locally: no round trip for orders the panel would refuse
+        service = self.catalog.validate(self.spec.name, details.service_id, quantity)
+        cost = service.cost(quantity) if service is not None else 0
+        if cost:
+            self.balances.debit(self.spec.name, cost)
+        try:
+            resp = self.client.order(
+                link=details.url,
+                service_id=details.service_id,
+                quantity=quantity,
+            )
+        except Exception as exc:
+            if cost and (isinstance(exc, ProviderError) or classify_error(exc) == RETRYABLE):
+                # Surely not placed
+                self.balances.credit(self.spec.name, cost)
+            raise
+        order_id = resp.get('order')
+        if order_id is None:
+            logger.error(resp.get('error'))
+            if cost:
+                self.balances.credit(self.spec.name, cost)
+        return order_id
+
+
+def panel_provider(spec: PanelSpec) -> type:
+    '''Provider class for the registered panel'''
+    name = f'{spec.title or spec.name.title()}Provider'
+    return type(name, (PanelProvider,), {'spec': spec})
@@ -0,0 +1,205 @@
+'''Per API key rate limits of provider calls.
+
+A token bucket (`rate` calls per second, up to `burst` at once) is kept in
+`RateLimitBucket` rows, so all processes using the same API key share it.
+A call reserves a token with a compare-and-swap UPDATE; the bucket may go
+negative, which queues the call until the token is refilled. Calls which
+would wait longer than `max_wait` (or past the retry scope deadline) are
+not queued: `RateLimited` with `retry_after` is raised instead, so the
+call is retried or deferred like any other retryable error.
+
+A bulkhead bounds calls in flight of this process.
+
+Limiters run in dispatcher threads: the DB is accessed with engine
+connections, never with the scoped session.
+'''
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import sqlalchemy as sa
+
+from ..log import logger
+from ..metrics import REGISTRY
+from ..models import RateLimitBucket
+from .utils import ProviderError, retry_deadline
+
+__all__ = (
+    'BucketStore',
+    'LocalBuckets',
+    'RateLimited',
+    'RateLimiter',
+)
+
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    'provider_rate_limit_wait_seconds', 'Provider call queueing by rate limiter', ('provider',),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+RATE_LIMITED = REGISTRY.counter(
+    'provider_rate_limited_total', 'Provider calls deferred by rate limiter', ('provider', 'reason'))
+IN_FLIGHT = REGISTRY.gauge(
+    'provider_calls_in_flight', 'Provider calls in progress', ('provider',))
+
+
+class RateLimited(ProviderError):
+    '''Call was not made: rate limit exceeded; retry after `retry_after` seconds'''
+
+    def __init__(self, name: str, reason: str, retry_after: float) -> None:
+        super().__init__(f'Rate limited ({reason}): {name}; retry in {retry_after:.1f}s')
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _take(tokens: float, refilled_at: float, rate: float, burst: float, now: float) -> tuple[float, float]:
+    '''(tokens left after taking one, seconds to wait for it)'''
+    tokens = min(burst, tokens + max(now - refilled_at, 0) * rate) - 1
+    return tokens, max(-tokens, 0) / rate
+
+
+class LocalBuckets:
+    '''Buckets of this process only'''
+
+    def __init__(self) -> None:
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str, rate: float, burst: float, now: float, max_wait: float) -> tuple[bool, float]:
+        '''(reserved, seconds to wait for the token)'''
+        with self._lock:
+            tokens, refilled_at = self._buckets.get(key, (burst, now))
+            tokens, wait = _take(tokens, refilled_at, rate, burst, now)
+            if wait > max_wait:
+                return False, wait
+            self._buckets[key] = (tokens, now)
+            return True, wait
+
+
+class BucketStore:
+    '''`RateLimitBucket` rows accessed with own connections'''
+
+    table = RateLimitBucket.__table__
+
+    # Reservations lost to concurrent updates before giving up
+    ATTEMPTS = 5
+
+    def __init__(self, engine) -> None:
+        self._engine = engine
+
+    def reserve(self, key: str, rate: float, burst: float, now: float, max_wait: float) -> tuple[bool, float]:
+        '''(reserved, seconds to wait for the token)'''
+        table = self.table
+        for _ in range(self.ATTEMPTS):
+            with self._engine.begin() as conn:
+                row = conn.execute(table.select().where(table.c.key == key)).first()
+                if row is None:
+                    try:
+                        with conn.begin_nested():
+                            conn.execute(table.insert().values(key=key, tokens=burst - 1, refilled_at=now, version=0))
+                    except sa.exc.IntegrityError:
+                        continue
+                    return True, 0.0
+                tokens, wait = _take(row.tokens, row.refilled_at, rate, burst, now)
+                if wait > max_wait:
+                    return False, wait
+                result = conn.execute(
+                    table.update()
+                    .where(table.c.key == key, table.c.version == row.version)
+                    .values(tokens=tokens, refilled_at=now, version=table.c.version + 1)
+                )
+                if result.rowcount == 1:
+                    return True, wait
+        # Heavy contention: the bucket is busy anyway
+        return False, 1 / rate
+
+
+class RateLimiter:
+    '''Rate limit and bulkhead of a provider API key.
+
+    rate: calls per second; 0 - unlimited
+    burst: calls allowed at once after idle time; defaults to `rate`
+    max_in_flight: calls in progress in this process; 0 - unlimited
+    max_wait: seconds a call may be queued
+    '''
+
+    # Suggested retry delay when the bulkhead is full
+    IN_FLIGHT_RETRY_AFTER = 1.0
+
+    def __init__(self, name: str, key: str = None, rate: float = 0, burst: float = None,
+                 max_in_flight: int = 0, max_wait: float = 5.0, store=None) -> None:
+        self.name = name
+        self.key = key or name
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self._store = store
+        self._local = LocalBuckets()
+        self._semaphore = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _max_wait(self) -> float:
+        deadline = retry_deadline()
+        if deadline is None:
+            return self.max_wait
+        return max(min(self.max_wait, deadline - time.monotonic()), 0)
+
+    def _reserve(self, max_wait: float) -> float:
+        now = time.time()
+        reserved, wait = None, 0.0
+        if self._store is not None:
+            try:
+                reserved, wait = self._store.reserve(self.key, self.rate, self.burst, now, max_wait)
+            except Exception as exc:
+                logger.warning('Unable to reserve %s rate limit token: %s', self.name, exc)
+        if reserved is None:
+            reserved, wait = self._local.reserve(self.key, self.rate, self.burst, now, max_wait)
+        if not reserved:
+            RATE_LIMITED.inc(provider=self.name, reason='rate')
+            raise RateLimited(self.name, 'rate', wait)
+        return wait
+
+    @contextmanager
+    def slot(self):
+        '''Wait for a bulkhead slot and a token; raise `RateLimited` if it takes too long
+
+        The slot is taken first: a call rejected by the bulkhead does not
+        consume the token shared by all processes.
+        '''
+        max_wait = self._max_wait()
+        started = time.monotonic()
+        if self._semaphore is not None:
+            if not self._semaphore.acquire(timeout=max_wait):
+                RATE_LIMITED.inc(provider=self.name, reason='in_flight')
+                raise RateLimited(self.name, 'in_flight', self.IN_FLIGHT_RETRY_AFTER)
+            max_wait = max(max_wait - (time.monotonic() - started), 0)
+        if self.rate:
+            try:
+                wait = self._reserve(max_wait)
+            except RateLimited:
+                if self._semaphore is not None:
+                    self._semaphore.release()
+                raise
+            if wait:
+                time.sleep(wait)
+        RATE_LIMIT_WAIT_SECONDS.observe(time.monotonic() - started, provider=self.name)
+        with self._lock:
+            self._in_flight += 1
+            IN_FLIGHT.set(self._in_flight, provider=self.name)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                IN_FLIGHT.set(self._in_flight, provider=self.name)
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+        }
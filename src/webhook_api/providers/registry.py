@@ -0,0 +1,162 @@
+import hashlib
+import os
+import threading
+from typing import Optional
+
+from flask import has_app_context
+
+from ..config import Config
+from ..ext import db
+from ..log import logger
+from ..models import Providers, ServiceProvider
+from . import get_provider
+from .breaker import BreakerStore, CircuitBreaker
+from .ratelimit import BucketStore, RateLimiter
+from .transport import Transport, build_session
+
+__all__ = (
+    'ProviderRegistry',
+    'get_registry',
+)
+
+
+class ProviderRegistry:
+    '''Long-lived provider instances, one pooled transport per provider
+
+    engine: keeps breaker and rate limit state shared by all processes;
+            taken from the app context when not given
+    '''
+
+    def __init__(self, config: Config, engine=None) -> None:
+        self._config = config
+        self._engine = engine
+        self._providers = {}
+        self._transports: dict[str, Transport] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        '''Engine of the shared state; None - state is local to the process'''
+        if self._engine is None and has_app_context():
+            self._engine = db.engine
+        return self._engine
+
+    def transport(self, provider_id: Providers) -> Transport:
+        with self._lock:
+            transport = self._transports.get(provider_id.name)
+            if transport is None:
+                # Pool never holds less connections than dispatcher may use
+                maxsize = max(self._config.http_pool_maxsize,
+                              self._config.get_provider_concurrency(provider_id))
+                if self.engine is None:
+                    logger.warning('%s breaker and rate limit are not shared: no database engine', provider_id.name)
+                transport = Transport(provider_id.name, build_session(pool_maxsize=maxsize),
+                                      breaker=self.breaker(provider_id),
+                                      limiter=self.limiter(provider_id, maxsize))
+                self._transports[provider_id.name] = transport
+            return transport
+
+    def breaker(self, provider_id: Providers) -> CircuitBreaker:
+        '''Breaker state is shared through the DB when the engine is known'''
+        config = self._config
+        return CircuitBreaker(
+            provider_id.name,
+            store=BreakerStore(self.engine) if self.engine is not None else None,
+            window=config.breaker_window,
+            min_calls=config.breaker_min_calls,
+            failure_rate=config.breaker_failure_rate,
+            slow_call=config.breaker_slow_call,
+            slow_rate=config.breaker_failure_rate,
+            open_seconds=config.breaker_open_seconds,
+            sync_interval=config.breaker_sync_interval,
+        )
+
+    def limiter(self, provider_id: Providers, max_in_flight: int) -> RateLimiter:
+        '''Rate limit is shared by the processes using the same API key'''
+        config = self._config
+        rate, burst = config.get_provider_rate_limit(provider_id)
+        token = config.get_provider_config(provider_id).get('token') or ''
+        return RateLimiter(
+            provider_id.name,
+            key=f'{provider_id.name}:{hashlib.sha256(token.encode()).hexdigest()[:16]}',
+            rate=rate,
+            burst=burst,
+            max_in_flight=config.get_provider_max_in_flight(provider_id) or max_in_flight,
+            max_wait=config.rate_limit_max_wait,
+            store=BucketStore(self.engine) if self.engine is not None else None,
+        )
+
+    def get(self, provider_id: Providers):
+        '''Cached provider instance'''
+        provider = self._providers.get(provider_id.name)
+        if provider is not None:
+            return provider
+        Provider = get_provider(provider_id)
+        transport = self.transport(provider_id)
+        with self._lock:
+            provider = self._providers.get(provider_id.name)
+            if provider is None:
+                provider = Provider(self._config.get_provider_config(provider_id), transport)
+                self._providers[provider_id.name] = provider
+            return provider
+
+    def rank(self, candidates) -> list[ServiceProvider]:
+        '''Candidates in order of preference.
+
+        Providers with open circuit breaker go last, then providers whose
+        average latency exceeds the slow call threshold; configured order
+        is kept otherwise. Providers not called yet are considered healthy.
+        '''
+        slow_call = self._config.breaker_slow_call
+        with self._lock:
+            transports = dict(self._transports)
+
+        def _key(item):
+            priority, candidate = item
+            transport = transports.get(candidate.provider_id.name)
+            if transport is None:
+                return False, False, priority
+            is_slow = transport.latency is not None and transport.latency >= slow_call
+            return not transport.is_available, is_slow, priority
+
+        return [candidate for _, candidate in sorted(enumerate(candidates), key=_key)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            transports = dict(self._transports)
+        return {name: transport.stats() for name, transport in transports.items()}
+
+    def breakers(self) -> dict:
+        with self._lock:
+            transports = dict(self._transports)
+        return {
+            name: {**(transport.breaker_stats() or {}), 'latency': transport.latency}
+            for name, transport in transports.items()
+        }
+
+    def limits(self) -> dict:
+        with self._lock:
+            transports = dict(self._transports)
+        return {name: transport.limiter_stats() for name, transport in transports.items()}
+
+    def close(self) -> None:
+        with self._lock:
+            for transport in self._transports.values():
+                transport.session.close()
+            self._transports.clear()
+            self._providers.clear()
+
+
+_registry: Optional[ProviderRegistry] = None
+_registry_pid: Optional[int] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(config: Config = None) -> ProviderRegistry:
+    '''Process-wide registry. Recreated after fork: pools are not shared between processes'''
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = ProviderRegistry(config or Config(), db.engine if has_app_context() else None)
+            _registry_pid = os.getpid()
+        return _registry
@@ -1,9 +0,0 @@
-
-__all__ = (
-
-)
-
-JUSTANOTHERPANEL = 'justanotherpanel'
-SOCPROOF = 'socproof'
-PROSMMSTORE = 'prosmmstore'
-FXSMMSOC = 'fxsmmsoc'
@@ -0,0 +1,129 @@
+import contextlib
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..metrics import PROVIDER_ERRORS, PROVIDER_REQUEST_SECONDS, REGISTRY
+from .ratelimit import RateLimited
+
+__all__ = (
+    'Transport',
+    'build_session',
+    'session_stats',
+)
+
+
+def build_session(pool_connections: int = 2, pool_maxsize: int = 10,
+                  pool_block: bool = True) -> requests.Session:
+    '''Keep-alive session with a bounded connection pool.
+
+    pool_connections: amount of cached per-host pools
+    pool_maxsize: connections kept alive per host
+    pool_block: never open more than `pool_maxsize` connections to a host
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=0,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_stats(session: requests.Session) -> dict:
+    '''Connection reuse for each host the session talked to'''
+    hosts = {}
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = getattr(adapter, 'poolmanager', None)
+        if pools is None:
+            continue
+        for key in list(pools.pools.keys()):
+            pool = pools.pools.get(key)
+            if pool is None:
+                continue
+            requests_total = pool.num_requests
+            connections = pool.num_connections
+            hosts[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'requests': requests_total,
+                'connections': connections,
+                'idle': pool.pool.qsize() if pool.pool is not None else 0,
+                'reuse_rate': round(1 - connections / requests_total, 3) if requests_total else None,
+            }
+    return hosts
+
+
+class Transport:
+    '''HTTP transport shared by every provider client.
+
+    Single place for cross-cutting call handling
+    (connection pooling, limits, instrumentation).
+    '''
+
+    # Smoothing factor of call latency average
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, name: str, session: requests.Session = None, breaker=None, limiter=None) -> None:
+        self.name = name
+        self.session = session or requests.Session()
+        self.breaker = breaker
+        self.limiter = limiter
+        self.latency: Optional[float] = None  # Exponentially weighted moving average; seconds
+
+    def post(self, action: str, url: str, **kwargs) -> requests.Response:
+        REGISTRY.touch()
+        try:
+            probe = self.breaker.before_call() if self.breaker is not None else False
+        except Exception as exc:
+            self.record_error(action, exc)
+            raise
+        try:
+            with (self.limiter.slot() if self.limiter is not None else contextlib.nullcontext()):
+                return self._post(action, url, probe, **kwargs)
+        except RateLimited as exc:
+            self.record_error(action, exc)
+            raise
+
+    def _post(self, action: str, url: str, probe: bool, **kwargs) -> requests.Response:
+        started = time.perf_counter()
+        failed = True
+        try:
+            resp = self.session.post(url, **kwargs)
+            # Panel is down or overloaded; client errors are not counted
+            failed = resp.status_code >= 500 or resp.status_code == 429
+        except Exception as exc:
+            self.record_error(action, exc)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            PROVIDER_REQUEST_SECONDS.observe(duration, provider=self.name, action=action)
+            self.latency = duration if self.latency is None \
+                else self.latency + self.LATENCY_ALPHA * (duration - self.latency)
+            if self.breaker is not None:
+                self.breaker.record(duration, failed, probe)
+        if resp.status_code >= 400:
+            PROVIDER_ERRORS.inc(provider=self.name, action=action, error=f'HTTP{resp.status_code // 100}xx')
+        return resp
+
+    def record_error(self, action: str, exc: Exception) -> None:
+        '''Count failed call by error class'''
+        PROVIDER_ERRORS.inc(provider=self.name, action=action, error=type(exc).__name__)
+
+    def stats(self) -> dict:
+        return session_stats(self.session)
+
+    def breaker_stats(self) -> Optional[dict]:
+        return self.breaker.stats() if self.breaker is not None else None
+
+    def limiter_stats(self) -> Optional[dict]:
+        return self.limiter.stats() if self.limiter is not None else None
+
+    @property
+    def is_available(self) -> bool:
+        '''Calls are not rejected by the circuit breaker'''
+        return self.breaker is None or self.breaker.is_closed
@@ -1,28 +1,212 @@
+import contextvars
+import dataclasses
+import email.utils
+import random
 import time
+from contextlib import contextmanager
 from functools import wraps
+from typing import Optional
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from ..log import logger
+from ..metrics import PROVIDER_ATTEMPTS, PROVIDER_RETRIES
 
 __all__ = (
+    'AMBIGUOUS',
+    'FATAL',
+    'RETRYABLE',
+    'ProviderError',
+    'ProviderUnavailable',
+    'RetryLater',
+    'backoff_delay',
+    'classify_error',
+    'retry_deadline',
     'retry_on_failure',
+    'retry_scope',
+)
+
+# Request surely was not processed: safe to repeat
+RETRYABLE = 'retryable'
+# Request may have been processed (e.g. read timeout): repeated for idempotent calls only
+AMBIGUOUS = 'ambiguous'
+FATAL = 'fatal'
+
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 503})
+AMBIGUOUS_STATUSES = frozenset({500, 502, 504})
+
+# Panel error messages (lowercase) worth another attempt
+RETRYABLE_PANEL_ERRORS = (
+    'active order with this link',
+    'too many requests',
+    'try again',
+    'temporarily',
 )
 
 
-def retry_on_failure(attempts: int = 2, delay: float = 0.2):
+class ProviderError(Exception):
+    '''Error reported by the provider API'''
+
+
+class ProviderUnavailable(ProviderError):
+    '''Call was not made: the provider is suspended for `retry_after` seconds.
+
+    Not waited for inline, so the caller fails over at once; deferred work
+    is rescheduled instead.
+    '''
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RetryLater(Exception):
+    '''Retryable failure in deferred mode: reschedule the work after `delay` seconds.
+
+    The original exception is available as `error` (and `__cause__`).
+    '''
+
+    def __init__(self, delay: float, error: Exception = None) -> None:
+        super().__init__(str(error) if error is not None else 'Retry later')
+        self.delay = delay
+        self.error = error
+
+
+@dataclasses.dataclass(frozen=True)
+class _RetryScope:
+    deadline: Optional[float] = None  # time.monotonic()
+    defer: bool = False
+
+
+_retry_scope: contextvars.ContextVar = contextvars.ContextVar('retry_scope', default=_RetryScope())
+
+
+@contextmanager
+def retry_scope(deadline: float = None, defer: bool = False):
+    '''Retry settings of the current context (thread).
+
+    deadline: `time.monotonic()` value; no waits past it
+    defer: raise `RetryLater` on retryable errors instead of waiting
+    '''
+    token = _retry_scope.set(_RetryScope(deadline, defer))
+    try:
+        yield
+    finally:
+        _retry_scope.reset(token)
+
+
+def retry_deadline() -> Optional[float]:
+    '''Deadline (`time.monotonic()`) of the current retry scope'''
+    return _retry_scope.get().deadline
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 5.0) -> float:
+    '''Exponential backoff with jitter: half of the delay is random'''
+    delay = min(cap, base * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    '''`Retry-After` header of HTTP error response'''
+    if getattr(exc, 'retry_after', None) is not None:
+        # Circuit breaker is open
+        return exc.retry_after
+    response = getattr(exc, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(parsed.timestamp() - time.time(), 0)
+
+
+def _is_not_connected(exc: requests.ConnectionError) -> bool:
+    '''Connection was never established (refused, DNS failure): request was not sent'''
+    reason = exc.args[0] if exc.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    # NameResolutionError is a NewConnectionError
+    return isinstance(reason, NewConnectionError)
+
+
+def classify_error(exc: Exception) -> str:
+    if isinstance(exc, requests.ConnectTimeout):
+        return RETRYABLE
+    if isinstance(exc, requests.ConnectionError) and _is_not_connected(exc):
+        return RETRYABLE
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return AMBIGUOUS
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        if status in RETRYABLE_STATUSES:
+            return RETRYABLE
+        if status in AMBIGUOUS_STATUSES:
+            return AMBIGUOUS
+        return FATAL
+    if getattr(exc, 'retry_after', None) is not None:
+        return RETRYABLE
+    if isinstance(exc, ProviderError):
+        message = str(exc).lower()
+        return RETRYABLE if any(error in message for error in RETRYABLE_PANEL_ERRORS) else FATAL
+    if isinstance(exc, ValueError):
+        # Not a JSON response: gateway error page
+        return AMBIGUOUS
+    return FATAL
+
+
+def retry_on_failure(attempts: int = 3, base_delay: float = 0.2, max_delay: float = 5.0,
+                     idempotent: bool = True):
+    '''Repeat the call on retryable errors.
+
+    Waits grow exponentially (with jitter) within the deadline of
+    `retry_scope`; in deferred scope `RetryLater` is raised instead of
+    waiting. Fatal errors and the last error are re-raised as is.
+    Non-idempotent calls are not repeated on ambiguous errors, nor
+    outside deferred scope `ProviderUnavailable` ones.
+    '''
     def wrapper(func):
+        operation = getattr(func, '__qualname__', repr(func))
+
         @wraps(func)
         def wrapped(*args, **kwargs):
-            message = ''
-            for _ in range(attempts):
+            scope = _retry_scope.get()
+            attempt = 0
+            while True:
+                attempt += 1
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
                 except Exception as exc:
-                    if 'Invalid API key' in str(exc):
-                        logger.error('>>> Invalid API key: %s', exc)
-                        raise exc
-                    logger.warning('exc: %s', exc, exc_info=exc)
-                    message = str(exc)
+                    kind = classify_error(exc)
+                    if kind == FATAL or (kind == AMBIGUOUS and not idempotent):
+                        PROVIDER_ATTEMPTS.inc(operation=operation, outcome='fatal')
+                        raise
+                    if isinstance(exc, ProviderUnavailable) and not scope.defer:
+                        PROVIDER_ATTEMPTS.inc(operation=operation, outcome='unavailable')
+                        raise
+                    delay = max(backoff_delay(attempt, base_delay, max_delay), _retry_after(exc) or 0)
+                    if scope.defer:
+                        PROVIDER_ATTEMPTS.inc(operation=operation, outcome='deferred')
+                        logger.warning('%s deferred for %.1fs: %s', operation, delay, exc)
+                        raise RetryLater(delay, exc) from exc
+                    if attempt >= attempts \
+                            or (scope.deadline is not None and time.monotonic() + delay > scope.deadline):
+                        PROVIDER_ATTEMPTS.inc(operation=operation, outcome='exhausted')
+                        logger.error('%s failed after %s attempts: %s', operation, attempt, exc)
+                        raise
+                    PROVIDER_ATTEMPTS.inc(operation=operation, outcome='retry')
+                    PROVIDER_RETRIES.inc(operation=operation)
+                    logger.warning('%s attempt %s failed, retry in %.2fs: %s',
+                                   operation, attempt, delay, exc, exc_info=exc)
                     time.sleep(delay)
-            raise Exception(f'Attempts limit exceeded: {message}')
+                else:
+                    PROVIDER_ATTEMPTS.inc(operation=operation, outcome='ok')
+                    return result
         return wrapped
     return wrapper
@@ -0,0 +1,262 @@
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+from .config import Config
+from .ext import db
+from .log import logger
+from .matching import FuzzyMatch, TrigramIndex, normalize_service_name
+from .metrics import REGISTRY
+from .models import Providers, Revision, ServiceDescription, ServiceProvider
+from .providers import is_valid_row, row_candidates
+
+__all__ = (
+    'ROUTING_REVISION',
+    'RoutingCache',
+    'ServicesDiff',
+    'get_routing_cache',
+    'match_logger',
+    'routing_rows',
+    'update_services',
+)
+
+# `Revision` row bumped with every `service_description` change
+ROUTING_REVISION = 'service_description'
+
+# Names matched to services by similarity; review and add them to the sheet
+match_logger = logging.getLogger('webhook_api.service_matches')
+
+SERVICE_MATCHES = REGISTRY.counter(
+    'service_name_misses_total', 'Service names missing from the routing table', ('outcome',))
+
+# Distinct unknown names remembered per table revision
+MATCH_CACHE_SIZE = 1024
+
+
+class _RoutingTable(NamedTuple):
+    '''Services by key and the fuzzy matcher of the same revision; replaced as a whole'''
+    index: dict[str, tuple[ServiceProvider, ...]]
+    match: Callable[[str], Optional[FuzzyMatch]]
+
+
+class RoutingCache:
+    '''In-process copy of services routing table.
+
+    Every process checks `Revision(ROUTING_REVISION)` at most once per
+    `check_interval` and reloads the table when it was bumped elsewhere.
+
+    Services are looked up by normalized name. Unknown names are routed to
+    the most similar service when the similarity is at least
+    `fuzzy_threshold` (0 - never); either way they are logged to
+    `match_logger` once per table revision (while among the last
+    `MATCH_CACHE_SIZE` unknown names).
+    '''
+
+    def __init__(self, check_interval: float = 1.0, fuzzy_threshold: float = 0.9) -> None:
+        self._check_interval = check_interval
+        self._fuzzy_threshold = fuzzy_threshold
+        self._table = self._build({})
+        self._revision: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fuzzy_hits = 0
+        self.reloads = 0
+
+    @staticmethod
+    def load() -> dict[str, tuple[ServiceProvider, ...]]:
+        '''Provider candidates of each service in priority order'''
+        rows = db.session.execute(
+            db.select(ServiceDescription.service_name,
+                      ServiceDescription.service_key,
+                      ServiceDescription.service_id,
+                      ServiceDescription.provider_id)
+            .order_by(ServiceDescription.priority, ServiceDescription.id)
+        ).all()
+        index = {}
+        for service_name, service_key, service_id, provider_id in rows:
+            # Rows written before `service_key` was introduced
+            key = service_key or normalize_service_name(service_name)
+            index[key] = index.get(key, ()) + (ServiceProvider(service_name, service_id, provider_id),)
+        return index
+
+    def _build(self, index: dict[str, tuple[ServiceProvider, ...]]) -> _RoutingTable:
+        trigrams = TrigramIndex(index)
+
+        @functools.lru_cache(maxsize=MATCH_CACHE_SIZE)
+        def _match(key: str) -> Optional[FuzzyMatch]:
+            '''The most similar configured service of an unknown key; logged when computed'''
+            match = trigrams.match(key)
+            if self._is_routed(match):
+                match_logger.warning('Service %r routed as %r (similarity %.2f)', key, match.key, match.score)
+            elif match is not None:
+                match_logger.warning('Service %r is not routed; closest is %r (similarity %.2f)',
+                                     key, match.key, match.score)
+            else:
+                match_logger.warning('Service %r is not routed', key)
+            return match
+
+        return _RoutingTable(index, _match)
+
+    def table(self) -> _RoutingTable:
+        now = time.monotonic()
+        if self._revision is not None and now - self._checked_at < self._check_interval:
+            return self._table
+        with self._lock:
+            if self._revision is None or now - self._checked_at >= self._check_interval:
+                revision = Revision.get_value(ROUTING_REVISION)
+                if revision != self._revision:
+                    self._table = self._build(self.load())
+                    self._revision = revision
+                    self.reloads += 1
+                    logger.info('Routing table reloaded: revision=%s services=%s',
+                                revision, len(self._table.index))
+                self._checked_at = now
+        return self._table
+
+    def index(self) -> dict[str, tuple[ServiceProvider, ...]]:
+        return self.table().index
+
+    def _is_routed(self, match: Optional[FuzzyMatch]) -> bool:
+        return match is not None and bool(self._fuzzy_threshold) and match.score >= self._fuzzy_threshold
+
+    def candidates(self, service_name: str) -> tuple[ServiceProvider, ...]:
+        '''Configured providers of the service; unknown services go to dummy'''
+        key = normalize_service_name(service_name)
+        # Index and matcher of one revision: a concurrent reload replaces both
+        table = self.table()
+        candidates = table.index.get(key)
+        if candidates:
+            self.hits += 1
+            return candidates
+        match = table.match(key)
+        if self._is_routed(match):
+            self.fuzzy_hits += 1
+            SERVICE_MATCHES.inc(outcome='routed')
+            return table.index[match.key]
+        self.misses += 1
+        SERVICE_MATCHES.inc(outcome='unrouted')
+        return (ServiceProvider(service_name, None, Providers['dummy']),)
+
+    def resolve(self, service_name: str) -> ServiceProvider:
+        '''Primary provider'''
+        return self.candidates(service_name)[0]
+
+    def invalidate(self) -> None:
+        '''Reload on next lookup (this process only)'''
+        with self._lock:
+            self._revision = None
+
+    @staticmethod
+    def bump(checksum: str = None) -> None:
+        '''Mark routing table changed for every process. Commit with the change'''
+        Revision.bump(ROUTING_REVISION, checksum)
+
+    def stats(self) -> dict:
+        return {
+            'revision': self._revision,
+            'services': len(self._table.index),
+            'hits': self.hits,
+            'misses': self.misses,
+            'fuzzy_hits': self.fuzzy_hits,
+            'reloads': self.reloads,
+        }
+
+
+_routing_cache: Optional[RoutingCache] = None
+_routing_lock = threading.Lock()
+
+
+def get_routing_cache(config: Config = None) -> RoutingCache:
+    global _routing_cache
+    with _routing_lock:
+        if _routing_cache is None:
+            config = config or Config()
+            _routing_cache = RoutingCache(config.routing_check_interval, config.service_match_threshold)
+        return _routing_cache
+
+
+class ServicesDiff(NamedTuple):
+    checksum: str
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    skipped: bool = False
+
+    def as_dict(self) -> dict:
+        return self._asdict()
+
+
+def routing_rows(rows: list) -> dict[tuple[str, int], tuple[str, Providers, str]]:
+    '''(service_id, provider, service key) by (service name, priority) of the sheet rows.
+
+    Invalid rows are skipped; of rows with the same normalized service name the first one wins.
+    '''
+    routes = {}
+    keys = set()
+    for row in rows:
+        if not is_valid_row(row):
+            continue
+        service_name = str(row[0]).lower().strip()
+        service_key = normalize_service_name(service_name)
+        if service_key in keys:
+            continue
+        keys.add(service_key)
+        # [service_name, service_id, provider, alt_service_id, alt_provider, ...]
+        for priority, (service_id, provider_id) in enumerate(row_candidates(row)):
+            routes[service_name, priority] = (str(service_id), Providers[provider_id], service_key)
+    return routes
+
+
+def _checksum(routes: dict[tuple[str, int], tuple[str, Providers, str]]) -> str:
+    content = sorted([name, priority, service_id, provider_id.name, service_key]
+                     for (name, priority), (service_id, provider_id, service_key) in routes.items())
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False).encode()).hexdigest()
+
+
+def update_services(rows: list) -> ServicesDiff:
+    '''Bring `service_description` to the sheet rows with the least changes. Caller commits.
+
+    The table is never empty meanwhile: only changed rows are inserted,
+    updated or deleted, each kind with a single statement. A push identical
+    to the last applied one (same content hash) changes nothing.
+    '''
+    routes = routing_rows(rows)
+    checksum = _checksum(routes)
+    # Concurrent pushes are applied one by one
+    applied = db.session.execute(
+        db.select(Revision.checksum).filter_by(name=ROUTING_REVISION).with_for_update()
+    ).scalar()
+    if applied == checksum:
+        return ServicesDiff(checksum, skipped=True)
+
+    updates, deletes = [], []
+    for row_id, service_name, priority, service_id, provider_id, service_key in db.session.execute(
+            db.select(ServiceDescription.id, ServiceDescription.service_name, ServiceDescription.priority,
+                      ServiceDescription.service_id, ServiceDescription.provider_id,
+                      ServiceDescription.service_key)):
+        route = routes.pop((service_name, priority), None)
+        if route is None:
+            deletes.append(row_id)
+        elif route != (service_id, provider_id, service_key):
+            updates.append({'id': row_id, 'service_id': route[0], 'provider_id': route[1], 'service_key': route[2]})
+    inserts = [
+        {'service_name': service_name, 'priority': priority, 'service_id': service_id,
+         'provider_id': provider_id, 'service_key': service_key}
+        for (service_name, priority), (service_id, provider_id, service_key) in routes.items()
+    ]
+
+    if deletes:
+        db.session.execute(db.delete(ServiceDescription).where(ServiceDescription.id.in_(deletes)))
+    if updates:
+        db.session.execute(db.update(ServiceDescription), updates)
+    if inserts:
+        db.session.execute(db.insert(ServiceDescription), inserts)
+    RoutingCache.bump(checksum)
+    logger.info('Services updated: inserted=%s updated=%s deleted=%s', len(inserts), len(updates), len(deletes))
+    return ServicesDiff(checksum, len(inserts), len(updates), len(deletes))
@@ -0,0 +1,137 @@
+'''Order statuses for `/api/v1/status`.
+
+Orders and their entries are read with a single joined query of the
+columns the response needs (`Order.raw_data` is never loaded). ETag is
+derived from the entries' last state changes, so unchanged orders are
+answered with `304 Not Modified` before anything is serialized.
+The same ETag is the position of `/api/v1/status/wait` and
+`/api/v1/status/stream` clients waiting for changes.
+'''
+import hashlib
+from typing import NamedTuple
+
+from .ext import db
+from .models import Order, OrderEntry, OrderEntryState
+from .sync import OPEN_STATES
+
+__all__ = (
+    'MAX_BATCH_SIZE',
+    'OrderStatus',
+    'is_settled',
+    'load_statuses',
+    'requested_order_ids',
+    'status_etag',
+    'status_result',
+)
+
+# Order ids per request
+MAX_BATCH_SIZE = 100
+
+# Entries which are expected to change
+UNSETTLED_STATES = (OrderEntryState.created, *OPEN_STATES)
+
+
+class OrderStatus(NamedTuple):
+    pk: int
+    order_id: str
+    created_at: object
+    total: int
+    entries: list  # Rows: entry_id, state, error_hint, state_changed_at, provider_id, provider_order_id
+
+    def as_dict(self, live: dict = None) -> dict:
+        '''live: provider statuses by (provider id, provider order id)'''
+        entries = []
+        for entry in self.entries:
+            entries.append({
+                'entryId': entry.entry_id,
+                'state': str(entry.state.name),
+                'message': str(entry.error_hint or ''),
+            })
+            key = (entry.provider_id, str(entry.provider_order_id))
+            if live is not None and key in live:
+                entries[-1]['live'] = live[key]
+        return {
+            'orderId': self.order_id,
+            'entries': entries,
+            'createdAt': self.created_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'total': self.total,
+        }
+
+
+def load_statuses(order_ids: list[str]) -> dict[str, OrderStatus]:
+    '''Found orders by Tilda order id, in order of creation'''
+    rows = db.session.execute(
+        db.select(Order.id, Order.order_id, Order.created_at, Order.orders_amount,
+                  OrderEntry.entry_id, OrderEntry.state, OrderEntry.error_hint, OrderEntry.state_changed_at,
+                  OrderEntry.provider_id, OrderEntry.provider_order_id)
+        .outerjoin(OrderEntry, OrderEntry.order_id == Order.id)
+        .where(Order.order_id.in_([str(order_id) for order_id in order_ids]))
+        .order_by(Order.id, OrderEntry.id)
+    ).all()
+    statuses = {}
+    for row in rows:
+        status = statuses.get(row.order_id)
+        if status is None:
+            status = statuses[row.order_id] = OrderStatus(row.id, row.order_id, row.created_at,
+                                                          row.orders_amount, [])
+        if row.entry_id is not None:
+            status.entries.append(row)
+    return statuses
+
+
+def status_etag(statuses: dict[str, OrderStatus], *variant) -> str:
+    '''Changes with any entry state (or error hint) change
+
+    variant: other response options (e.g. requested order ids)
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(variant).encode())
+    for status in statuses.values():
+        changed_at = max((entry.state_changed_at for entry in status.entries if entry.state_changed_at),
+                         default=None)
+        digest.update(f'{status.order_id}:{len(status.entries)}:{changed_at};'.encode())
+    return digest.hexdigest()
+
+
+def requested_order_ids(data) -> tuple[list[str], bool]:
+    '''Requested order ids and whether it is a batch request
+
+    data: request JSON or args; `orderId` or `orderIds` (a list or comma separated)
+    Raises ValueError for bad requests
+    '''
+    order_id = data.get('orderId')
+    order_ids = data.get('orderIds')
+    if isinstance(order_ids, str):
+        order_ids = [part.strip() for part in order_ids.split(',') if part.strip()]
+    if order_id is None and not order_ids:
+        raise ValueError('orderId missing')
+    if order_ids is None:
+        return [str(order_id)], False
+    if not isinstance(order_ids, list) or len(order_ids) > MAX_BATCH_SIZE:
+        raise ValueError(f'orderIds must be a list of up to {MAX_BATCH_SIZE} ids')
+    return [str(_id) for _id in order_ids], True
+
+
+def status_result(statuses: dict[str, OrderStatus], requested: list[str], is_batch: bool,
+                  live: dict = None) -> dict:
+    '''Response body
+
+    live: provider statuses of the entries, see `LiveStatus.lookup`
+    '''
+    if is_batch:
+        return {
+            'status': 'ok',
+            'result': [status.as_dict(live) for status in statuses.values()],
+            'notFound': [_id for _id in requested if _id not in statuses],
+        }
+    status = statuses.get(requested[0])
+    return {
+        'status': 'ok',
+        'result': status.as_dict(live) if status is not None else 'Not found',
+    }
+
+
+def is_settled(statuses: dict[str, OrderStatus], requested: list[str]) -> bool:
+    '''All the orders exist and none of their entries is going to change'''
+    return all(_id in statuses for _id in requested) and not any(
+        entry.state in UNSETTLED_STATES for status in statuses.values() for entry in status.entries)
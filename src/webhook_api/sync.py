@@ -0,0 +1,151 @@
+import itertools
+import zlib
+from collections import defaultdict
+from typing import Iterator, NamedTuple
+
+from .config import Config
+from .dispatcher import OrderDispatcher, get_dispatcher
+from .events import publish
+from .ext import db
+from .jobs import utcnow
+from .log import logger
+from .metrics import ORDER_ENTRY_TRANSITIONS
+from .models import Order, OrderEntry, OrderEntryState, Providers
+from .panels import PANELS
+from .providers.registry import ProviderRegistry, get_registry
+
+__all__ = (
+    'OPEN_STATES',
+    'PANEL_STATES',
+    'StatusSynchronizer',
+)
+
+# Entries accepted by provider but not finished yet
+OPEN_STATES = (
+    OrderEntryState.fulfilled,
+    OrderEntryState.in_progress,
+)
+
+# Panel "status" field; lowercase
+PANEL_STATES = {
+    'pending': OrderEntryState.in_progress,
+    'in progress': OrderEntryState.in_progress,
+    'processing': OrderEntryState.in_progress,
+    'partial': OrderEntryState.partial,
+    'canceled': OrderEntryState.canceled,
+    'cancelled': OrderEntryState.canceled,
+    'completed': OrderEntryState.completed,
+}
+
+# pg_try_advisory_xact_lock key; one synchronization at a time
+SYNC_LOCK_KEY = zlib.crc32(b'webhook_api.sync')
+
+
+class _OpenEntry(NamedTuple):
+    id: int
+    provider_order_id: str
+    state: OrderEntryState
+
+
+class _Batch(NamedTuple):
+    provider_id: Providers
+    entries: tuple[_OpenEntry, ...]
+
+
+def _chunks(entries: list, size: int) -> Iterator[tuple]:
+    iterator = iter(entries)
+    while chunk := tuple(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class StatusSynchronizer:
+    '''Pulls order states from panels with batched `multi_status` requests.
+
+    Open entries are grouped by provider and split into the largest
+    batches the panel accepts (`PanelSpec.max_status_batch`). Batches run
+    concurrently within provider concurrency limits; states are stored
+    with a single bulk UPDATE.
+    '''
+
+    def __init__(self, config: Config, registry: ProviderRegistry = None,
+                 dispatcher: OrderDispatcher = None, page_size: int = 5000) -> None:
+        self._config = config
+        self._registry = registry or get_registry(config)
+        self._dispatcher = dispatcher or get_dispatcher(config)
+        self._page_size = page_size
+
+    def open_entries(self) -> dict[Providers, list[_OpenEntry]]:
+        panels = [Providers[name] for name in PANELS]
+        rows = db.session.execute(
+            db.select(OrderEntry.id, OrderEntry.provider_id,
+                      OrderEntry.provider_order_id, OrderEntry.state)
+            .where(OrderEntry.state.in_(OPEN_STATES),
+                   OrderEntry.provider_id.in_(panels),
+                   OrderEntry.provider_order_id.is_not(None))
+            .order_by(OrderEntry.id)
+            .execution_options(yield_per=self._page_size)
+        )
+        entries = defaultdict(list)
+        for entry_id, provider_id, provider_order_id, state in rows:
+            entries[provider_id].append(_OpenEntry(entry_id, str(provider_order_id), state))
+        return entries
+
+    def batches(self, entries: dict[Providers, list[_OpenEntry]]) -> list[_Batch]:
+        batches = []
+        for provider_id, provider_entries in entries.items():
+            size = PANELS[provider_id.name].max_status_batch
+            batches.extend(_Batch(provider_id, chunk) for chunk in _chunks(provider_entries, size))
+        return batches
+
+    def _fetch(self, batch: _Batch, provider) -> dict:
+        '''Executed in dispatcher thread'''
+        with self._dispatcher.slot(batch.provider_id):
+            return provider.client.multi_status([entry.provider_order_id for entry in batch.entries])
+
+    @staticmethod
+    def resolve_state(details) -> OrderEntryState:
+        if not isinstance(details, dict) or 'error' in details:
+            return None
+        return PANEL_STATES.get(str(details.get('status', '')).strip().lower())
+
+    def _try_lock(self) -> bool:
+        if db.session.get_bind().dialect.name != 'postgresql':
+            return True
+        return bool(db.session.execute(
+            db.select(db.func.pg_try_advisory_xact_lock(SYNC_LOCK_KEY))
+        ).scalar())
+
+    def run(self) -> int:
+        '''Synchronize all open entries. Returns amount of changed entries'''
+        if not self._try_lock():
+            logger.info('Status synchronization is running elsewhere')
+            db.session.rollback()
+            return 0
+
+        batches = self.batches(self.open_entries())
+        # Resolved within app context: transports built here share breakers and rate limits
+        providers = {provider_id: self._registry.get(provider_id)
+                     for provider_id in {batch.provider_id for batch in batches}}
+        updates = []
+        now = utcnow()
+        for batch, statuses, error in self._dispatcher.map(
+                lambda batch: self._fetch(batch, providers[batch.provider_id]), batches):
+            if error is not None:
+                logger.warning('Unable to sync %s statuses: %s', batch.provider_id.name, error)
+                continue
+            for entry in batch.entries:
+                state = self.resolve_state((statuses or {}).get(entry.provider_order_id))
+                if state is not None and state != entry.state:
+                    updates.append({'id': entry.id, 'state': state, 'state_changed_at': now})
+                    ORDER_ENTRY_TRANSITIONS.inc(source='sync', state=state.name)
+
+        if updates:
+            db.session.execute(db.update(OrderEntry), updates)
+            publish(db.session, db.session.execute(
+                db.select(Order.order_id).distinct()
+                .join(OrderEntry, OrderEntry.order_id == Order.id)
+                .where(OrderEntry.id.in_([update['id'] for update in updates]))
+            ).scalars())
+        db.session.commit()
+        logger.info('Status synchronization: batches=%s updated=%s', len(batches), len(updates))
+        return len(updates)
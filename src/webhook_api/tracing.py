@@ -0,0 +1,107 @@
+'''Per-request stage tracing.
+
+A `Trace` collects spans of a webhook request (or a worker run) and is
+stored as a `RequestTrace` row of the order. The active trace is kept in
+a context variable; dispatcher threads receive it explicitly.
+'''
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from .models import RequestTrace
+
+__all__ = (
+    'Trace',
+    'activate',
+    'current_trace',
+    'span',
+    'slow_logger',
+    'traced',
+)
+
+slow_logger = logging.getLogger('webhook_api.slow_requests')
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('request_trace', default=None)
+
+
+class Trace:
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.spans = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @property
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self._started) * 1000, 3)
+
+    def add(self, name: str, started: float, duration: float, **attrs) -> None:
+        '''started: `time.perf_counter()` value; duration: seconds'''
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'start_ms': round((started - self._started) * 1000, 3),
+                'duration_ms': round(duration * 1000, 3),
+                **attrs,
+            })
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.perf_counter() - started, **attrs)
+
+    def record(self, order_pk: int) -> RequestTrace:
+        '''Row for the session'''
+        with self._lock:
+            spans = sorted(self.spans, key=lambda item: item['start_ms'])
+        return RequestTrace(order_id=order_pk, source=self.source, total_ms=self.total_ms, spans=spans)
+
+    def report(self, order_id: str, threshold_ms: float) -> None:
+        '''Log slow request with its spans'''
+        total_ms = self.total_ms
+        if threshold_ms and total_ms >= threshold_ms:
+            slow_logger.warning('Slow %s order=%s total=%.1fms spans=%s',
+                                self.source, order_id, total_ms, self.spans)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def activate(trace: Trace):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, trace: Trace = None, **attrs):
+    '''Span of the given or active trace; no-op without trace'''
+    trace = trace or current_trace()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **attrs):
+        yield
+
+
+def traced(source: str):
+    '''Run the function with a new active trace'''
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with activate(Trace(source)):
+                return func(*args, **kwargs)
+        return wrapped
+    return wrapper
@@ -0,0 +1,175 @@
+import logging
+import signal
+import time
+
+from flask import Flask
+
+from .config import Config
+from .ext import db
+from .fulfillment import abandon_entries, fulfill_order, pending_entries
+from .jobs import FulfillmentQueue
+from .log import logger
+from .models import FulfillmentJob, FulfillmentJobState, Providers
+from .outbox import OutboxDispatcher
+from .panels import PANELS
+from .providers.registry import get_registry
+from .providers.utils import RetryLater, backoff_delay
+from .sync import StatusSynchronizer
+from .tracing import Trace, activate
+
+__all__ = (
+    'Worker',
+    'main',
+)
+
+
+class Worker:
+    '''Drains fulfillment queue. Any number of workers may run on any nodes'''
+
+    def __init__(self, app: Flask, config: Config = None, worker_id: str = None) -> None:
+        self._app = app
+        self._config = config or Config()
+        self._running = False
+        self._synced_at = time.monotonic()
+        self._catalogs_refreshed_at = None
+        self._balances_polled_at = None
+        self.queue = FulfillmentQueue(
+            worker_id=worker_id,
+            lock_timeout=self._config.worker_lock_timeout,
+            max_attempts=self._config.worker_max_attempts,
+        )
+        self.outbox = OutboxDispatcher(app, self._config, poll_interval=self._config.worker_poll_interval)
+
+    @staticmethod
+    def retry_delay(job: FulfillmentJob) -> float:
+        return backoff_delay(job.attempts, base=2.0, cap=600.0)
+
+    def release(self, job: FulfillmentJob, delay: float, error: str) -> None:
+        '''Reschedule the job; once it runs out of attempts its unfinished entries fail'''
+        self.queue.release(job, delay=delay, error=error)
+        if job.state == FulfillmentJobState.failed:
+            abandon_entries(job.order, self._config, f'Gave up after {job.attempts} attempts', error)
+
+    def process(self, job: FulfillmentJob) -> None:
+        trace = Trace('worker')
+        try:
+            with activate(trace):
+                is_retry = job.attempts > 1
+                entries = pending_entries(job.order, is_retry=is_retry)
+                # Retryable provider errors reschedule the job instead of blocking the worker
+                fulfill_order(job.order, self._config, entries, defer_retries=True, is_retry=is_retry)
+            self.queue.complete(job)
+            db.session.add(trace.record(job.order_id))
+            db.session.commit()
+        except RetryLater as exc:
+            # Results of the other entries are kept
+            logger.warning('Job %s rescheduled: %s', job.id, exc)
+            self.release(job, delay=max(exc.delay, self.retry_delay(job)), error=str(exc))
+            db.session.add(trace.record(job.order_id))
+            db.session.commit()
+        except Exception as exc:
+            logger.error('Unable to process job %s: %s', job.id, exc, exc_info=exc)
+            db.session.rollback()
+            self.release(job, delay=self.retry_delay(job), error=str(exc))
+            db.session.add(trace.record(job.order_id))
+            db.session.commit()
+        trace.report(job.order_id, self._config.slow_request_threshold_ms)
+
+    def run_once(self) -> int:
+        '''Claim and process a single batch. Returns amount of processed jobs'''
+        with self._app.app_context():
+            jobs = self.queue.claim(self._config.worker_batch_size)
+            for job in jobs:
+                self.process(job)
+            db.session.remove()
+        return len(jobs)
+
+    def sync_statuses(self, force: bool = False) -> int:
+        '''Periodic provider status synchronization'''
+        interval = self._config.status_sync_interval
+        if not force and (not interval or time.monotonic() - self._synced_at < interval):
+            return 0
+        self._synced_at = time.monotonic()
+        with self._app.app_context():
+            try:
+                return StatusSynchronizer(self._config).run()
+            except Exception as exc:
+                logger.error('Status synchronization failed: %s', exc, exc_info=exc)
+                db.session.rollback()
+                return 0
+            finally:
+                db.session.remove()
+
+    def refresh_catalogs(self, force: bool = False) -> int:
+        '''Periodic panel service catalogs refresh. Returns amount of refreshed catalogs'''
+        interval = self._config.catalog_refresh_interval
+        if not force and (not interval or (self._catalogs_refreshed_at is not None
+                                           and time.monotonic() - self._catalogs_refreshed_at < interval)):
+            return 0
+        self._catalogs_refreshed_at = time.monotonic()
+        refreshed = 0
+        with self._app.app_context():
+            registry = get_registry(self._config)
+            for name in PANELS:
+                try:
+                    registry.get(Providers[name]).refresh_catalog()
+                    refreshed += 1
+                except Exception as exc:
+                    logger.error('Unable to refresh %s catalog: %s', name, exc, exc_info=exc)
+            db.session.remove()
+        return refreshed
+
+    def poll_balances(self, force: bool = False) -> int:
+        '''Periodic panel balances poll. Returns amount of polled balances'''
+        interval = self._config.balance_poll_interval
+        if not force and (not interval or (self._balances_polled_at is not None
+                                           and time.monotonic() - self._balances_polled_at < interval)):
+            return 0
+        self._balances_polled_at = time.monotonic()
+        polled = 0
+        with self._app.app_context():
+            registry = get_registry(self._config)
+            for name in PANELS:
+                try:
+                    registry.get(Providers[name]).poll_balance()
+                    polled += 1
+                except Exception as exc:
+                    logger.error('Unable to poll %s balance: %s', name, exc, exc_info=exc)
+            db.session.remove()
+        return polled
+
+    def stop(self, *_) -> None:
+        logger.info('Worker %s stopping', self.queue.worker_id)
+        self._running = False
+
+    def run_forever(self) -> None:
+        self._running = True
+        logger.info('Worker %s started', self.queue.worker_id)
+        # Notifications are sent independently of the jobs
+        self.outbox.start()
+        while self._running:
+            try:
+                processed = self.run_once()
+            except Exception as exc:
+                logger.error('Worker iteration failed: %s', exc, exc_info=exc)
+                processed = 0
+            self.sync_statuses()
+            self.refresh_catalogs()
+            self.poll_balances()
+            if not processed:
+                time.sleep(self._config.worker_poll_interval)
+        self.outbox.stop()
+
+
+def main():
+    from .app_factory import create_app
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+    worker = Worker(app)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run_forever()
+
+
+if __name__ == '__main__':
+    main()
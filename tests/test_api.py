@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 import unittest
 from http import HTTPStatus
@@ -7,6 +8,26 @@ from unittest import mock  # pylint: disable=unused-import
 import flask
 
 from webhook_api.app_factory import create_app
+from webhook_api.ext import db
+from webhook_api.jobs import utcnow
+from webhook_api.models import FulfillmentJob, Order, OrderEntry, OrderEntryState
+
+WEBHOOK_PAYLOAD = {
+    'email': 'username@gmail.com',
+    'payment': {
+        'sys': 'yakassa',
+        'systranid': '2b2d447b-000f-5000-9999-999999999999',
+        'orderid': '1624284557',
+        'products': [
+            {
+                'name': 'Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/photo605824221_457243790  Количество: 68',
+                'quantity': 1,
+                'amount': 22.4,
+                'price': '22.4',
+            },
+        ],
+    },
+}
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -16,15 +37,94 @@ class TestAPIRoutes(unittest.TestCase):
     '''Test common api routes'''
 
     def setUp(self):
-        self.app: flask.Flask = create_app()
+        with mock.patch.dict(os.environ, {'API_TOKENS': 'qwerty'}):
+            self.app: flask.Flask = create_app()
         self.app_context: flask.ctx.RequestContext = self.app.test_request_context()
         self.app_context.push()
         self.client: flask.testing.FlaskClient = self.app.test_client()
 
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
     def test_favicon(self):
         rv: flask.Response = self.client.get('/favicon.ico')
         assert rv.status_code == HTTPStatus.NO_CONTENT, 'Should return 204 - No Content'
 
+    def test_webhook_duplicate(self):
+        rv: flask.Response = self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        assert rv.status_code == HTTPStatus.OK
+        rv = self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        assert rv.status_code == HTTPStatus.CONFLICT, 'Should return 409 - Already exists'
+
+        assert db.session.execute(db.select(db.func.count(Order.id))).scalar() == 1
+        assert db.session.execute(db.select(db.func.count(OrderEntry.id))).scalar() == 1
+        assert db.session.execute(db.select(db.func.count(FulfillmentJob.id))).scalar() == 1
+
+    def test_webhook_test_callback(self):
+        rv: flask.Response = self.client.post('/api/v1/webhook', json={'test': 'test'})
+        assert rv.status_code == HTTPStatus.OK
+
+    def test_status_timings(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        request = {'orderId': WEBHOOK_PAYLOAD['payment']['orderid'], 'timings': True}
+
+        rv: flask.Response = self.client.post('/api/v1/status', json=request)
+        assert rv.status_code == HTTPStatus.OK
+        assert 'timings' not in rv.json['result'], 'Timings require auth'
+
+        rv = self.client.post('/api/v1/status', json=request, headers={'Authorization': 'Bearer qwerty'})
+        [trace] = rv.json['result']['timings']
+        assert trace['source'] == 'webhook'
+        assert [span['name'] for span in trace['spans']] == ['parse', 'persist']
+
+    def test_status_batch(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        order_id = WEBHOOK_PAYLOAD['payment']['orderid']
+
+        rv: flask.Response = self.client.post('/api/v1/status', json={'orderIds': [order_id, 'missing']})
+        assert rv.status_code == HTTPStatus.OK
+        [status] = rv.json['result']
+        assert status['orderId'] == order_id
+        assert status['entries'][0]['state'] == 'created'
+        assert rv.json['notFound'] == ['missing']
+        etag = rv.headers['ETag']
+
+        rv = self.client.get(f'/api/v1/status?orderIds={order_id},missing', headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.NOT_MODIFIED
+        assert rv.get_data() == b''
+
+        rv = self.client.post('/api/v1/status', json={'orderIds': [order_id]}, headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.OK, 'Other orders requested'
+
+        rv = self.client.post('/api/v1/status', json={'orderIds': list(range(101))})
+        assert rv.status_code == HTTPStatus.BAD_REQUEST
+
+    def test_status_etag(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        request = {'orderId': WEBHOOK_PAYLOAD['payment']['orderid']}
+        etag = self.client.post('/api/v1/status', json=request).headers['ETag']
+        rv: flask.Response = self.client.post('/api/v1/status', json=request, headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.NOT_MODIFIED
+
+        entry = db.session.execute(db.select(OrderEntry)).scalar_one()
+        entry.state = OrderEntryState.failed
+        entry.state_changed_at = utcnow()
+        db.session.commit()
+        rv = self.client.post('/api/v1/status', json=request, headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.OK
+        assert rv.json['result']['entries'][0]['state'] == 'failed'
+        assert rv.headers['ETag'] != etag
+
+    def test_metrics(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        rv: flask.Response = self.client.get('/metrics')
+        assert rv.status_code == HTTPStatus.OK
+        body = rv.get_data(as_text=True)
+        assert 'webhook_stage_seconds_count{stage="persist"}' in body
+        assert 'http_request_seconds_count{endpoint="/api/v1/webhook",status="200"}' in body
+
 
 if __name__ == '__main__':
     unittest.main()
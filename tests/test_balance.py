@@ -0,0 +1,88 @@
+import logging
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+
+from webhook_api.models import ProviderBalance
+from webhook_api.panels import PanelSpec
+from webhook_api.providers.balance import BalanceLedger, BalanceStore, InsufficientFunds
+from webhook_api.providers.catalog import ServiceCatalog
+from webhook_api.providers.panel import PanelAPIError, PanelProvider
+from webhook_api.providers.utils import RETRYABLE, classify_error
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+SPEC = PanelSpec(name='sample', provider_id=100, base_url='https://panel.local/api/v2', token_key='SAMPLE_TOKEN')
+
+
+class TestBalanceLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://', poolclass=StaticPool,
+                                       connect_args={'check_same_thread': False})
+        ProviderBalance.__table__.create(self.engine)
+        self.ledger = BalanceLedger(BalanceStore(self.engine), retry_after=60)
+        self.now = 1000.0
+        patcher = mock.patch('webhook_api.providers.balance.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_debit(self):
+        self.ledger.debit('sample', 100)  # Unknown balance is not checked
+        self.ledger.record('sample', 10, 'USD')
+        self.ledger.debit('sample', 6)
+        # Debits are shared through the DB
+        other = BalanceLedger(BalanceStore(self.engine))
+        with self.assertRaises(InsufficientFunds) as ctx:
+            other.debit('sample', 6)
+        assert classify_error(ctx.exception) == RETRYABLE
+        self.ledger.credit('sample', 6)
+        other.debit('sample', 6)
+        assert self.ledger.stats()['sample']['available'] == 4
+
+    def test_burn_rate(self):
+        self.ledger.record('sample', 100, 'USD')
+        assert self.ledger.stats()['sample']['burn_rate'] is None
+        self.now += 1800
+        self.ledger.record('sample', 90, 'USD')
+        self.ledger.debit('sample', 5)
+        stats = self.ledger.stats()['sample']
+        assert stats['burn_rate'] == 20
+        assert stats['hours_left'] == 4.2
+        # Top-up keeps the rate
+        self.now += 1800
+        self.ledger.record('sample', 500, 'USD')
+        assert self.ledger.stats()['sample']['burn_rate'] == 20
+
+    def test_make_order(self):
+        client = mock.Mock()
+        client.services.return_value = [{'service': 1, 'rate': '2', 'min': '10', 'max': '1000'}]
+        catalog = ServiceCatalog()
+        catalog.refresh('sample', client)
+        transport = mock.Mock()
+        provider = type('SampleProvider', (PanelProvider,), {'spec': SPEC})(
+            {'token': 'secret'}, transport, catalog, self.ledger)
+        transport.post.return_value.json.return_value = {'balance': '1.5', 'currency': 'USD'}
+        provider.poll_balance()
+        details = mock.Mock(url='https://t.me/channel', service_id='1', units_amount=500, quantity=1.0)
+
+        # Panel error: the order is not placed
+        transport.post.return_value.json.return_value = {'error': 'Incorrect link'}
+        with self.assertRaises(PanelAPIError):
+            provider.make_order(details)
+        transport.post.return_value.json.return_value = {'order': 42}
+        assert provider.make_order(details) == 42
+        assert self.ledger.stats()['sample']['available'] == 0.5
+
+        transport.post.reset_mock()
+        with self.assertRaises(InsufficientFunds):
+            provider.make_order(details)
+        transport.post.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
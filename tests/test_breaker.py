@@ -0,0 +1,99 @@
+import logging
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+
+from webhook_api.models import BreakerState, ProviderBreaker
+from webhook_api.providers.breaker import BreakerStore, CircuitBreaker, CircuitOpen
+from webhook_api.providers.transport import Transport
+from webhook_api.providers.utils import RETRYABLE, classify_error
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://', poolclass=StaticPool,
+                                       connect_args={'check_same_thread': False})
+        ProviderBreaker.__table__.create(self.engine)
+        self.store = BreakerStore(self.engine)
+        self.now = 1000.0
+        patcher = mock.patch('webhook_api.providers.breaker.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def breaker(self, **kwargs) -> CircuitBreaker:
+        return CircuitBreaker('sample', store=self.store, min_calls=4, open_seconds=30,
+                              sync_interval=1, **kwargs)
+
+    def fail(self, breaker: CircuitBreaker, times: int) -> None:
+        for _ in range(times):
+            breaker.record(0.1, failed=not breaker.before_call())
+
+    def test_trip_and_fail_fast(self):
+        breaker = self.breaker()
+        breaker.record(0.1, failed=False)
+        self.fail(breaker, 3)
+        assert breaker.state == BreakerState.open
+        with self.assertRaises(CircuitOpen) as ctx:
+            breaker.before_call()
+        assert ctx.exception.retry_after == 30
+        assert classify_error(ctx.exception) == RETRYABLE
+
+    def test_slow_calls_trip(self):
+        breaker = self.breaker(slow_call=1)
+        for _ in range(4):
+            breaker.record(2, failed=False)
+        assert breaker.state == BreakerState.open
+
+    def test_state_shared(self):
+        breaker, other = self.breaker(), self.breaker()
+        other.before_call()
+        self.fail(breaker, 4)
+        assert other.before_call() is False, 'State is synchronized once per interval'
+        self.now += 1
+        with self.assertRaises(CircuitOpen):
+            other.before_call()
+
+    def test_probe(self):
+        breaker, other = self.breaker(), self.breaker()
+        self.fail(breaker, 4)
+        self.now += 31
+        assert breaker.before_call() is True, 'Probe call'
+        assert breaker.state == BreakerState.half_open
+        with self.assertRaises(CircuitOpen):
+            other.before_call()
+
+        # Failed probe opens breaker again
+        breaker.record(0.1, failed=True, probe=True)
+        assert breaker.state == BreakerState.open
+        self.now += 31
+        assert other.before_call() is True
+        other.record(0.1, failed=False, probe=True)
+        assert other.state == BreakerState.closed
+
+        self.now += 1
+        assert breaker.before_call() is False
+        assert breaker.state == BreakerState.closed
+        with self.engine.connect() as conn:
+            assert conn.execute(sa.select(ProviderBreaker.trips)).scalar() == 2
+
+    def test_transport(self):
+        session = mock.Mock()
+        session.post.return_value.status_code = 503
+        transport = Transport('sample', session, breaker=self.breaker())
+        for _ in range(4):
+            transport.post('add', 'https://example.com')
+        with self.assertRaises(CircuitOpen):
+            transport.post('add', 'https://example.com')
+        assert session.post.call_count == 4
+        assert transport.breaker_stats()['state'] == 'open'
+
+
+if __name__ == '__main__':
+    unittest.main()
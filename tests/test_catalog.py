@@ -0,0 +1,75 @@
+import logging
+import sys
+import tempfile
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.panels import PanelSpec
+from webhook_api.providers.catalog import OrderValidationError, ServiceCatalog
+from webhook_api.providers.panel import PanelProvider
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+SPEC = PanelSpec(name='sample', provider_id=100, base_url='https://panel.local/api/v2', token_key='SAMPLE_TOKEN')
+
+SERVICES = [
+    {'service': 1, 'name': 'Followers', 'type': 'Default', 'category': 'First Category',
+     'rate': '0.90', 'min': '50', 'max': '10000'},
+    {'service': 2, 'name': 'Comments', 'type': 'Custom Comments', 'category': 'Second Category',
+     'rate': '8', 'min': '10', 'max': '1500'},
+]
+
+
+class TestServiceCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+        self.client = mock.Mock()
+        self.client.services.return_value = SERVICES
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_validate(self):
+        catalog = ServiceCatalog()
+        assert catalog.validate('sample', '1', 1) is None, 'Not checked before refresh'
+        catalog.refresh('sample', self.client)
+        assert catalog.validate('sample', '1', 100).rate == 0.9
+        assert catalog.service('sample', '2').cost(500) == 4
+        with self.assertRaises(OrderValidationError):
+            catalog.validate('sample', '3', 100)
+        with self.assertRaises(OrderValidationError):
+            catalog.validate('sample', '1', 49)
+        with self.assertRaises(OrderValidationError):
+            catalog.validate('sample', '2', 1501)
+
+    def test_shared_through_directory(self):
+        ServiceCatalog(self.directory).refresh('sample', self.client)
+        other = ServiceCatalog(self.directory)
+        assert other.stats('sample')['services'] == 2
+        assert other.stats('sample')['is_stale'] is False
+        assert other.stats('unknown') == {'fetched_at': None, 'age': None, 'is_stale': True, 'services': 0}
+
+    def test_mismatches(self):
+        catalog = ServiceCatalog()
+        catalog.refresh('sample', self.client)
+        rows = [('likes', '1', 'sample'), ('views', '7', 'sample'), ('reposts', '7', 'other')]
+        assert catalog.mismatches(rows) == [
+            {'service_name': 'views', 'provider': 'sample', 'service_id': '7', 'problem': 'unknown_service'},
+        ]
+
+    def test_make_order_preflight(self):
+        catalog = ServiceCatalog()
+        catalog.refresh('sample', self.client)
+        transport = mock.Mock()
+        provider = type('SampleProvider', (PanelProvider,), {'spec': SPEC})({'token': 'secret'}, transport, catalog)
+        details = mock.Mock(url='https://t.me/channel', service_id='1', units_amount=10, quantity=1.0)
+        with self.assertRaises(OrderValidationError):
+            provider.make_order(details)
+        transport.post.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
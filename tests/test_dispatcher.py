@@ -0,0 +1,55 @@
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.config import Config
+from webhook_api.dispatcher import OrderDispatcher
+from webhook_api.models import Providers
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestOrderDispatcher(unittest.TestCase):
+
+    @mock.patch.dict(os.environ, {'DISPATCH_MAX_WORKERS': '8', 'SOCPROOF_CONCURRENCY': '2'})
+    def test_provider_concurrency_cap(self):
+        dispatcher = OrderDispatcher(Config())
+        lock = threading.Lock()
+        active = {'now': 0, 'max': 0}
+
+        def call(n):
+            with dispatcher.slot(Providers.socproof):
+                with lock:
+                    active['now'] += 1
+                    active['max'] = max(active['max'], active['now'])
+                time.sleep(0.01)
+                with lock:
+                    active['now'] -= 1
+            return n
+
+        results = dispatcher.map(call, range(10))
+        dispatcher.shutdown()
+        assert [result.result for result in results] == list(range(10))
+        assert active['max'] == 2
+
+    def test_errors_collected(self):
+        dispatcher = OrderDispatcher(Config())
+
+        def call(n):
+            if n % 2:
+                raise ValueError(n)
+            return n
+
+        results = dispatcher.map(call, range(4))
+        dispatcher.shutdown()
+        assert [result.error is None for result in results] == [True, False, True, False]
+        assert isinstance(results[1].error, ValueError)
+
+
+if __name__ == '__main__':
+    unittest.main()
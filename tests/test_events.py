@@ -0,0 +1,158 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+from http import HTTPStatus
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+
+from webhook_api.app_factory import create_app
+from webhook_api.events import PAYLOAD_SIZE, OrderEvents, Subscription, _payloads, get_events, publish
+from webhook_api.ext import db
+from webhook_api.jobs import utcnow
+from webhook_api.models import OrderEntry, OrderEntryState
+
+from .test_api import WEBHOOK_PAYLOAD
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+ORDER_ID = WEBHOOK_PAYLOAD['payment']['orderid']
+
+
+class TestOrderEvents(unittest.TestCase):
+
+    def test_dispatch(self):
+        events = OrderEvents()
+        with events.subscribe(['1', '2']) as subscription, events.subscribe(['3']) as other:
+            assert subscription.wait(0) == set()
+            events.dispatch(['2', '4'])
+            assert subscription.wait(0) == {'2'}
+            assert subscription.wait(0) == set(), 'Changes are consumed'
+            assert other.wait(0) == set()
+            assert events.stats()['waiting'] == 2
+        assert events.stats() == {'waiting': 0, 'orders': 0, 'received': 2, 'listening': False}
+
+    def test_wakes_up_waiting_thread(self):
+        events = OrderEvents()
+        with events.subscribe(['1']) as subscription:
+            threading.Timer(0.05, events.dispatch, (['1'],)).start()
+            assert subscription.wait(5) == {'1'}
+
+    def test_dispatch_all(self):
+        events = OrderEvents()
+        with events.subscribe(['1', '2']) as subscription:
+            events.dispatch_all()
+            assert subscription.wait(0) == {'1', '2'}
+
+    def test_rebuilt_after_fork(self):
+        events = get_events()
+        assert get_events() is events
+        with mock.patch('webhook_api.events.os.getpid', return_value=events.pid + 1):
+            forked = get_events()
+            assert forked is not events
+            assert forked.pid == events.pid + 1
+            assert get_events() is forked
+            assert forked.stats()['listening'] is False
+
+    def test_payloads(self):
+        order_ids = [f'{n:010d}' for n in range(2000)]
+        payloads = _payloads(order_ids)
+        assert len(payloads) > 1
+        assert all(len(payload) <= PAYLOAD_SIZE for payload in payloads)
+        assert ','.join(payloads).split(',') == order_ids
+
+
+@mock.patch.dict(os.environ, {'STATUS_KEEPALIVE_INTERVAL': '0.01', 'STATUS_STREAM_TIMEOUT': '0.1'})
+class TestStatusEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.app: flask.Flask = create_app()
+        self.app_context = self.app.test_request_context()
+        self.app_context.push()
+        self.client: flask.testing.FlaskClient = self.app.test_client()
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def change_state(self, state: OrderEntryState) -> None:
+        entry = db.session.execute(db.select(OrderEntry)).scalar_one()
+        entry.state = state
+        entry.state_changed_at = utcnow()
+        publish(db.session, [ORDER_ID])
+        db.session.commit()
+
+    def test_published_on_commit(self):
+        with get_events().subscribe([ORDER_ID]) as subscription:
+            publish(db.session, [ORDER_ID])
+            assert subscription.wait(0) == set()
+            db.session.rollback()
+            db.session.commit()
+            assert subscription.wait(0) == set(), 'Discarded by rollback'
+
+            self.change_state(OrderEntryState.failed)
+            assert subscription.wait(0) == {ORDER_ID}
+
+    def test_wait_timeout(self):
+        etag = self.client.get(f'/api/v1/status?orderId={ORDER_ID}').headers['ETag']
+        rv = self.client.get(f'/api/v1/status/wait?orderId={ORDER_ID}&timeout=0.05',
+                             headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.NOT_MODIFIED
+        assert rv.headers['ETag'] == etag
+
+        rv = self.client.get(f'/api/v1/status/wait?orderIds={ORDER_ID}')
+        assert rv.status_code == HTTPStatus.OK, 'Answered at once without If-None-Match'
+        assert rv.json['result'][0]['orderId'] == ORDER_ID
+
+    def test_wait_for_change(self):
+        etag = self.client.get(f'/api/v1/status?orderIds={ORDER_ID}').headers['ETag']
+        wait = Subscription.wait
+
+        def _change_and_wait(subscription, timeout):
+            # Change is committed by another request while this one waits
+            self.change_state(OrderEntryState.fulfilled)
+            return wait(subscription, timeout)
+
+        with mock.patch.object(Subscription, 'wait', autospec=True, side_effect=_change_and_wait) as waited:
+            rv = self.client.get(f'/api/v1/status/wait?orderIds={ORDER_ID}&timeout=5',
+                                 headers={'If-None-Match': etag})
+        assert rv.status_code == HTTPStatus.OK
+        assert waited.call_count == 1
+        assert rv.json['result'][0]['entries'][0]['state'] == 'fulfilled'
+        assert rv.headers['ETag'] != etag
+
+    def test_stream(self):
+        rv = self.client.get(f'/api/v1/status/stream?orderId={ORDER_ID}', buffered=False)
+        assert rv.status_code == HTTPStatus.OK
+        assert rv.mimetype == 'text/event-stream'
+        chunks = iter(rv.response)
+        first = next(chunks).decode()
+        assert first.startswith('event: status\nid: ')
+        assert '"state": "created"' in first
+
+        self.change_state(OrderEntryState.failed)
+        second = next(chunks).decode()
+        assert '"state": "failed"' in second
+        assert list(chunks) == [], 'Ends once entries are settled'
+        rv.close()
+        assert get_events().stats()['waiting'] == 0
+
+        last_event_id = second.split('\n')[1][len('id: '):]
+        rv = self.client.get(f'/api/v1/status/stream?orderId={ORDER_ID}', headers={'Last-Event-ID': last_event_id})
+        assert rv.status_code == HTTPStatus.NO_CONTENT
+
+    def test_stream_keepalive(self):
+        rv = self.client.get(f'/api/v1/status/stream?orderIds={ORDER_ID}', buffered=False)
+        chunks = [chunk.decode() for chunk in rv.response]
+        rv.close()
+        assert chunks[0].startswith('event: status')
+        assert set(chunks[1:]) == {': keep-alive\n\n'}, 'Until STATUS_STREAM_TIMEOUT'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import logging
+import os
+import sys
+import unittest
+from http import HTTPStatus
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from webhook_api.app_factory import create_app
+from webhook_api.ext import db
+from webhook_api.jobs import FulfillmentQueue
+from webhook_api.config import Config
+from webhook_api.models import (FulfillmentJob, FulfillmentJobState, Notification,
+                                OrderEntry, OrderEntryState, Providers, RequestTrace)
+from webhook_api.providers.balance import InsufficientFunds
+from webhook_api.providers.dummy import DummyProvider
+from webhook_api.providers.panel import PanelAPIError
+from webhook_api.providers.utils import RetryLater
+from webhook_api.worker import Worker
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PAYLOAD = {
+    'email': 'username@gmail.com',
+    'payment': {
+        'sys': 'yakassa',
+        'systranid': '2b2d447b-000f-5000-9999-999999999999',
+        'orderid': '1624284557',
+        'products': [
+            {
+                'name': 'Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/photo605824221_457243790  Количество: 68',
+                'quantity': 1,
+                'amount': 22.4,
+                'price': '22.4',
+            },
+            {
+                'name': 'Услуга Telegram: Подписчики Эконом: 0.52 руб. / 1 шт   Ссылка: https://t.me/napodbor_channel  Количество: 1200',
+                'quantity': 1,
+                'amount': 52,
+                'price': '52',
+            },
+        ],
+    },
+}
+
+
+@mock.patch.dict(os.environ, {'FULFILLMENT_MODE': 'queue', 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+class TestFulfillmentQueue(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, {'API_TOKENS': 'qwerty'}):
+            self.app: flask.Flask = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client: flask.testing.FlaskClient = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_webhook_enqueues_job(self):
+        with mock.patch('webhook_api.app_factory.fulfill_order') as fulfill:
+            rv = self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        assert rv.status_code == HTTPStatus.OK
+        fulfill.assert_not_called()
+
+        jobs = db.session.execute(db.select(FulfillmentJob)).scalars().all()
+        assert len(jobs) == 1
+        assert jobs[0].state == FulfillmentJobState.pending
+        assert jobs[0].order.order_id == '1624284557'
+
+    def test_claim_is_exclusive(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        first = FulfillmentQueue(worker_id='first')
+        second = FulfillmentQueue(worker_id='second')
+        assert len(first.claim(5)) == 1
+        assert second.claim(5) == []
+
+    def test_stale_job_reclaimed(self):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        [job] = FulfillmentQueue(worker_id='dead').claim()
+        assert job.state == FulfillmentJobState.running
+
+        queue = FulfillmentQueue(worker_id='alive', lock_timeout=-1)
+        [job] = queue.claim()
+        assert job.locked_by == 'alive'
+        assert job.attempts == 2
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_processes_job(self, get_registry):
+        provider = get_registry.return_value.get.return_value
+        provider.make_order.return_value = '42'
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        assert Worker(self.app).run_once() == 1
+        assert Worker(self.app).run_once() == 0
+
+        job = db.session.execute(db.select(FulfillmentJob)).scalar_one()
+        assert job.state == FulfillmentJobState.done
+
+        entries = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().all()
+        assert provider.describe.call_count == 2
+        assert entries[0].state == OrderEntryState.fulfilled
+        assert entries[0].provider_order_id == '42'
+        assert entries[1].state == OrderEntryState.not_payed
+
+        trace = db.session.execute(db.select(RequestTrace).filter_by(source='worker')).scalar_one()
+        assert sorted(span['name'] for span in trace.spans) == ['fulfill', 'notify', 'notify', 'route', 'submit']
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_defers_retryable_error(self, get_registry):
+        provider = get_registry.return_value.get.return_value
+        provider.make_order.side_effect = RetryLater(30, Exception('Too many requests'))
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        job = db.session.execute(db.select(FulfillmentJob)).scalar_one()
+        assert job.state == FulfillmentJobState.pending
+        assert (job.available_at - job.locked_at).total_seconds() >= 30
+        entries = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().all()
+        assert entries[0].state == OrderEntryState.created, 'Entry is retried by the next run'
+        assert entries[0].error_hint == 'Too many requests'
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_defers_insufficient_funds(self, get_registry):
+        provider = get_registry.return_value.get.return_value
+        provider.make_order.side_effect = InsufficientFunds('socproof', 1, 5, retry_after=300)
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        job = db.session.execute(db.select(FulfillmentJob)).scalar_one()
+        assert job.state == FulfillmentJobState.pending
+        assert (job.available_at - job.locked_at).total_seconds() >= 300
+        entry = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().first()
+        assert entry.state == OrderEntryState.created
+
+    def mock_providers(self, get_registry) -> tuple[mock.Mock, mock.Mock]:
+        self.client.post('/api/v1/updateServices', json=[
+            ['ВК: Лайки Эконом', '101', 'socproof', '202', 'justanotherpanel'],
+        ], headers={'Authorization': 'Bearer qwerty'})
+        primary, alternate = mock.Mock(), mock.Mock()
+        providers = {Providers.socproof: primary, Providers.justanotherpanel: alternate, Providers.dummy: mock.Mock()}
+        get_registry.return_value.get.side_effect = providers.get
+        get_registry.return_value.rank.side_effect = list
+        return primary, alternate
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_fails_over(self, get_registry):
+        primary, alternate = self.mock_providers(get_registry)
+        submitted = []
+
+        def _make_order(details, error=None):
+            submitted.append((details.provider_id, details.service_id))
+            if error is not None:
+                raise error
+            return '77'
+
+        primary.make_order.side_effect = lambda details: _make_order(details, PanelAPIError('Not enough funds'))
+        alternate.make_order.side_effect = _make_order
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        entry = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().first()
+        assert entry.state == OrderEntryState.fulfilled
+        assert (entry.provider_id, entry.service_id, entry.provider_order_id) == (Providers.justanotherpanel, '202', '77')
+        assert submitted == [(Providers.socproof, '101'), (Providers.justanotherpanel, '202')]
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_fails_over_refused_connection(self, get_registry):
+        primary, alternate = self.mock_providers(get_registry)
+        refused = NewConnectionError(None, 'Failed to establish a new connection: [Errno 111] Connection refused')
+        primary.make_order.side_effect = requests.ConnectionError(MaxRetryError(None, '/api/v2', refused))
+        alternate.make_order.return_value = '77'
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        entry = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().first()
+        assert entry.state == OrderEntryState.fulfilled
+        assert (entry.provider_id, entry.provider_order_id) == (Providers.justanotherpanel, '77')
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_no_failover_if_order_may_be_placed(self, get_registry):
+        primary, alternate = self.mock_providers(get_registry)
+        primary.make_order.side_effect = requests.ReadTimeout()
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        entry = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().first()
+        assert entry.state == OrderEntryState.failed
+        assert entry.provider_id == Providers.socproof
+        alternate.make_order.assert_not_called()
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_retry_not_described_again(self, get_registry):
+        primary, _ = self.mock_providers(get_registry)
+        dummy = DummyProvider(Config().get_provider_config(Providers.dummy))
+        get_registry.return_value.get.side_effect = {Providers.socproof: primary, Providers.dummy: dummy}.get
+        primary.make_order.side_effect = [RetryLater(0, Exception('Too many requests')), '42']
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        worker = Worker(self.app)
+        with mock.patch.object(Worker, 'retry_delay', return_value=0):
+            assert worker.run_once() == 1
+            assert worker.run_once() == 1
+
+        entry = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().first()
+        assert entry.state == OrderEntryState.fulfilled
+        assert primary.make_order.call_count == 2
+        assert len(db.session.execute(db.select(Notification)).scalars().all()) == 2, 'An entry is described once'
+
+    @mock.patch('webhook_api.worker.fulfill_order', side_effect=Exception('Boom'))
+    def test_worker_releases_failed_job(self, _):
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        Worker(self.app).run_once()
+
+        job = db.session.execute(db.select(FulfillmentJob)).scalar_one()
+        assert job.state == FulfillmentJobState.pending
+        assert job.error_hint == 'Boom'
+        assert job.available_at > job.locked_at
+
+    @mock.patch('webhook_api.fulfillment.get_registry')
+    def test_worker_abandons_entries(self, get_registry):
+        provider = get_registry.return_value.get.return_value
+        provider.make_order.side_effect = RetryLater(0, Exception('Too many requests'))
+        self.client.post('/api/v1/webhook', json=WEBHOOK_PAYLOAD)
+        worker = Worker(self.app)
+        worker.queue.max_attempts = 2
+        with mock.patch.object(Worker, 'retry_delay', return_value=0):
+            assert worker.run_once() == 1
+            assert worker.run_once() == 1
+            assert worker.run_once() == 0
+
+        job = db.session.execute(db.select(FulfillmentJob)).scalar_one()
+        assert job.state == FulfillmentJobState.failed
+        entries = db.session.execute(db.select(OrderEntry).order_by(OrderEntry.id)).scalars().all()
+        assert entries[0].state == OrderEntryState.failed
+        assert entries[0].error_hint == 'Gave up after 2 attempts: Too many requests'
+        assert entries[1].state == OrderEntryState.not_payed
+        provider.report_failure.assert_called_once()
+
+        rv = self.client.get('/api/v1/status?orderId=1624284557')
+        assert [entry['state'] for entry in rv.json['result']['entries']] == ['failed', 'not_payed']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import logging
+import sys
+import tempfile
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.journal import RequestJournal, iter_journal
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestRequestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_append_and_replay(self):
+        journal = RequestJournal(self.directory)
+        journal.append('{"test": "test"}', 'application/json')
+        journal.append('{"payment": {"orderid": "1"}}', 'application/json')
+        assert list(iter_journal(self.directory)) == []
+        assert journal.flush() == 2
+
+        # Segment being written is readable up to the last flush
+        records = list(iter_journal(self.directory, include_open=True))
+        assert [record.raw_data for record in records] == ['{"test": "test"}', '{"payment": {"orderid": "1"}}']
+
+        journal.stop()
+        assert len(list(iter_journal(self.directory))) == 2
+
+    def test_rotation(self):
+        journal = RequestJournal(self.directory, max_segment_bytes=1)
+        for n in range(3):
+            journal.append(f'request {n}', 'text/plain')
+            journal.flush()
+        journal.stop()
+        records = list(iter_journal(self.directory))
+        assert [record.raw_data for record in records] == ['request 0', 'request 1', 'request 2']
+
+    def test_sink_batches(self):
+        sink = mock.Mock()
+        journal = RequestJournal(sink=sink)
+        for n in range(5):
+            journal.append(f'request {n}', 'text/plain')
+        journal.flush()
+        sink.assert_called_once()
+        assert len(sink.call_args.args[0]) == 5
+
+    def test_background_flush(self):
+        sink = mock.Mock()
+        journal = RequestJournal(sink=sink, flush_interval=0.01)
+        journal.append('request', 'text/plain')
+        journal.stop()
+        sink.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+from http import HTTPStatus
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+
+from webhook_api.app_factory import create_app
+from webhook_api.config import Config
+from webhook_api.dispatcher import OrderDispatcher
+from webhook_api.ext import db
+from webhook_api.live import LiveStatus
+from webhook_api.models import Order, OrderEntry, OrderEntryState, Providers
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestLiveStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = mock.Mock()
+        self.multi_status = self.registry.get.return_value.client.multi_status
+        self.multi_status.side_effect = lambda order_ids: {
+            order_id: {'status': 'In progress', 'remains': order_id, 'charge': '0.27819', 'currency': 'USD'}
+            for order_id in order_ids
+        }
+        self.dispatcher = OrderDispatcher(Config())
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def live_status(self, **kwargs) -> LiveStatus:
+        return LiveStatus(Config(), self.registry, self.dispatcher, **kwargs)
+
+    def test_coalesced(self):
+        live = self.live_status(window=0.2)
+        results = {}
+
+        def _lookup(n):
+            results[n] = live.lookup([(Providers.socproof, str(n)), (Providers.socproof, '0')])
+
+        threads = [threading.Thread(target=_lookup, args=(n,)) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.multi_status.assert_called_once()
+        assert sorted(self.multi_status.call_args.args[0]) == ['0', '1', '2', '3', '4']
+        assert results[3] == {
+            (Providers.socproof, '3'): {'status': 'In progress', 'remains': '3'},
+            (Providers.socproof, '0'): {'status': 'In progress', 'remains': '0'},
+        }
+
+    def test_in_flight_not_requested_twice(self):
+        live = self.live_status(window=0)
+        started, release = threading.Event(), threading.Event()
+        fetch = self.multi_status.side_effect
+
+        def _slow(order_ids):
+            started.set()
+            release.wait(5)
+            return fetch(order_ids)
+
+        self.multi_status.side_effect = _slow
+        first = threading.Thread(target=live.lookup, args=([(Providers.socproof, '1')],))
+        first.start()
+        started.wait(5)
+        threading.Timer(0.1, release.set).start()
+        assert live.lookup([(Providers.socproof, '1')]) == {(Providers.socproof, '1'): {'status': 'In progress', 'remains': '1'}}
+        first.join()
+        self.multi_status.assert_called_once()
+
+    def test_cached(self):
+        live = self.live_status(window=0)
+        live.lookup([(Providers.socproof, '1')])
+        live.lookup([(Providers.socproof, '1')])
+        self.multi_status.assert_called_once()
+
+        live = self.live_status(window=0, ttl=0)
+        live.lookup([(Providers.socproof, '1')])
+        live.lookup([(Providers.socproof, '1')])
+        assert self.multi_status.call_count == 3
+
+    def test_errors_not_cached(self):
+        live = self.live_status(window=0)
+        self.multi_status.side_effect = Exception('Invalid API key')
+        assert live.lookup([(Providers.socproof, '1')]) == {(Providers.socproof, '1'): {'error': 'Unavailable'}}
+        live.lookup([(Providers.socproof, '1')])
+        assert self.multi_status.call_count == 2
+
+    def test_public_fields(self):
+        live = self.live_status(window=0)
+        self.multi_status.side_effect = lambda order_ids: {
+            '1': {'status': 'Partial', 'remains': '10', 'start_count': '3', 'charge': '1.2', 'currency': 'USD'},
+            '2': {'error': 'Incorrect order ID'},
+        }
+        assert live.lookup([(Providers.socproof, '1'), (Providers.socproof, '2')]) == {
+            (Providers.socproof, '1'): {'status': 'Partial', 'remains': '10', 'start_count': '3'},
+            (Providers.socproof, '2'): {'error': 'Not found'},
+        }
+
+    def test_unsupported_entries(self):
+        live = self.live_status(window=0)
+        assert live.lookup([(Providers.dummy, '1'), (Providers.socproof, None), (None, None)]) == {}
+        self.multi_status.assert_not_called()
+
+
+class TestLiveStatusAPI(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, {'API_TOKENS': 'qwerty'}):
+            self.app: flask.Flask = create_app()
+        self.app_context = self.app.test_request_context()
+        self.app_context.push()
+        self.client: flask.testing.FlaskClient = self.app.test_client()
+        order = Order(order_id='1', orders_amount=2)
+        db.session.add(order)
+        db.session.add(OrderEntry(order=order, entry_id='1-0', state=OrderEntryState.fulfilled,
+                                  provider_id=Providers.socproof, provider_order_id='77'))
+        db.session.add(OrderEntry(order=order, entry_id='1-1', state=OrderEntryState.failed,
+                                  provider_id=Providers.socproof))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @mock.patch('webhook_api.app_factory.get_live_status')
+    def test_status_live(self, get_live_status):
+        get_live_status.return_value.lookup.side_effect = lambda entries: {
+            key: {'status': 'Partial', 'remains': '10'} for key in entries if key[1] is not None
+        }
+        rv = self.client.get('/api/v1/status?orderId=1&live=1')
+        assert 'live' not in rv.json['result']['entries'][0], 'Authorized only'
+        get_live_status.return_value.lookup.assert_not_called()
+
+        rv = self.client.get('/api/v1/status?orderId=1&live=1', headers={'Authorization': 'Bearer qwerty'})
+        assert rv.status_code == HTTPStatus.OK
+        assert 'ETag' not in rv.headers
+        live, not_placed = rv.json['result']['entries']
+        assert live['live'] == {'status': 'Partial', 'remains': '10'}
+        assert 'live' not in not_placed
+
+        rv = self.client.get('/api/v1/status?orderId=1')
+        assert 'live' not in rv.json['result']['entries'][0]
+        assert get_live_status.return_value.lookup.call_count == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import logging
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.matching import FuzzyMatch, TrigramIndex, normalize_service_name
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestMatching(unittest.TestCase):
+
+    def test_normalize(self):
+        assert normalize_service_name('300 шт позитивных  ') == '300 шт позитивных'
+        assert normalize_service_name('ВК :  Лaйки\xa0Эконом ') == 'вк лайки эконом'
+        # Latin look-alikes, "ё", dashes and quotes
+        assert normalize_service_name('TikTok — Просмотры «Ёлка»') == normalize_service_name('tiktok - просмотры "елка"')
+        assert normalize_service_name(None) == ''
+
+    def test_match(self):
+        index = TrigramIndex(normalize_service_name(name) for name in (
+            'ВК: Лайки Эконом', 'ВК: Лайки Премиум', 'Telegram: Подписчики Эконом', 'ВК: Лайки Эконом',
+        ))
+        assert len(index) == 3
+        match = index.match(normalize_service_name('ВК: Лайки Экономм'))
+        assert match.key == 'вк лайки эконом'
+        assert 0.9 < match.score < 1
+        assert index.match('вк лайки эконом') == FuzzyMatch('вк лайки эконом', 1.0)
+        assert index.match('instagram репосты') is None
+        assert TrigramIndex(()).match('вк') is None
+
+    def test_ties(self):
+        index = TrigramIndex(['вк лайки 2', 'вк лайки 1'])
+        assert index.match('вк лайки 3', min_score=0).key == 'вк лайки 1'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.metrics import MetricsRegistry, PROVIDER_ERRORS, PROVIDER_REQUEST_SECONDS
+from webhook_api.providers.transport import Transport
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.counter = self.registry.counter('sample_total', 'Sample counter', ('kind',))
+        self.histogram = self.registry.histogram('sample_seconds', 'Sample latency', ('stage',), buckets=(0.1, 1))
+
+    def test_render(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.histogram.observe(0.05, stage='parse')
+        self.histogram.observe(0.5, stage='parse')
+        self.histogram.observe(5, stage='parse')
+        lines = self.registry.render().splitlines()
+        assert '# TYPE sample_total counter' in lines
+        assert 'sample_total{kind="a"} 3' in lines
+        assert 'sample_seconds_bucket{stage="parse",le="0.1"} 1' in lines
+        assert 'sample_seconds_bucket{stage="parse",le="1"} 2' in lines
+        assert 'sample_seconds_bucket{stage="parse",le="+Inf"} 3' in lines
+        assert 'sample_seconds_sum{stage="parse"} 5.55' in lines
+        assert 'sample_seconds_count{stage="parse"} 3' in lines
+
+    def test_merge_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.registry.configure(directory)
+            self.counter.inc(kind='a')
+            self.histogram.observe(0.05, stage='parse')
+            # Dump of another process
+            other = MetricsRegistry()
+            other.counter('sample_total', 'Sample counter', ('kind',)).inc(4, kind='a')
+            other.histogram('sample_seconds', 'Sample latency', ('stage',), buckets=(0.1, 1)).observe(0.5, stage='parse')
+            (pathlib.Path(directory) / 'metrics-1.json').write_text(json.dumps(other.dump()))
+
+            lines = self.registry.render().splitlines()
+            assert 'sample_total{kind="a"} 5' in lines
+            assert 'sample_seconds_bucket{stage="parse",le="0.1"} 1' in lines
+            assert 'sample_seconds_count{stage="parse"} 2' in lines
+
+    def test_exited_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.registry.configure(directory, flush_interval=5)
+            gauge = self.registry.gauge('sample_depth', 'Sample gauge')
+            self.counter.inc(kind='a')
+            gauge.set(1)
+            other = MetricsRegistry()
+            other.counter('sample_total', 'Sample counter', ('kind',)).inc(4, kind='a')
+            other.gauge('sample_depth', 'Sample gauge').set(100)
+            with subprocess.Popen(['true']) as process:
+                process.wait()
+            dead = pathlib.Path(directory) / f'metrics-{process.pid}.json'
+            dead.write_text(json.dumps(other.dump()))
+            future = os.stat(dead).st_mtime + 60
+            os.utime(dead, (future, future))
+
+            for _ in range(2):
+                lines = self.registry.render().splitlines()
+                assert 'sample_total{kind="a"} 5' in lines, 'Counters of exited processes are kept'
+                assert 'sample_depth 1' in lines, 'Gauges of exited processes are dropped'
+            assert not dead.exists()
+            assert sorted(path.name for path in pathlib.Path(directory).glob('*.json')) == [
+                'archive.json', f'metrics-{os.getpid()}.json']
+
+            # Own dump is archived at exit
+            self.registry._pid = os.getpid()
+            self.registry._exit()
+            self.registry._pid = None
+            assert [path.name for path in pathlib.Path(directory).glob('metrics-*.json')] == []
+            assert json.loads((pathlib.Path(directory) / 'archive.json').read_text())['sample_total'] == {'["a"]': 5}
+
+    def test_stale_gauges_ignored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.registry.configure(directory, flush_interval=5)
+            self.registry.gauge('sample_depth', 'Sample gauge', ('name',)).set(1, name='own')
+            other = MetricsRegistry()
+            other.gauge('sample_depth', 'Sample gauge', ('name',)).set(100, name='hung')
+            stale = pathlib.Path(directory) / 'metrics-1.json'
+            stale.write_text(json.dumps(other.dump()))
+            os.utime(stale, (0, 0))
+            lines = self.registry.render().splitlines()
+            assert 'sample_depth{name="own"} 1' in lines
+            assert not any('hung' in line for line in lines)
+
+    def test_transport_instrumentation(self):
+        session = mock.Mock()
+        session.post.return_value.status_code = 502
+        transport = Transport('instrumented', session)
+        transport.post('add', 'https://example.com')
+        session.post.side_effect = ConnectionError()
+        with self.assertRaises(ConnectionError):
+            transport.post('add', 'https://example.com')
+
+        assert PROVIDER_ERRORS.dump()[json.dumps(['instrumented', 'add', 'HTTP5xx'])] == 1
+        assert PROVIDER_ERRORS.dump()[json.dumps(['instrumented', 'add', 'ConnectionError'])] == 1
+        assert sum(PROVIDER_REQUEST_SECONDS.dump()[json.dumps(['instrumented', 'add'])][:-1]) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
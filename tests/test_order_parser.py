@@ -6,8 +6,9 @@ import typing  # pylint: disable=unused-import
 import unittest
 from unittest import mock  # pylint: disable=unused-import
 
-from webhook_api.order_parser import (OrderDetails, parse_order,
-                                      parse_raw_orders, unescape_url)
+from webhook_api.order_parser import (OrderDetails, iter_raw_orders,
+                                      parse_order, parse_raw_orders,
+                                      unescape_url)
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -96,6 +97,15 @@ class TestOrderParser(unittest.TestCase):
         assert len(orders) == 33
         assert all([order.is_payed and not order.is_package for order in orders])
 
+    def test_iter_raw_orders(self):
+        sample = 'Услуга ВК: Лайки Премиум: 1 руб. / 1 шт   Ссылка: https://vk.com/wall-217057222_2  Количество: 120 - 1x120 = 120; ' \
+                 'Услуга broken; ' \
+                 'Услуга ВК: Лайки Премиум: 1 руб. / 1 шт   Ссылка: https://vk.com/wall-217057222_1  Количество: 120 - 1x120 = 120'
+        orders = iter_raw_orders(sample)
+        assert not isinstance(orders, list)
+        assert [order.url for order in orders] == ['https://vk.com/wall-217057222_2', 'https://vk.com/wall-217057222_1']
+        assert list(iter_raw_orders('')) == []
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+import logging
+import os
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+
+from webhook_api.app_factory import create_app
+from webhook_api.ext import db
+from webhook_api.jobs import utcnow
+from webhook_api.models import Notification, NotificationState, Providers
+from webhook_api.outbox import OutboxDispatcher, pack_digest
+from webhook_api.providers.dummy import DummyProvider, TelegramClient, TelegramError
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@mock.patch.dict(os.environ, {'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.app: flask.Flask = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.telegram = mock.Mock()
+        self.dispatcher = OutboxDispatcher(self.app, client=self.telegram)
+        self.provider = DummyProvider({'token': 'secret', 'chat_id': '-100'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def notifications(self) -> list[Notification]:
+        db.session.expire_all()
+        return list(db.session.execute(db.select(Notification).order_by(Notification.id)).scalars())
+
+    def test_deliver(self):
+        notification_id = self.provider.notify('<b>Order</b>')
+        self.telegram.send_message.assert_not_called()
+        self.telegram.send_message.return_value = {'ok': True, 'result': {'message_id': 7}}
+        assert self.dispatcher.run_once() == 1
+        self.telegram.send_message.assert_called_once_with('-100', '<b>Order</b>')
+        notification, = self.notifications()
+        assert notification.id == notification_id
+        assert notification.state == NotificationState.sent
+        assert notification.message_id == '7'
+        assert self.dispatcher.run_once() == 0, 'Sent once'
+
+    def test_retry(self):
+        self.provider.notify('first')
+        self.provider.notify('second')
+        self.telegram.send_message.side_effect = [
+            TelegramError('Too Many Requests: retry after 30', 429, retry_after=30),
+            TelegramError('Bad Request: chat not found', 400),
+        ]
+        assert self.dispatcher.run_once() == 2
+        retried, failed = self.notifications()
+        assert retried.state == NotificationState.pending
+        assert (retried.available_at.replace(tzinfo=None) - utcnow().replace(tzinfo=None)).total_seconds() > 25
+        assert retried.error_hint == 'Too Many Requests: retry after 30'
+        assert failed.state == NotificationState.failed
+        assert self.dispatcher.run_once() == 0, 'Retried after Retry-After delay'
+        assert self.dispatcher.depth() == 1
+
+    def entry(self, order_id: str, n: int) -> mock.Mock:
+        order = mock.Mock(order_id=order_id, payment_system='cloudpayments')
+        return mock.Mock(entry_id=f'{order_id}-{n}', service_name='ВК: Лайки', provider_id=Providers.socproof,
+                         service_id='101', quantity=1.0, units_amount=100, url='https://vk.com/wall1',
+                         is_payed=True, is_package=False, order=order)
+
+    def test_digest(self):
+        provider = DummyProvider({'token': 'secret', 'chat_id': '-100', 'digest_window': 5})
+        for n in range(40):
+            provider.describe(self.entry('1001', n))
+        provider.make_order(self.entry('1002', 0))
+        assert self.dispatcher.run_once() == 0, 'Digest window'
+
+        db.session.execute(db.update(Notification).where(Notification.id == 1).values(available_at=utcnow()))
+        db.session.commit()
+        self.telegram.send_message.return_value = {'ok': True, 'result': {'message_id': 7}}
+        assert self.dispatcher.run_once() == 41, 'Pending lines join the due one'
+        texts = [call.args[1] for call in self.telegram.send_message.call_args_list]
+        assert len(texts) == 2
+        assert all(len(text) <= 4096 for text in texts)
+        assert texts[0].startswith('<b>Order 1001</b>\n<b>1001-0</b> <code>ВК: Лайки</code> socproof:101 × 100')
+        assert '#socproof #cloudpayments #payed #service_id101' in texts[0]
+        assert texts[1].startswith('<b>Order 1001</b>'), 'Header is repeated in the next part'
+        assert '<b>Order 1002</b>' in texts[1] and '#unrouted' in texts[1]
+        assert {notification.state for notification in self.notifications()} == {NotificationState.sent}
+
+    def test_pack_digest(self):
+        groups = {'1': [mock.Mock(text='a' * 100) for _ in range(3)], '2': [mock.Mock(text='b' * 5000)]}
+        messages = pack_digest(groups, limit=250)
+        assert [len(included) for _, included in messages] == [2, 1, 1]
+        assert messages[1][0] == '<b>Order 1</b>\n' + 'a' * 100
+        assert messages[2][0] == '<b>Order 2</b>\n' + 'b' * (250 - len('<b>Order 2</b>') - 1)
+
+    def test_pack_digest_markup(self):
+        line = '<b>1001-0</b> <code>ВК: Лайки &amp; репосты</code> socproof:101 × 100 https://vk.com/wall-1_2'
+        text = line + '\n#socproof #failed\n' + '&lt;error&gt; ' * 100
+        [(message, _)] = pack_digest({'1001': [mock.Mock(text=text)]}, limit=250)
+        assert len(message) <= 250
+        assert message == '<b>Order 1001</b>\n' + line + '\n#socproof #failed', 'Cut on a line boundary'
+
+        [(message, _)] = pack_digest({'1001': [mock.Mock(text=line * 5)]}, limit=100)
+        assert message == '<b>Order 1001</b>\n1001-0 ВК: Лайки &amp; репосты socproof:101 × 100 https://vk.com/wall-1_21001-0 ВК', \
+            'Too long line loses its markup'
+
+        [(message, _)] = pack_digest({'1001': [mock.Mock(text='&amp;' * 100)]}, limit=40)
+        assert message == '<b>Order 1001</b>\n' + '&amp;' * 4, 'Entities are not cut'
+
+    def test_telegram_error(self):
+        transport = mock.Mock()
+        transport.post.return_value.json.return_value = {
+            'ok': False, 'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 5}}
+        with self.assertRaises(TelegramError) as ctx:
+            TelegramClient('secret', transport).send_message('-100', 'text')
+        assert ctx.exception.retry_after == 5
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import logging
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.models import Providers
+from webhook_api.panels import PANELS, PanelSpec, register_panel
+from webhook_api.providers import PROVIDERS, get_provider
+from webhook_api.providers.panel import PanelAPI, PanelAPIError, PanelProvider
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+SPEC = PanelSpec(name='sample', provider_id=100, base_url='https://panel.local/api/v2', token_key='SAMPLE_TOKEN')
+
+
+class TestPanelAPI(unittest.TestCase):
+
+    def test_registry_drives_providers(self):
+        for name, spec in PANELS.items():
+            assert Providers[name].value == spec.provider_id
+            Provider = get_provider(Providers[name])
+            assert issubclass(Provider, PanelProvider)
+            assert Provider.spec is spec
+        assert set(PROVIDERS) == set(PANELS) | {'dummy'}
+
+    def test_duplicate_registration(self):
+        with self.assertRaises(ValueError):
+            register_panel(PANELS['socproof'])
+
+    def test_invoke(self):
+        transport = mock.Mock()
+        transport.post.return_value.json.return_value = {'balance': '100.84', 'currency': 'USD'}
+        api = PanelAPI(SPEC, 'secret', transport)
+        assert api.balance() == {'balance': '100.84', 'currency': 'USD'}
+
+        transport.post.assert_called_once_with(
+            'balance', SPEC.base_url,
+            data={'key': 'secret', 'action': 'balance'},
+            verify=SPEC.verify, timeout=SPEC.timeout,
+        )
+        transport.post.return_value.json.assert_called_once()
+
+    def test_invoke_error(self):
+        transport = mock.Mock()
+        transport.post.return_value.json.return_value = {'error': 'Incorrect order ID'}
+        api = PanelAPI(SPEC, 'secret', transport)
+        with self.assertRaises(PanelAPIError):
+            api.status('1')
+
+    def test_make_order(self):
+        transport = mock.Mock()
+        transport.post.return_value.json.return_value = {'order': 23501}
+        provider = type('SampleProvider', (PanelProvider,), {'spec': SPEC})({'token': 'secret'}, transport)
+        details = mock.Mock(url='https://t.me/channel', service_id='1', units_amount=300, quantity=1.0)
+        assert provider.make_order(details) == 23501
+        assert transport.post.call_args.kwargs['data']['quantity'] == 300
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ import typing  # pylint: disable=unused-import
 import unittest
 from unittest import mock  # pylint: disable=unused-import
 
-from webhook_api.parser import parse_order, unescape_url
+from webhook_api.parser import parse_order, parse_orders, unescape_url
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -133,6 +133,36 @@ class TestOrderParser(unittest.TestCase):
         assert order.units_amount == 2000
         assert order.service_name == 'Telegram: Премиум 2000 подп'
 
+    def test_parse_orders(self):
+        products = [
+            {
+                'name': 'Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/wall-215968286_46  Количество: 95',
+                'quantity': 1,
+                'amount': 31,
+                'price': '31'
+            },
+            {
+                'name': 'Услуга ВК: Лайки Эконом: 0.33 руб. / 1 шт   Ссылка: https://vk.com/wall-215968286_46  Количество: 95',
+                'quantity': 2,
+                'amount': 62,
+                'price': '31',
+                'externalid': 'ext-1',
+            },
+            {
+                'name': 'Unknown product',
+                'quantity': 1,
+                'amount': 1,
+                'price': '1'
+            },
+        ]
+        first, second, unknown = parse_orders(products)
+        assert unknown is None
+        assert first.quantity == 1 and second.quantity == 2
+        assert second.calculated_price == 62.7
+        assert second.is_payed is True
+        assert first.as_dict()['url'] == 'https://vk.com/wall-215968286_46'
+        assert parse_orders(products[:1]) == [first]
+
 
 if __name__ == '__main__':
     unittest.main()
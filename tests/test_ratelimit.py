@@ -0,0 +1,139 @@
+import logging
+import sys
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+
+from webhook_api.models import RateLimitBucket
+from webhook_api.providers.ratelimit import BucketStore, RateLimited, RateLimiter
+from webhook_api.providers.transport import Transport
+from webhook_api.providers.utils import RETRYABLE, classify_error, retry_on_failure, retry_scope
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://', poolclass=StaticPool,
+                                       connect_args={'check_same_thread': False})
+        RateLimitBucket.__table__.create(self.engine)
+        self.store = BucketStore(self.engine)
+        self.now = 1000.0
+        self.sleeps = []
+        patcher = mock.patch('webhook_api.providers.ratelimit.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('webhook_api.providers.ratelimit.time.sleep', self.sleeps.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def limiter(self, **kwargs) -> RateLimiter:
+        return RateLimiter('sample', key='sample:key', rate=2, burst=2, store=self.store, **kwargs)
+
+    def call(self, limiter: RateLimiter) -> None:
+        with limiter.slot():
+            pass
+
+    def test_queue(self):
+        limiter = self.limiter()
+        self.call(limiter)
+        self.call(limiter)
+        assert self.sleeps == [], 'Burst is not queued'
+        self.call(limiter)
+        self.call(limiter)
+        assert self.sleeps == [0.5, 1.0]
+
+        self.now += 10
+        self.call(limiter)
+        assert self.sleeps == [0.5, 1.0], 'Bucket refilled'
+
+    def test_shared_bucket(self):
+        limiter, other = self.limiter(), self.limiter()
+        self.call(limiter)
+        self.call(limiter)
+        self.call(other)
+        assert self.sleeps == [0.5]
+        with self.engine.connect() as conn:
+            assert conn.execute(sa.select(RateLimitBucket.tokens)).scalar() == -1
+
+    def test_defer(self):
+        limiter = self.limiter(max_wait=1)
+        for _ in range(4):
+            self.call(limiter)
+        with self.assertRaises(RateLimited) as ctx:
+            self.call(limiter)
+        assert ctx.exception.retry_after == 1.5
+        assert classify_error(ctx.exception) == RETRYABLE
+
+        # Deadline of retry scope limits the wait too
+        self.now += 10
+        self.call(self.limiter())
+        self.call(self.limiter())
+        with retry_scope(deadline=0), self.assertRaises(RateLimited):
+            self.call(self.limiter())
+
+    def test_bulkhead(self):
+        limiter = RateLimiter('sample', max_in_flight=1, max_wait=0.01)
+        with limiter.slot():
+            with self.assertRaises(RateLimited) as ctx:
+                self.call(limiter)
+            assert ctx.exception.reason == 'in_flight'
+            assert limiter.stats()['in_flight'] == 1
+        self.call(limiter)
+        assert limiter.stats()['in_flight'] == 0
+
+    def test_bulkhead_rejection_keeps_token(self):
+        limiter = self.limiter(max_in_flight=1, max_wait=0.01)
+        with limiter.slot():
+            for _ in range(3):
+                with self.assertRaises(RateLimited):
+                    self.call(limiter)
+        with self.engine.connect() as conn:
+            assert conn.execute(sa.select(RateLimitBucket.tokens)).scalar() == 1, 'Only the admitted call took a token'
+
+        # Slot is released when the token is refused
+        limiter = self.limiter(max_in_flight=1, max_wait=0)
+        self.call(limiter)
+        with self.assertRaises(RateLimited) as ctx:
+            self.call(limiter)
+        assert ctx.exception.reason == 'rate'
+        assert limiter.stats()['in_flight'] == 0
+        assert limiter._semaphore.acquire(blocking=False)
+
+    def test_transport_defers(self):
+        session = mock.Mock()
+        session.post.return_value.status_code = 200
+        transport = Transport('limited', session, limiter=self.limiter(max_wait=0))
+        call = retry_on_failure()(lambda: transport.post('status', 'https://example.com'))
+        call()
+        call()
+        with retry_scope(defer=True), self.assertRaises(Exception) as ctx:
+            call()
+        assert ctx.exception.delay >= 0.5
+        assert session.post.call_count == 2
+
+    def test_lost_update(self):
+        limiter = self.limiter()
+        self.call(limiter)
+        execute = sa.engine.Connection.execute
+        updates = []
+
+        def _execute(conn, statement, *args, **kwargs):
+            if isinstance(statement, sa.Update) and not updates:
+                # Another process took a token in between
+                updates.append(execute(conn, statement.values(tokens=0), *args, **kwargs))
+            return execute(conn, statement, *args, **kwargs)
+
+        with mock.patch.object(sa.engine.Connection, 'execute', _execute):
+            self.call(limiter)
+        assert self.sleeps == [0.5], 'Reservation is repeated with the new bucket state'
+        with self.engine.connect() as conn:
+            assert conn.execute(sa.select(RateLimitBucket.version)).scalar() == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
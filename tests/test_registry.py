@@ -0,0 +1,87 @@
+import http.server
+import logging
+import sys
+import threading
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+from webhook_api.config import Config
+from webhook_api.models import Providers, ServiceProvider
+from webhook_api.providers.registry import ProviderRegistry, get_registry
+from webhook_api.providers.transport import build_session, session_stats
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProviderRegistry(unittest.TestCase):
+
+    def test_provider_cached(self):
+        registry = ProviderRegistry(Config())
+        provider = registry.get(Providers.socproof)
+        assert registry.get(Providers.socproof) is provider
+        assert registry.get(Providers.dummy) is not provider
+        assert provider.client._transport is registry.transport(Providers.socproof)
+
+    def test_rank(self):
+        registry = ProviderRegistry(Config())
+        candidates = [
+            ServiceProvider('likes', '1', Providers.socproof),
+            ServiceProvider('likes', '2', Providers.justanotherpanel),
+            ServiceProvider('likes', '3', Providers.prosmmstore),
+        ]
+        assert registry.rank(candidates) == candidates, 'Configured order without observations'
+
+        registry.transport(Providers.socproof).latency = 10.0
+        registry.transport(Providers.justanotherpanel).breaker._trip(0)
+        assert [candidate.service_id for candidate in registry.rank(candidates)] == ['3', '1', '2']
+
+    def test_shared_state_engine(self):
+        engine = mock.Mock()
+        registry = ProviderRegistry(Config(), engine)
+        transport = registry.transport(Providers.socproof)
+        assert transport.breaker._store._engine is engine
+        assert transport.limiter._store._engine is engine
+
+        # Outside app context (e.g. dispatcher thread) without engine: process-local state
+        transport = ProviderRegistry(Config()).transport(Providers.socproof)
+        assert transport.breaker._store is None and transport.limiter._store is None
+
+    def test_process_wide_registry(self):
+        assert get_registry() is get_registry()
+
+    def test_connection_reuse(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            session = build_session()
+            url = f'http://127.0.0.1:{server.server_address[1]}/'
+            for _ in range(5):
+                session.get(url).json()
+            [stats] = session_stats(session).values()
+            assert stats['requests'] == 5
+            assert stats['connections'] == 1
+            assert stats['reuse_rate'] == 0.8
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
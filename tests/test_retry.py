@@ -0,0 +1,119 @@
+import logging
+import sys
+import time
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import requests
+from urllib3.exceptions import MaxRetryError, NameResolutionError, NewConnectionError, ProtocolError
+
+from webhook_api.providers.breaker import CircuitOpen
+from webhook_api.providers.panel import PanelAPIError
+from webhook_api.providers.utils import (AMBIGUOUS, FATAL, RETRYABLE, RetryLater,
+                                         backoff_delay, classify_error,
+                                         retry_on_failure, retry_scope)
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def http_error(status: int, headers: dict = None) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+@mock.patch('webhook_api.providers.utils.time.sleep')
+class TestRetryOnFailure(unittest.TestCase):
+
+    def test_classify_error(self, _):
+        assert classify_error(requests.ConnectTimeout()) == RETRYABLE
+        assert classify_error(requests.ReadTimeout()) == AMBIGUOUS
+        assert classify_error(http_error(429)) == RETRYABLE
+        assert classify_error(http_error(502)) == AMBIGUOUS
+        assert classify_error(http_error(403)) == FATAL
+        assert classify_error(PanelAPIError('Invalid API key')) == FATAL
+        assert classify_error(PanelAPIError('You have active order with this link. Please wait')) == RETRYABLE
+        assert classify_error(KeyError('order')) == FATAL
+
+    def test_classify_connection_error(self, _):
+        refused = NewConnectionError(None, 'Failed to establish a new connection: [Errno 111] Connection refused')
+        assert classify_error(requests.ConnectionError(MaxRetryError(None, '/', refused))) == RETRYABLE
+        assert classify_error(requests.ConnectionError(refused)) == RETRYABLE
+        unresolved = NameResolutionError('panel.example', None, OSError('Name or service not known'))
+        assert classify_error(requests.ConnectionError(MaxRetryError(None, '/', unresolved))) == RETRYABLE
+        disconnected = ProtocolError('Connection aborted.', ConnectionResetError())
+        assert classify_error(requests.ConnectionError(disconnected)) == AMBIGUOUS
+        assert classify_error(requests.ConnectionError()) == AMBIGUOUS
+
+    def test_refused_order_deferred(self, sleep):
+        error = requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused')))
+        func = mock.Mock(side_effect=error)
+        with retry_scope(defer=True), self.assertRaises(RetryLater):
+            retry_on_failure(idempotent=False)(func)()
+        func.assert_called_once()
+
+    def test_backoff_delay(self, _):
+        for attempt in range(1, 10):
+            delay = backoff_delay(attempt, base=0.2, cap=5.0)
+            cap = min(5.0, 0.2 * 2 ** (attempt - 1))
+            assert cap / 2 <= delay <= cap
+
+    def test_retry_until_success(self, sleep):
+        func = mock.Mock(side_effect=[requests.ConnectTimeout(), requests.ReadTimeout(), 'ok'])
+        assert retry_on_failure(attempts=3)(func)() == 'ok'
+        assert func.call_count == 3
+        assert sleep.call_count == 2
+
+    def test_original_exception_raised(self, sleep):
+        error = requests.ConnectTimeout('timeout')
+        func = mock.Mock(side_effect=error)
+        with self.assertRaises(requests.ConnectTimeout) as ctx:
+            retry_on_failure(attempts=3)(func)()
+        assert ctx.exception is error
+        assert func.call_count == 3
+
+    def test_fatal_not_repeated(self, sleep):
+        func = mock.Mock(side_effect=PanelAPIError('Invalid API key'))
+        with self.assertRaises(PanelAPIError):
+            retry_on_failure()(func)()
+        func.assert_called_once()
+        sleep.assert_not_called()
+
+    def test_ambiguous_not_repeated_for_non_idempotent(self, sleep):
+        func = mock.Mock(side_effect=requests.ReadTimeout())
+        with self.assertRaises(requests.ReadTimeout):
+            retry_on_failure(idempotent=False)(func)()
+        func.assert_called_once()
+
+    def test_deadline(self, sleep):
+        func = mock.Mock(side_effect=requests.ConnectTimeout())
+        with retry_scope(deadline=time.monotonic()), self.assertRaises(requests.ConnectTimeout):
+            retry_on_failure(attempts=5)(func)()
+        func.assert_called_once()
+
+    def test_deferred(self, sleep):
+        error = http_error(429, {'Retry-After': '30'})
+        func = mock.Mock(side_effect=error)
+        with retry_scope(defer=True), self.assertRaises(RetryLater) as ctx:
+            retry_on_failure()(func)()
+        func.assert_called_once()
+        sleep.assert_not_called()
+        assert ctx.exception.delay == 30
+        assert ctx.exception.error is error
+
+    def test_circuit_open_not_waited_inline(self, sleep):
+        func = mock.Mock(side_effect=CircuitOpen('sample', 3))
+        with retry_scope(deadline=time.monotonic() + 30), self.assertRaises(CircuitOpen):
+            retry_on_failure(attempts=3)(func)()
+        func.assert_called_once()
+        sleep.assert_not_called()
+
+        with retry_scope(defer=True), self.assertRaises(RetryLater) as ctx:
+            retry_on_failure()(func)()
+        assert ctx.exception.delay >= 3
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+import logging
+import os
+import sys
+import unittest
+from http import HTTPStatus
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+
+from webhook_api.app_factory import create_app
+from webhook_api.ext import db
+from webhook_api.models import Providers, Revision, ServiceDescription
+from webhook_api.routing import ROUTING_REVISION, RoutingCache
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@mock.patch.dict(os.environ, {'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+class TestRoutingCache(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch.dict(os.environ, {'API_TOKENS': 'qwerty'}):
+            self.app: flask.Flask = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client: flask.testing.FlaskClient = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def update_services(self, rows) -> dict:
+        rv = self.client.post('/api/v1/updateServices', json=rows, headers={'Authorization': 'Bearer qwerty'})
+        assert rv.status_code == HTTPStatus.OK
+        return rv.json['result']
+
+    def routes(self) -> list[tuple]:
+        return db.session.execute(
+            db.select(ServiceDescription.id, ServiceDescription.service_name, ServiceDescription.priority,
+                      ServiceDescription.service_id, ServiceDescription.provider_id)
+            .order_by(ServiceDescription.service_name, ServiceDescription.priority)
+        ).all()
+
+    def test_resolve(self):
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        cache = RoutingCache(check_interval=60)
+        details = cache.resolve('вк: лайки эконом')
+        assert details.provider_id == Providers.socproof
+        assert details.service_id == '101'
+        assert cache.resolve('unknown').provider_id == Providers.dummy
+        assert cache.stats() == {'revision': 1, 'services': 1, 'hits': 1, 'misses': 1, 'fuzzy_hits': 0, 'reloads': 1}
+
+    def test_reload_on_revision(self):
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        cache = RoutingCache(check_interval=0)
+        assert cache.resolve('вк: лайки эконом').service_id == '101'
+
+        # Routing table changed by another process
+        self.update_services([['ВК: Лайки Эконом', '202', 'justanotherpanel']])
+        details = cache.resolve('вк: лайки эконом')
+        assert details.provider_id == Providers.justanotherpanel
+        assert details.service_id == '202'
+        assert cache.stats()['reloads'] == 2
+
+    def test_alternate_providers(self):
+        self.update_services([
+            ['ВК: Лайки Эконом', '101', 'socproof', '202', 'justanotherpanel', '', ''],
+            ['ВК: Репосты', '103', 'prosmmstore'],
+            ['ВК: Друзья', '104', 'unknown', '105', 'socproof'],
+        ])
+        cache = RoutingCache(check_interval=60)
+        candidates = cache.candidates('вк: лайки эконом')
+        assert [(c.provider_id, c.service_id) for c in candidates] == [
+            (Providers.socproof, '101'), (Providers.justanotherpanel, '202')]
+        assert cache.resolve('вк: лайки эконом').provider_id == Providers.socproof
+        assert len(cache.candidates('вк: репосты')) == 1
+        assert cache.resolve('вк: друзья').provider_id == Providers.dummy, 'Invalid row is skipped'
+
+    def test_update_auth_required(self):
+        rv = self.client.post('/api/v1/updateServices', json=[['ВК: Лайки Эконом', '101', 'socproof']])
+        assert rv.status_code == HTTPStatus.BAD_REQUEST
+        assert self.routes() == []
+
+    def test_update_diff(self):
+        result = self.update_services([
+            ['ВК: Лайки Эконом', '101', 'socproof', '202', 'justanotherpanel'],
+            ['ВК: Репосты', '103', 'prosmmstore'],
+            ['ВК: Друзья', '104', 'socproof'],
+            [' вк: друзья ', '999', 'socproof'],
+        ])
+        assert (result['inserted'], result['updated'], result['deleted']) == (4, 0, 0)
+        before = {(name, priority): row_id for row_id, name, priority, *_ in self.routes()}
+        assert len(before) == 4, 'Duplicate service name: the first row wins'
+
+        result = self.update_services([
+            ['ВК: Лайки Эконом', '101', 'socproof', '303', 'justanotherpanel'],
+            ['ВК: Друзья', '104', 'socproof', '105', 'prosmmstore'],
+        ])
+        assert (result['inserted'], result['updated'], result['deleted']) == (1, 1, 1)
+        routes = self.routes()
+        assert [(name, priority, service_id, provider_id) for _, name, priority, service_id, provider_id in routes] == [
+            ('вк: друзья', 0, '104', Providers.socproof),
+            ('вк: друзья', 1, '105', Providers.prosmmstore),
+            ('вк: лайки эконом', 0, '101', Providers.socproof),
+            ('вк: лайки эконом', 1, '303', Providers.justanotherpanel),
+        ]
+        assert routes[0].id == before['вк: друзья', 0], 'Unchanged rows are kept'
+        assert routes[3].id == before['вк: лайки эконом', 1], 'Changed rows are updated in place'
+
+    def test_identical_push_skipped(self):
+        rows = [['ВК: Лайки Эконом', '101', 'socproof']]
+        first = self.update_services(rows)
+        revision = Revision.get_value(ROUTING_REVISION)
+        second = self.update_services(rows + [['ВК: Друзья', '104', 'unknown']])
+        assert second == {**first, 'inserted': 0, 'skipped': True}
+        assert Revision.get_value(ROUTING_REVISION) == revision, 'Routing caches are not reloaded'
+
+        assert not self.update_services([['ВК: Лайки Эконом', '102', 'socproof']])['skipped']
+
+    def test_normalized_names(self):
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        assert db.session.execute(db.select(ServiceDescription.service_key)).scalar() == 'вк лайки эконом'
+        cache = RoutingCache(check_interval=60)
+        # Extra spaces, Latin "a" and "K", no colon
+        assert cache.resolve('  BK  Лaйки\xa0ЭКОНОМ ').service_id == '101'
+        assert cache.stats()['hits'] == 1
+
+    def test_fuzzy_match(self):
+        self.update_services([
+            ['ВК: Лайки Эконом', '101', 'socproof'],
+            ['Telegram: Подписчики Эконом', '102', 'socproof'],
+        ])
+        cache = RoutingCache(check_interval=60, fuzzy_threshold=0.9)
+        with self.assertLogs('webhook_api.service_matches', logging.WARNING) as logs:
+            assert cache.resolve('ВК: Лайки Экономм').service_id == '101'
+            assert cache.resolve('ВК: Лайки Экономм').service_id == '101'
+            assert cache.resolve('Telegram: Подписчики').provider_id == Providers.dummy, 'Not similar enough'
+        assert len(logs.records) == 2, 'Logged once per name'
+        assert "routed as 'вк лайки эконом'" in logs.output[0]
+        assert "closest is 'теlеgrам подписчики эконом'" in logs.output[1]
+        assert (cache.stats()['fuzzy_hits'], cache.stats()['misses']) == (2, 1)
+
+        cache = RoutingCache(check_interval=60, fuzzy_threshold=0)
+        assert cache.resolve('ВК: Лайки Экономм').provider_id == Providers.dummy
+
+    def test_fuzzy_match_of_revision(self):
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        cache = RoutingCache(check_interval=60)
+        table = cache.table()
+        self.update_services([['Telegram: Подписчики Эконом', '102', 'socproof']])
+        cache.invalidate()
+        assert 'вк лайки эконом' not in cache.index()
+        # Request which read the table before the reload
+        match = table.match('вк лайки экономм')
+        assert table.index[match.key][0].service_id == '101'
+
+    def test_match_cache_bounded(self):
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        with mock.patch('webhook_api.routing.MATCH_CACHE_SIZE', 8):
+            cache = RoutingCache(check_interval=60)
+            for n in range(100):
+                cache.resolve(f'Unknown service {n}')
+        assert cache.table().match.cache_info().currsize == 8
+
+    def test_no_reload_within_interval(self):
+        cache = RoutingCache(check_interval=60)
+        cache.resolve('вк: лайки эконом')
+        self.update_services([['ВК: Лайки Эконом', '101', 'socproof']])
+        assert cache.resolve('вк: лайки эконом').provider_id == Providers.dummy
+        assert cache.stats()['reloads'] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+from unittest import mock  # pylint: disable=unused-import
+
+import flask
+
+from webhook_api.app_factory import create_app
+from webhook_api.config import Config
+from webhook_api.dispatcher import OrderDispatcher
+from webhook_api.ext import db
+from webhook_api.models import Order, OrderEntry, OrderEntryState, Providers
+from webhook_api.sync import StatusSynchronizer
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@mock.patch.dict(os.environ, {'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+class TestStatusSynchronizer(unittest.TestCase):
+
+    def setUp(self):
+        self.app: flask.Flask = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        order = Order(order_id='1', orders_amount=250)
+        db.session.add(order)
+        for n in range(250):
+            db.session.add(OrderEntry(
+                order=order, entry_id=f'1-{n}', state=OrderEntryState.fulfilled,
+                provider_id=Providers.socproof, provider_order_id=str(n),
+            ))
+        # Not synchronized: not accepted by provider / handled by Telegram
+        db.session.add(OrderEntry(order=order, entry_id='1-failed', state=OrderEntryState.failed,
+                                  provider_id=Providers.socproof))
+        db.session.add(OrderEntry(order=order, entry_id='1-dummy', state=OrderEntryState.fulfilled,
+                                  provider_id=Providers.dummy, provider_order_id='1'))
+        db.session.commit()
+
+        self.registry = mock.Mock()
+        self.multi_status = self.registry.get.return_value.client.multi_status
+        self.get_threads = []
+        self.registry.get.side_effect = lambda provider_id: (
+            self.get_threads.append(threading.get_ident()) or self.registry.get.return_value)
+        self.multi_status.side_effect = lambda order_ids: {
+            order_id: {'status': 'Completed'} if int(order_id) % 2 else {'status': 'In progress'}
+            for order_id in order_ids
+        }
+        self.dispatcher = OrderDispatcher(Config())
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batched_sync(self):
+        synchronizer = StatusSynchronizer(Config(), self.registry, self.dispatcher)
+        assert synchronizer.run() == 250
+
+        # socproof accepts 100 orders per request
+        assert self.multi_status.call_count == 3
+        assert sorted(len(call.args[0]) for call in self.multi_status.call_args_list) == [50, 100, 100]
+
+        states = dict(db.session.execute(db.select(OrderEntry.entry_id, OrderEntry.state)).all())
+        assert states['1-1'] == OrderEntryState.completed
+        assert states['1-2'] == OrderEntryState.in_progress
+        assert states['1-failed'] == OrderEntryState.failed
+
+        main_thread = threading.get_ident()
+        assert set(self.get_threads) == {main_thread}, 'Providers are resolved by the caller'
+
+        # Completed entries are not requested again
+        self.multi_status.reset_mock()
+        assert synchronizer.run() == 0
+        assert sum(len(call.args[0]) for call in self.multi_status.call_args_list) == 125
+
+    def test_provider_error(self):
+        self.multi_status.side_effect = Exception('Invalid API key')
+        synchronizer = StatusSynchronizer(Config(), self.registry, self.dispatcher)
+        assert synchronizer.run() == 0
+
+    def test_resolve_state(self):
+        assert StatusSynchronizer.resolve_state({'status': 'Partial', 'remains': '157'}) == OrderEntryState.partial
+        assert StatusSynchronizer.resolve_state({'status': 'Canceled'}) == OrderEntryState.canceled
+        assert StatusSynchronizer.resolve_state({'error': 'Incorrect order ID'}) is None
+        assert StatusSynchronizer.resolve_state(None) is None
+
+
+if __name__ == '__main__':
+    unittest.main()